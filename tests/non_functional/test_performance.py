@@ -0,0 +1,197 @@
+"""
+Micro-benchmarks for the overhead of the simulation machinery itself, i.e., excluding LLM calls.
+"""
+
+import pytest
+import timeit
+import json
+
+import logging
+logger = logging.getLogger("tinytroupe")
+
+import sys
+sys.path.append('../../tinytroupe/')
+sys.path.append('../../')
+sys.path.append('..')
+
+import tinytroupe.control as control
+from tinytroupe.control import transactional
+from tinytroupe.factory.tiny_factory import TinyFactory
+
+from testing_utils import *
+
+
+class _CountingFactory(TinyFactory):
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def plain_increment(self):
+        self.count += 1
+
+    @transactional
+    def increment(self):
+        self.count += 1
+
+    @transactional
+    def increment_many(self, n):
+        for _ in range(n):
+            self.increment()
+
+
+def _overhead_per_call(statement, baseline, number=100_000):
+    """
+    Returns the overhead per call of the statement with respect to the baseline, in microseconds.
+    """
+    statement_time = min(timeit.repeat(statement, number=number, repeat=3))
+    baseline_time = min(timeit.repeat(baseline, number=number, repeat=3))
+    return (statement_time - baseline_time) / number * 1e6
+
+
+def test_transactional_overhead_without_simulation():
+    control.reset()
+    factory = _CountingFactory()
+
+    overhead = _overhead_per_call(factory.increment, factory.plain_increment)
+    print(f"@transactional overhead without a simulation: {overhead:.3f} us/call")
+
+    # with no simulation running, the decorator just forwards the call
+    assert overhead < 5.0
+
+
+def test_transactional_overhead_reentrant(tmp_path):
+    control.reset()
+    control.begin(str(tmp_path / "performance.cache.json"))
+    try:
+        factory = _CountingFactory()
+
+        n = 100_000
+        reentrant_time = min(timeit.repeat(lambda: factory.increment_many(n), number=1, repeat=3))
+        plain_time = min(timeit.repeat(lambda: [factory.plain_increment() for _ in range(n)], number=1, repeat=3))
+
+        overhead = (reentrant_time - plain_time) / n * 1e6
+        print(f"@transactional overhead for reentrant calls: {overhead:.3f} us/call")
+
+        # only the outer call is a real transaction, nested ones just forward the call
+        assert overhead < 5.0
+    finally:
+        control.end()
+
+
+def _prompt_tokens_per_action(agent, steps):
+    """
+    Runs a scripted agent (no LLM calls) for the given number of steps, and returns the average 
+    (estimated) number of prompt tokens per action, both in total and for the episodes alone (i.e., excluding the system
+    prompt and the final message, with the cognitive state and the instruction).
+    """
+    prompt_tokens = []
+    interaction_tokens = []
+
+    def produce_message():
+        agent.reset_prompt()
+        tokens = [len(json.dumps(message["content"], default=str)) // 4 for message in agent.current_messages]
+        prompt_tokens.append(sum(tokens))
+        interaction_tokens.append(sum(tokens[1:-1]))
+        return "assistant", {"action": {"type": "DONE", "content": "", "target": ""},
+                             "cognitive_state": {"goals": "", "attention": "", "emotions": ""}}
+
+    agent._produce_message = produce_message
+
+    for i in range(steps):
+        agent.listen(f"Step {i}: here is some news about the town, which the agent should remember for a while.")
+        agent.act()
+
+    return sum(prompt_tokens) / len(prompt_tokens), sum(interaction_tokens) / len(interaction_tokens)
+
+
+def test_memory_consolidation_prompt_size():
+    control.reset()
+    from tinytroupe.agent import TinyPerson, MemoryConsolidator
+
+    TinyPerson.communication_display = False
+    try:
+        baseline = _prompt_tokens_per_action(TinyPerson("Baseline remembering agent"), steps=500)
+
+        consolidator = MemoryConsolidator(recent_window_tokens=1000, batch_size=20, push_to_semantic_memory=False,
+                                          summarizer=lambda episodes: f"Summary of {len(episodes)} episodes about town news.")
+        consolidated = _prompt_tokens_per_action(TinyPerson("Consolidating agent", memory_consolidator=consolidator), steps=500)
+    finally:
+        TinyPerson.communication_display = True
+
+    print(f"Prompt tokens per action over 500 steps: {baseline[0]:.0f} without consolidation, {consolidated[0]:.0f} with consolidation")
+    print(f"  of which from interactions: {baseline[1]:.0f} without consolidation, {consolidated[1]:.0f} with consolidation")
+
+    # the system prompt is the same in both cases, only the interactions are consolidated
+    assert consolidated[0] < baseline[0]
+    assert consolidated[1] < baseline[1] / 4
+
+
+def _legacy_extract_json(text):
+    """
+    The former, regex-based, JSON extraction, kept here for comparison only.
+    """
+    import re
+    text = re.sub(r'^.*?({|\[)', r'\1', text, flags=re.DOTALL)
+    text = re.sub(r'(}|\])(?!.*(\]|\})).*$', r'\1', text, flags=re.DOTALL)
+    return json.loads(text, strict=False)
+
+def _model_output_of_size(size):
+    """
+    A model output with a JSON object of about the given size, followed by some trailing remarks of similar size.
+    """
+    n = size // 48
+    obj = {"items": [{"id": i, "text": "Some {words}."} for i in range(n)]}
+    return "Here is my answer:\n```json\n" + json.dumps(obj) + "\n```\nSome remarks: " + ("bla " * (size // 8))
+
+def test_extract_json_scaling():
+    from tinytroupe.utils import extract_json, JSONExtractor
+
+    timings = {}
+    for kb in [1, 10, 50, 200]:
+        text = _model_output_of_size(kb * 1024)
+
+        current = min(timeit.repeat(lambda: extract_json(text, strict=True), number=1, repeat=3))
+
+        def streamed():
+            extractor = JSONExtractor()
+            for i in range(0, len(text), 64):
+                extractor.feed(text[i:i+64])
+            return extractor.result()
+        incremental = min(timeit.repeat(streamed, number=1, repeat=3))
+
+        # the former approach is quadratic, so we only run it on the smaller outputs
+        legacy = min(timeit.repeat(lambda: _legacy_extract_json(text), number=1, repeat=1)) if kb <= 50 else None
+        if legacy is not None:
+            assert _legacy_extract_json(text) == extract_json(text) == streamed()
+
+        timings[kb] = (current, incremental, legacy)
+        print(f"extract_json on {kb} KB: {current*1000:.2f} ms, incrementally: {incremental*1000:.2f} ms, " +
+              (f"former regex-based: {legacy*1000:.2f} ms" if legacy is not None else "former regex-based: skipped"))
+
+    # linear: 20x larger outputs take much less than 20^2 times longer
+    assert timings[200][0] < timings[10][0] * 20 * 5
+    assert timings[200][1] < timings[10][1] * 20 * 5
+
+    assert timings[50][0] * 10 < timings[50][2]
+    assert timings[200][0] < 0.1
+
+
+def test_tracing_overhead_when_disabled():
+    import tinytroupe.tracing as tracing
+    assert not tracing.is_enabled()
+
+    factory = _CountingFactory()
+    traced_increment = tracing.traced("increment")(factory.plain_increment)
+
+    def with_span():
+        with tracing.span("increment"):
+            factory.plain_increment()
+
+    decorator_overhead = _overhead_per_call(traced_increment, factory.plain_increment)
+    span_overhead = _overhead_per_call(with_span, factory.plain_increment)
+    print(f"Tracing overhead when disabled: {decorator_overhead:.3f} us/call with @traced, {span_overhead:.3f} us/call with span()")
+
+    # a global check, and at most a no-op context manager
+    assert decorator_overhead < 1.0
+    assert span_overhead < 2.0
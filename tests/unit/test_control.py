@@ -10,7 +10,7 @@ sys.path.append('..')
 from tinytroupe.examples import create_oscar_the_architect, create_lisa_the_data_scientist
 from tinytroupe.agent import TinyPerson, TinyToolUse
 from tinytroupe.environment import TinyWorld
-from tinytroupe.control import Simulation
+from tinytroupe.control import Simulation, SimulationCacheTree
 import tinytroupe.control as control
 from tinytroupe.factory import TinyPersonFactory
 from tinytroupe.enrichment import TinyEnricher
@@ -174,3 +174,258 @@ def test_begin_checkpoint_end_with_factory(setup):
     assert "'define_several'" not in cache_contents, "The cache file should not contain the 'define_several' methods, as these are reentrant."
 
         
+
+
+def test_cache_tree_branches_share_prefix():
+    tree = SimulationCacheTree()
+
+    # a common prefix
+    setup_id = tree.add(SimulationCacheTree.ROOT_DIGEST, "setup", None, {"step": "setup"})
+    setup_digest = tree.nodes[setup_id]["state_digest"]
+
+    # two different branches leaving the same state
+    ad_a_id = tree.add(setup_digest, "show ad A", None, {"step": "ad A"})
+    ad_b_id = tree.add(setup_digest, "show ad B", None, {"step": "ad B"})
+
+    assert len(tree) == 3, "Both branches should be kept in the tree."
+    assert set(tree.children_of(setup_digest)) == {ad_a_id, ad_b_id}, "Both branches should leave the same prefix."
+    assert tree.get(setup_digest, "show ad A")["state"] == {"step": "ad A"}
+    assert tree.get(setup_digest, "show ad C") is None
+
+    # nodes are content-addressed, so merging trees from different runs is a simple union
+    other_tree = SimulationCacheTree()
+    other_tree.add(SimulationCacheTree.ROOT_DIGEST, "setup", None, {"step": "setup"})
+    other_tree.add(setup_digest, "show ad C", None, {"step": "ad C"})
+    tree.merge(other_tree)
+
+    assert len(tree) == 4, "The merged tree should contain the union of the nodes."
+
+    # serialization roundtrip
+    restored_tree = SimulationCacheTree.from_json(tree.to_json())
+    assert restored_tree.nodes.keys() == tree.nodes.keys()
+
+def test_cache_tree_garbage_collection():
+    tree = SimulationCacheTree()
+
+    setup_id = tree.add(SimulationCacheTree.ROOT_DIGEST, "setup", None, {"step": "setup"})
+    setup_digest = tree.nodes[setup_id]["state_digest"]
+    ad_a_id = tree.add(setup_digest, "show ad A", None, {"step": "ad A"})
+    ad_b_id = tree.add(setup_digest, "show ad B", None, {"step": "ad B"})
+    tree.add(tree.nodes[ad_b_id]["state_digest"], "react to ad B", None, {"step": "reaction to ad B"})
+
+    # orphans cannot be reached from the root, so they are collected
+    tree.add("some unknown state", "orphan event", None, {"step": "orphan"})
+    assert tree.collect_garbage() == 1, "Only the orphan node should be collected."
+
+    # retaining only one branch also collects everything that hangs from the others
+    assert tree.collect_garbage(retain={setup_id, ad_a_id}) == 2, "The ad B branch should be collected."
+    assert set(tree.nodes.keys()) == {setup_id, ad_a_id}
+
+def test_cache_garbage_collection_shrinks_cache_file(tmp_path):
+    cache_path = str(tmp_path / "garbage_collection.cache.json")
+
+    simulation = Simulation()
+    simulation.cache_path = cache_path
+
+    setup_id = simulation._add_to_cache_trace({"step": "setup"}, "setup", None)
+    simulation._add_to_execution_trace(setup_id)
+    ad_a_id = simulation._add_to_cache_trace({"step": "ad A"}, "show ad A", None)
+    simulation._add_to_cache_trace({"step": "ad B"}, "show ad B", None)
+    simulation._add_to_execution_trace(ad_a_id)
+    simulation.checkpoint(wait=True)
+
+    assert simulation.collect_cache_garbage(only_current_branch=True) == 1, "The ad B branch should be collected."
+    simulation.checkpoint(wait=True)
+
+    # the collected branch must not be brought back from the file when saving
+    restored = Simulation()
+    restored._load_cache_file(cache_path)
+    assert set(restored.cached_trace.nodes.keys()) == {setup_id, ad_a_id}
+
+def test_legacy_cache_trace_is_converted():
+    legacy_trace = [[None, "event 1", None, {"step": 1}],
+                    ["some hash", "event 2", {"type": "JSON", "value": 2}, {"step": 2}]]
+
+    simulation = Simulation(cached_trace=legacy_trace)
+
+    first_node = simulation._cached_node_for("event 1")
+    assert first_node is not None, "The first legacy event should start from the root."
+
+    simulation._skip_execution_with_cache("event 1")
+    second_node = simulation._cached_node_for("event 2")
+    assert second_node is not None, "The second legacy event should follow the first one."
+    assert second_node["event_output"] == {"type": "JSON", "value": 2}
+
+def test_background_checkpoint(tmp_path):
+    cache_path = str(tmp_path / "background_checkpoint.cache.json")
+
+    simulation = Simulation()
+    simulation.cache_path = cache_path
+
+    node_id = simulation._add_to_cache_trace({"step": 1}, "event 1", None)
+    simulation._add_to_execution_trace(node_id)
+
+    # does not wait for the disk
+    simulation.checkpoint(wait=False)
+    assert not simulation.has_unsaved_cache_changes, "The changes should have been handed to the background writer."
+
+    simulation._add_to_cache_trace({"step": 2}, "event 2", None)
+    simulation.checkpoint(wait=True)
+
+    status = simulation.checkpoint_status()
+    assert status["pending"] == 0 and not status["busy"], "All checkpoints should have been written."
+    assert status["failures"] == 0 and status["last_error"] is None
+    assert status["writes"] >= 1
+
+    # the file contains the latest version of the tree
+    restored = Simulation()
+    restored._load_cache_file(cache_path)
+    assert len(restored.cached_trace) == 2
+
+    # failures are reported through the status, not raised in the simulation thread
+    simulation.cache_path = str(tmp_path / "missing_folder" / "background_checkpoint.cache.json")
+    simulation._add_to_cache_trace({"step": 3}, "event 3", None)
+    simulation.checkpoint(wait=True)
+    assert simulation.checkpoint_status()["failures"] == 1
+    assert simulation.checkpoint_status()["last_error"] is not None
+
+def test_checkpoint_writer_lifecycle(tmp_path):
+    cache_path = str(tmp_path / "lifecycle.cache.json")
+
+    control.reset()
+    control.begin(cache_path, id="lifecycle")
+    simulation = control.current_simulation()
+    simulation._add_to_cache_trace({"step": 1}, "event 1", None)
+    control.checkpoint()
+
+    # another run saves its own branch to the same file in the meantime, which must not be lost
+    other = Simulation()
+    other.cache_path = cache_path
+    other._add_to_cache_trace({"step": "other"}, "other event", None)
+    other.checkpoint(wait=True)
+
+    simulation._add_to_cache_trace({"step": 2}, "event 2", None)
+    control.end()
+
+    # the background thread is stopped once the simulation ends
+    assert simulation._checkpoint_writer._thread is None
+
+    restored = Simulation()
+    restored._load_cache_file(cache_path)
+    assert len(restored.cached_trace) == 3
+
+    # a simulation without a cache path cannot be checkpointed, which is reported right away
+    simulation.cache_path = None
+    simulation._add_to_cache_trace({"step": 3}, "event 3", None)
+    with pytest.raises(ValueError):
+        simulation.checkpoint()
+
+    control.discard("lifecycle")
+    control.reset()
+
+def test_concurrent_simulations(tmp_path):
+    import threading
+    from tinytroupe.factory.tiny_factory import TinyFactory
+
+    control.reset()
+    results = {}
+    barrier = threading.Barrier(2)
+
+    def run_simulation(sim_id):
+        control.begin(str(tmp_path / f"{sim_id}.cache.json"), id=sim_id)
+        try:
+            factory = TinyFactory()
+            # make sure both simulations are running at the same time
+            barrier.wait(timeout=10)
+
+            results[sim_id] = {"factory_name": factory.name,
+                               "simulation_id": control.current_simulation().id,
+                               "registered": list(TinyFactory.all_factories.keys())}
+        finally:
+            control.end()
+
+    threads = [threading.Thread(target=run_simulation, args=(sim_id,)) for sim_id in ["sim_a", "sim_b"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for sim_id in ["sim_a", "sim_b"]:
+        # ids are deterministic within each simulation, and entities do not leak across simulations
+        assert results[sim_id]["factory_name"] == "Factory 1"
+        assert results[sim_id]["simulation_id"] == sim_id
+        assert results[sim_id]["registered"] == ["Factory 1"]
+        assert control._current_simulations[sim_id].status == Simulation.STATUS_STOPPED
+
+    # the main context is not affected by the simulations running in other threads
+    assert control.current_simulation() is None
+
+    control.reset()
+
+def test_entities_remain_available_after_end(setup, tmp_path):
+    import threading
+
+    control.reset()
+    control.begin(str(tmp_path / "after_end.cache.json"))
+
+    agent = TinyPerson("Zed")
+    world = TinyWorld("W", [agent])
+
+    # threads do not inherit the simulation, unless they are given the current context
+    seen_from_thread = {}
+    def look_up():
+        seen_from_thread["agent"] = TinyPerson.get_agent_by_name("Zed")
+        seen_from_thread["simulation"] = control.current_simulation()
+
+    thread = threading.Thread(target=control.in_current_context(look_up))
+    thread.start()
+    thread.join()
+    assert seen_from_thread["agent"] is agent
+    assert seen_from_thread["simulation"] is control.current_simulation()
+
+    control.checkpoint()
+    control.end()
+
+    assert TinyPerson.get_agent_by_name("Zed") is agent
+    assert TinyWorld.get_environment_by_name("W") is world
+    assert TinyPerson.all_agents_names() == ["Zed"]
+
+    # a reset forgets them
+    control.reset()
+    assert TinyPerson.get_agent_by_name("Zed") is None
+
+def test_transactions_of_concurrent_threads(setup, tmp_path):
+    import threading
+
+    control.reset()
+    control.begin(str(tmp_path / "threads.cache.json"))
+    simulation = control.current_simulation()
+    agent = TinyPerson("Yves")
+
+    def listen():
+        agent.listen("Hello from another thread.")
+
+    def run_in_thread(func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+
+    listen_outside_transaction = control.in_current_context(listen)
+
+    simulation.begin_transaction()
+    try:
+        # a thread that was not started from within the transaction runs its own, top-level, transaction
+        misses = simulation.cache_misses
+        run_in_thread(listen_outside_transaction)
+        assert simulation.cache_misses == misses + 1
+
+        # while one started from within the transaction is part of it
+        run_in_thread(control.in_current_context(listen))
+        assert simulation.cache_misses == misses + 1
+    finally:
+        simulation.end_transaction()
+
+    assert not simulation.is_under_transaction()
+
+    control.end()
+    control.reset()
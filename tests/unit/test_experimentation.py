@@ -128,3 +128,86 @@ def test_proposition_class_method(setup):
     assert check_proposition(target=oscar, claim="Oscar writes a novel about how cats are better than dogs.") == False
     assert check_proposition(oscar, "Oscar writes a novel about how cats are better than dogs.") == False
 
+
+def _scenario_for_runner_test(variant):
+    from tinytroupe.factory.tiny_factory import TinyFactory
+
+    if variant.get("fail", False):
+        raise ValueError("Variant configured to fail.")
+    
+    # each variant runs in its own simulation, so names never clash across variants
+    factory = TinyFactory()
+    return {"score": variant["seed"] * 10, "factory_name": factory.name}
+
+def test_experiment_runner(tmp_path):
+    import multiprocessing
+    from tinytroupe.experimentation import ExperimentRunner
+
+    variants = ExperimentRunner.variant_grid(seed=[1, 2], treatment=["control", "ad"])
+    assert len(variants) == 4
+
+    runner = ExperimentRunner(_scenario_for_runner_test, variants + [{"seed": 3, "treatment": "ad", "fail": True}],
+                              name="runner_test", output_folder=str(tmp_path), max_workers=2,
+                              mp_context=multiprocessing.get_context("fork"))
+    results = runner.run()
+
+    assert len(results) == 5
+    done = results[results["status"] == "done"]
+    assert len(done) == 4
+    assert sorted(done["score"].tolist()) == [10, 10, 20, 20]
+    assert set(done["factory_name"]) == {"Factory 1"}
+
+    failed = results[results["status"] == "failed"]
+    assert len(failed) == 1 and "Variant configured to fail" in failed["error"].iloc[0]
+
+    # resuming only reruns what is not done, using the persisted results
+    resumed = ExperimentRunner(_scenario_for_runner_test, variants + [{"seed": 3, "treatment": "ad", "fail": True}],
+                               name="runner_test", output_folder=str(tmp_path), max_workers=0)
+    assert list(resumed.pending_variants().values()) == [{"seed": 3, "treatment": "ad", "fail": True}]
+    
+    results = resumed.run()
+    assert (results["status"] == "done").sum() == 4
+
+def test_experiment_runner_in_process(tmp_path, monkeypatch):
+    import litellm
+    from tinytroupe import litellm_utils
+    from tinytroupe.experimentation import ExperimentRunner
+
+    calls = []
+    mock_completion = litellm.completion
+
+    def completion(**params):
+        calls.append(params)
+        return mock_completion(model="gpt-4o-mini", messages=params["messages"], mock_response="Hello!")
+
+    monkeypatch.setattr(litellm, "completion", completion)
+
+    def scenario(variant):
+        answer = litellm_utils.client().send_message([{"role": "user", "content": "Hi"}])["content"]
+        if variant["treatment"] == "clash":
+            return {"answer": answer, "seed": 0}
+        return {"answer": answer}
+
+    client = litellm_utils.client()
+    cache_settings = (client.cache_api_calls, client.cache_file_name, client.api_cache)
+
+    llm_cache_file = str(tmp_path / "llm.cache.pickle")
+    variants = [{"seed": 1, "treatment": "control"}, {"seed": 2, "treatment": "control"}, {"seed": 3, "treatment": "clash"}]
+    runner = ExperimentRunner(scenario, variants, name="in_process_test", output_folder=str(tmp_path), 
+                              max_workers=0, llm_cache_file=llm_cache_file)
+    results = runner.run()
+
+    # the LLM cache is shared by the variants, and saved to the file
+    assert len(calls) == 1
+    assert os.path.exists(llm_cache_file)
+    assert results[results["status"] == "done"]["answer"].tolist() == ["Hello!", "Hello!"]
+
+    # results cannot overwrite the variant parameters
+    failed = results[results["status"] == "failed"]
+    assert failed["seed"].tolist() == [3] and "seed" in failed["error"].iloc[0]
+
+    # the client's own cache is restored, and the saved LLM cache is used by later runs
+    assert (client.cache_api_calls, client.cache_file_name, client.api_cache) == cache_settings
+    ExperimentRunner(scenario, variants[:2], name="in_process_test_2", output_folder=str(tmp_path), 
+                     max_workers=0, llm_cache_file=llm_cache_file).run()
+    assert len(calls) == 1
@@ -1,5 +1,8 @@
 import pytest
 import os
+import re
+import json
+import threading
 
 import sys
 sys.path.append('../../tinytroupe/')
@@ -11,6 +14,7 @@ from tinytroupe.examples import create_oscar_the_architect
 from tinytroupe.control import Simulation
 import tinytroupe.control as control
 from tinytroupe.factory import TinyPersonFactory
+from tinytroupe.agent import TinyPerson
 
 from testing_utils import *
 
@@ -30,3 +34,82 @@ def test_generate_person(setup):
     assert proposition_holds(f"The following is an acceptable short description for someone working in banking: '{minibio}'"), f"Proposition is false according to the LLM."
 
     
+def test_generate_people_in_parallel(setup, monkeypatch):
+    # the model is scripted: persons 2 and 4 are first given the same name, so only person 4 must be generated again
+    first_round = threading.Barrier(4, timeout=10) # only passed if the first round of calls runs in parallel
+    calls = []
+    calls_lock = threading.Lock()
+
+    def scripted_model_call(self, messages, temperature, frequency_penalty, presence_penalty):
+        position = int(re.search(r"You are generating person (\d+) of", messages[2]["content"]).group(1))
+        regenerating = any("IMPORTANT" in message["content"] for message in messages)
+        with calls_lock:
+            calls.append((position, regenerating))
+
+        if not regenerating:
+            first_round.wait()
+            name = {1: "Ana Costa", 2: "Bruno Lima", 3: "Carla Dias", 4: "Bruno Lima"}[position]
+        else:
+            name = "Diego Alves"
+
+        spec = {"name": name, "age": 30 + position, "nationality": "Brazilian", "residence": "São Paulo", 
+                "occupation": {"title": "Engineer"}}
+        return {"role": "assistant", "content": json.dumps(spec)}
+
+    monkeypatch.setattr(TinyPersonFactory, "_model_call", scripted_model_call)
+    monkeypatch.setattr(TinyPerson, "minibio", lambda self, extended=True: f"{self.name} is an engineer.")
+
+    factory = TinyPersonFactory("Engineers living in São Paulo.")
+    people = factory.generate_people(4, parallelism=4)
+
+    assert [person.name for person in people] == ["Ana Costa", "Bruno Lima", "Carla Dias", "Diego Alves"]
+    assert sorted(calls) == [(1, False), (2, False), (3, False), (4, False), (4, True)]
+    assert factory.generated_names == ["ana costa", "bruno lima", "carla dias", "diego alves"]
+    assert len(factory.generated_minibios) == 4
+
+    # names taken by existing agents are not reused either
+    assert not factory._reserve_name("ANA COSTA")
+
+def test_generate_people_in_parallel_is_cached(setup, monkeypatch):
+    calls = []
+
+    def scripted_model_call(self, messages, temperature, frequency_penalty, presence_penalty):
+        position = int(re.search(r"You are generating person (\d+) of", messages[2]["content"]).group(1))
+        regenerating = any("IMPORTANT" in message["content"] for message in messages)
+        calls.append((position, regenerating))
+
+        name = {1: "Ana Costa", 2: "Bruno Lima", 3: "Bruno Lima"}[position] if not regenerating else "Carla Dias"
+        spec = {"name": name, "age": 30 + position, "nationality": "Brazilian", "residence": "São Paulo", 
+                "occupation": {"title": "Engineer"}}
+        return {"role": "assistant", "content": json.dumps(spec)}
+
+    monkeypatch.setattr(TinyPersonFactory, "_model_call", scripted_model_call)
+    monkeypatch.setattr(TinyPerson, "minibio", lambda self, extended=True: f"{self.name} is an engineer.")
+
+    remove_file_if_exists("factory_test_parallel.cache.json")
+
+    def aux_simulation_to_repeat():
+        control.reset()
+        TinyPerson.clear_agents()
+        calls.clear()
+
+        control.begin("factory_test_parallel.cache.json")
+        factory = TinyPersonFactory("Engineers living in São Paulo.")
+        people = factory.generate_people(3, parallelism=3)
+        control.checkpoint()
+        control.end()
+
+        return [person.name for person in people]
+
+    # first, the model is called, and the clashing person generated again
+    assert aux_simulation_to_repeat() == ["Ana Costa", "Bruno Lima", "Carla Dias"]
+    assert sorted(calls) == [(1, False), (2, False), (3, False), (3, True)]
+
+    # then, the same people are replayed from the cache, without calling the model
+    assert aux_simulation_to_repeat() == ["Ana Costa", "Bruno Lima", "Carla Dias"]
+    assert calls == []
+    assert control.cache_misses() == 0
+
+    remove_file_if_exists("factory_test_parallel.cache.json")
+    control.reset()
+    TinyPersonFactory.clear_factories() # ids start over after a reset, so the names of the factories created here would clash
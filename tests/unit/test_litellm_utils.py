@@ -0,0 +1,316 @@
+import pytest
+import logging
+logger = logging.getLogger("tinytroupe")
+
+import sys
+sys.path.append('../../tinytroupe/')
+sys.path.append('../../')
+sys.path.append('..')
+
+import litellm
+
+from tinytroupe import litellm_utils
+from tinytroupe.litellm_utils import LiteLLMClient, ModelCapabilities
+from testing_utils import *
+
+
+def _scripted_completion(monkeypatch, script):
+    """
+    Replaces the actual LLM calls with a script of outcomes: either an exception to raise, or a text to respond with.
+    Returns the list of parameters of each call.
+    """
+    mock_completion = litellm.completion
+    calls = []
+
+    def completion(**params):
+        calls.append(params)
+        outcome = script[min(len(calls), len(script)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return mock_completion(model="gpt-4o-mini", messages=params["messages"], mock_response=outcome)
+
+    monkeypatch.setattr(litellm, "completion", completion)
+    return calls
+
+
+def test_capabilities_sanitize_parameters(monkeypatch):
+    monkeypatch.setattr(ModelCapabilities, "known_capabilities", dict(ModelCapabilities.known_capabilities))
+    monkeypatch.setattr(ModelCapabilities, "_capabilities_cache", {})
+
+    params = {"model": "groq/llama3-8b-8192", "messages": [], "temperature": 1.0, "echo": True, "stop": [], "max_tokens": 4000}
+
+    # declared as unsupported
+    sanitized = ModelCapabilities.sanitize("groq/llama3-8b-8192", params)
+    assert "echo" not in sanitized and "stop" not in sanitized
+    assert sanitized["temperature"] == 1.0 and sanitized["messages"] == []
+
+    # capabilities are those of the model actually requested, so Gemini models get those of vertex_ai
+    resolved = litellm_utils._resolve_model("gemini/gemini-1.5-pro")
+    assert resolved.startswith("vertex_ai/gemini")
+    assert "presence_penalty" not in ModelCapabilities.sanitize(resolved, {**params, "presence_penalty": 0.5})
+
+    # explicitly registered capabilities take precedence, including the maximum output
+    ModelCapabilities.register("test/", supported_params={"temperature", "max_tokens"}, max_output_tokens=1000)
+    sanitized = ModelCapabilities.sanitize("test/small-model", {**params, "top_p": 1.0})
+    assert set(sanitized.keys()) == {"model", "messages", "temperature", "max_tokens"}
+    assert sanitized["max_tokens"] == 1000
+
+
+def test_capabilities_learned_from_errors(monkeypatch):
+    monkeypatch.setattr(ModelCapabilities, "_learned_unsupported_params", {})
+    monkeypatch.setattr(ModelCapabilities, "_capabilities_cache", {})
+
+    error = litellm.BadRequestError("Unsupported parameter: 'top_p' is not supported with this model.", 
+                                    model="test/learning-model", llm_provider="test")
+    calls = _scripted_completion(monkeypatch, [error, "Hello!"])
+
+    client = LiteLLMClient(cache_api_calls=False)
+    response = client.send_message([{"role": "user", "content": "Hi"}], model="test/learning-model", top_p=0.9)
+    assert response["content"] == "Hello!"
+    assert len(calls) == 2 and "top_p" not in calls[1]
+
+    # the next request is sanitized upfront, so no round trip is wasted
+    client.send_message([{"role": "user", "content": "Hi again"}], model="test/learning-model", top_p=0.9)
+    assert len(calls) == 3 and "top_p" not in calls[2]
+    assert "top_p" in ModelCapabilities.of("test/learning-model")["unsupported_params"]
+
+
+def test_router_fails_over_and_breaks_circuits(monkeypatch):
+    import time
+    from tinytroupe.litellm_utils import ModelRouter
+
+    outage = litellm.ServiceUnavailableError("Service unavailable", model="test/primary", llm_provider="test")
+    calls = []
+    mock_completion = litellm.completion
+
+    def completion(**params):
+        calls.append(params["model"])
+        if params["model"] == "test/primary" and primary_down:
+            raise outage
+        return mock_completion(model="gpt-4o-mini", messages=params["messages"], mock_response=f"From {params['model']}")
+
+    monkeypatch.setattr(litellm, "completion", completion)
+
+    client = LiteLLMClient(cache_api_calls=False)
+    client.router = ModelRouter(fallback_models=["test/fallback"], failure_threshold=2, cooldown=0.2)
+
+    # failures of the primary model fail over immediately, without waiting for retries
+    primary_down = True
+    start = time.monotonic()
+    for _ in range(2):
+        response = client.send_message([{"role": "user", "content": "Hi"}], model="test/primary", waiting_time=5)
+        assert response["content"] == "From test/fallback"
+    assert time.monotonic() - start < 2
+    assert calls == ["test/primary", "test/fallback"] * 2
+
+    # the circuit of the primary model is now open, so it is not even tried
+    client.send_message([{"role": "user", "content": "Hi"}], model="test/primary")
+    assert calls[-1] == "test/fallback" and calls[-2] == "test/fallback"
+    assert client.get_routing_report()["test/primary"]["circuit"] == ModelRouter.OPEN
+
+    # after the cooldown, the primary model is tried again, and closes its circuit if it recovered
+    primary_down = False
+    time.sleep(0.3)
+    response = client.send_message([{"role": "user", "content": "Hi"}], model="test/primary")
+    assert response["content"] == "From test/primary"
+    report = client.get_routing_report()
+    assert report["test/primary"]["circuit"] == ModelRouter.CLOSED
+    assert report["test/fallback"]["calls"] == 3 and report["test/fallback"]["latency_p50"] is not None
+
+
+def test_hedged_requests(monkeypatch):
+    import time
+    from tinytroupe import metrics
+    from tinytroupe.litellm_utils import ModelRouter, HedgingPolicy
+
+    calls = []
+    calls_labels = []
+    mock_completion = litellm.completion
+
+    def completion(**params):
+        calls.append(params["model"])
+        calls_labels.append(metrics.current_labels())
+        if params["model"] == "test/primary" and primary_slow:
+            time.sleep(1.0)
+        return mock_completion(model="gpt-4o-mini", messages=params["messages"], mock_response=f"From {params['model']}")
+
+    monkeypatch.setattr(litellm, "completion", completion)
+
+    client = LiteLLMClient(cache_api_calls=False)
+    client.router = ModelRouter(fallback_models=["test/fallback"])
+    client.set_hedging_policy(HedgingPolicy(percentile=95, max_extra_load=0.5, min_samples=5))
+
+    # fast requests build up the latency statistics, and are not hedged
+    primary_slow = False
+    for _ in range(5):
+        client.send_message([{"role": "user", "content": "Hi"}], model="test/primary")
+    assert calls == ["test/primary"] * 5
+
+    # a slow request is hedged with the fallback model, whose response wins
+    primary_slow = True
+    start = time.monotonic()
+    with metrics.labels(agent="Oscar"):
+        response = client.send_message([{"role": "user", "content": "Hi"}], model="test/primary")
+    assert response["content"] == "From test/fallback"
+    assert time.monotonic() - start < 0.5
+
+    # both requests ran within the caller's context
+    assert [labels.get("agent") for labels in calls_labels[-2:]] == ["Oscar", "Oscar"]
+
+    report = client.get_hedging_report()
+    assert report["requests"] == 1 and report["hedged"] == 1 and report["hedge_wins"] == 1
+    assert client.usage_tracker["test/fallback"]["hedged_calls"] == 1
+    assert client.usage_tracker["test/fallback"]["hedge_wins"] == 1
+
+    # the abandoned request still counts in the usage, once it completes
+    deadline = time.monotonic() + 5
+    while client.usage_tracker["test/primary"]["calls"] < 6 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert client.usage_tracker["test/primary"]["calls"] == 6
+
+    # no more requests are hedged than the extra load allows
+    client.send_message([{"role": "user", "content": "Hi"}], model="test/primary")
+    assert client.get_hedging_report()["hedged"] == 1
+    assert calls[-1] == "test/primary"
+
+    # closing the client shuts its threads down
+    executor = client._executor
+    client.close()
+    assert client._executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(print)
+
+
+def test_call_site_settings(monkeypatch):
+    monkeypatch.setattr(litellm_utils, "call_sites", {"extraction": {"temperature": 0.0}})
+    calls = _scripted_completion(monkeypatch, ["Hello!"])
+
+    litellm_utils.configure_call_site("test.bulk", model="test/cheap-model", max_tokens=100)
+    with pytest.raises(ValueError):
+        litellm_utils.configure_call_site("test.bulk", top_p=0.5)
+
+    client = LiteLLMClient(cache_api_calls=False)
+
+    # the call site's settings apply, and the defaults fill in the rest
+    client.send_message([{"role": "user", "content": "Hi"}], call_site="test.bulk")
+    assert calls[-1]["model"] == "test/cheap-model" and calls[-1]["max_tokens"] == 100
+    assert calls[-1]["temperature"] == litellm_utils.default["temperature"]
+
+    # explicit parameters take precedence over the call site's settings
+    client.send_message([{"role": "user", "content": "Hi"}], call_site="extraction", temperature=0.7)
+    assert calls[-1]["model"] == litellm_utils.default["model"] and calls[-1]["temperature"] == 0.7
+
+    client.send_message([{"role": "user", "content": "Hi"}], call_site="extraction")
+    assert calls[-1]["temperature"] == 0.0
+
+    # usage is reported by call site, too
+    client.send_message([{"role": "user", "content": "Hi"}])
+    report = client.get_call_site_usage_report()
+    assert report["test.bulk"]["calls"] == 1 and report["extraction"]["calls"] == 2 and report["other"]["calls"] == 1
+    assert client.get_usage_report()["test/cheap-model"]["calls"] == 1
+
+    # a setting of None goes back to the default
+    litellm_utils.configure_call_site("test.bulk", model=None)
+    assert litellm_utils.call_site_settings("test.bulk")["model"] == litellm_utils.default["model"]
+
+
+def test_adaptive_max_tokens(monkeypatch, tmp_path):
+    from tinytroupe.litellm_utils import OutputLengthStats
+
+    requested = []
+    mock_completion = litellm.completion
+
+    def completion(**params):
+        # outputs of output_tokens tokens, truncated at max_tokens
+        requested.append(params["max_tokens"])
+        if params.get("stream"):
+            return mock_completion(model="gpt-4o-mini", messages=params["messages"], mock_response="Some output.", stream=True)
+        response = mock_completion(model="gpt-4o-mini", messages=params["messages"], mock_response="Some output.")
+        response.usage.completion_tokens = min(output_tokens, params["max_tokens"])
+        response.choices[0].finish_reason = "length" if output_tokens > params["max_tokens"] else "stop"
+        return response
+
+    monkeypatch.setattr(litellm, "completion", completion)
+
+    file_name = str(tmp_path / "output_lengths.json")
+    stats = OutputLengthStats(percentile=99, margin=1.25, min_samples=5, min_max_tokens=10, file_name=file_name)
+    client = LiteLLMClient(cache_api_calls=False)
+    client.set_output_length_stats(stats)
+    max_tokens = litellm_utils.default["max_tokens"]
+
+    # until there are enough outputs, the configured max_tokens is used
+    output_tokens = 40
+    for _ in range(5):
+        client.send_message([{"role": "user", "content": "Hi"}], call_site="test.short")
+    assert requested == [max_tokens] * 5
+
+    client.send_message([{"role": "user", "content": "Hi"}], call_site="test.short")
+    assert requested[-1] == 50
+
+    # explicit max_tokens, and calls without a call site, are not adapted
+    client.send_message([{"role": "user", "content": "Hi"}], call_site="test.short", max_tokens=1000)
+    client.send_message([{"role": "user", "content": "Hi"}])
+    assert requested[-2:] == [1000, max_tokens]
+
+    # truncated outputs are requested again with larger budgets
+    output_tokens = 120
+    client.send_message([{"role": "user", "content": "Hi"}], call_site="test.short")
+    assert requested[-3:] == [50, 100, 200]
+    report = client.get_output_length_report()["test.short"]
+    assert report["samples"] == 9 and report["truncations"] == 2
+    assert client.get_call_site_usage_report()["test.short"]["calls"] == 10
+
+    # streamed outputs are not adapted, since a truncated one could not be requested again
+    client.send_message([{"role": "user", "content": "Hi"}], call_site="test.short", stream=True, stream_callback=lambda text: None)
+    assert requested[-1] == max_tokens
+
+    # the statistics persist across runs, with those not saved yet saved when the client is closed
+    client.close()
+    assert OutputLengthStats(percentile=99, margin=1.25, min_samples=5, file_name=file_name).max_tokens_for("test.short", max_tokens) == \
+           stats.max_tokens_for("test.short", max_tokens) == 150
+
+
+def test_llm_call_metrics(monkeypatch):
+    from tinytroupe import metrics
+
+    metrics.registry.reset()
+    error = litellm.InternalServerError("Oops", model="test/metrics-model", llm_provider="test")
+    _scripted_completion(monkeypatch, [error, "Hello!", "Hello again!"])
+
+    client = LiteLLMClient(cache_api_calls=False)
+    client.set_api_cache(True, cache_file_name=None)
+
+    with metrics.labels(agent="Oscar"):
+        client.send_message([{"role": "user", "content": "Hi"}], model="test/metrics-model", call_site="test.metrics", max_attempts=1, waiting_time=0)
+        client.send_message([{"role": "user", "content": "Hi"}], model="test/metrics-model", call_site="test.metrics", max_attempts=1, waiting_time=0)
+
+    labels = {"model": "test/metrics-model", "call_site": "test.metrics", "agent": "Oscar"}
+    assert metrics.registry.get("tinytroupe_llm_calls_total").value(**labels) == 1
+    assert metrics.registry.get("tinytroupe_llm_errors_total").value(error="InternalServerError", **labels) == 1
+    assert metrics.registry.get("tinytroupe_llm_retries_total").value(**labels) == 1
+    assert metrics.registry.get("tinytroupe_llm_cache_misses_total").value(**labels) == 1
+    assert metrics.registry.get("tinytroupe_llm_cache_hits_total").value(**labels) == 1
+    assert metrics.registry.get("tinytroupe_llm_call_duration_seconds").count(**labels) == 1
+    assert metrics.registry.get("tinytroupe_llm_tokens_total").value(kind="completion", **labels) > 0
+    assert metrics.registry.get("tinytroupe_llm_calls_in_flight").value() == 0
+    assert "tinytroupe_llm_calls_total{" in metrics.registry.to_prometheus()
+
+
+def test_tracking_from_concurrent_threads():
+    import threading
+
+    client = LiteLLMClient(cache_api_calls=False)
+
+    def track():
+        for i in range(200):
+            client._track_prefix_stability("Oscar", [{"role": "user", "content": f"Hi {i}"}])
+            client._track_structured_output("test/model", repair_attempts=0, failed=False, wasted_tokens=0)
+
+    threads = [threading.Thread(target=track) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.get_prefix_stability_report()["Oscar"]["calls"] == 800
+    assert client.get_structured_output_report()["test/model"]["valid_at_first"] == 800
@@ -0,0 +1,72 @@
+import pytest
+import logging
+logger = logging.getLogger("tinytroupe")
+
+import sys
+sys.path.append('../../tinytroupe/')
+sys.path.append('../../')
+sys.path.append('..')
+
+import json
+import threading
+
+import tinytroupe.control as control
+from tinytroupe.metrics import MetricsRegistry, labels
+from testing_utils import *
+
+
+def test_metrics_are_thread_safe_and_labeled():
+    control.reset()
+    registry = MetricsRegistry()
+    calls = registry.counter("test_calls_total", "Calls.", ["model", "agent"])
+    latency = registry.histogram("test_latency_seconds", "Latency.", ["model"], buckets=[0.1, 1.0])
+
+    # the same metric is returned again, but not with different labels
+    assert registry.counter("test_calls_total", "Calls.", ["model", "agent"]) is calls
+    with pytest.raises(ValueError):
+        registry.gauge("test_calls_total", "Calls.", ["model", "agent"])
+
+    def work(agent):
+        with labels(agent=agent):
+            for _ in range(1000):
+                calls.inc(model="m")
+                latency.observe(0.5, model="m")
+
+    threads = [threading.Thread(target=work, args=(f"Agent {i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls.value() == 8000
+    assert calls.value(agent="Agent 3") == 1000
+    assert latency.count(model="m") == 8000
+
+    [(sample_labels, histogram)] = latency.samples()
+    assert list(histogram["buckets"].values()) == [0, 8000, 8000]
+    assert histogram["sum"] == pytest.approx(4000)
+
+
+def test_metrics_export(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter("test_calls_total", "Calls.", ["model"]).inc(2, model='a "quoted" model')
+    registry.gauge("test_in_flight", "In flight.", []).inc()
+    registry.histogram("test_latency_seconds", "Latency.", ["model"], buckets=[1.0]).observe(0.5, model="m")
+
+    text = registry.to_prometheus()
+    assert '# TYPE test_calls_total counter' in text
+    assert 'test_calls_total{model="a \\"quoted\\" model"} 2' in text
+    assert 'test_in_flight 1' in text
+    assert 'test_latency_seconds_bucket{model="m",le="1.0"} 1' in text
+    assert 'test_latency_seconds_bucket{model="m",le="+Inf"} 1' in text
+    assert 'test_latency_seconds_count{model="m"} 1' in text
+
+    registry.export(str(tmp_path / "metrics.json"))
+    with open(tmp_path / "metrics.json") as f:
+        snapshot = json.load(f)
+    assert snapshot["metrics"]["test_calls_total"]["samples"] == [{"labels": {"model": 'a "quoted" model'}, "value": 2}]
+    assert snapshot["metrics"]["test_latency_seconds"]["samples"][0]["value"]["buckets"] == {"1.0": 1, "+Inf": 1}
+
+    registry.export(str(tmp_path / "metrics.prom"))
+    with open(tmp_path / "metrics.prom") as f:
+        assert f.read() == registry.to_prometheus()
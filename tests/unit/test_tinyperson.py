@@ -1,5 +1,6 @@
 import pytest
 import logging
+import json
 logger = logging.getLogger("tinytroupe")
 
 import sys
@@ -122,6 +123,48 @@ def test_change_context(setup):
         assert "relaxed" in agent._mental_state["context"], f"{agent.name} should have relaxed as part of the current context."
         assert "comfortable" in agent._mental_state["context"], f"{agent.name} should have comfortable as part of the current context."
 
+def test_shared_episodes(setup):
+    from tinytroupe.agent import TinyPerson
+    import tinytroupe.utils as utils
+
+    agents = [TinyPerson(f"Listener {i}") for i in range(3)]
+    for agent in agents:
+        agent.listen("The meeting starts now.", source=None)
+
+    # equal episodes are stored only once, and shared among all agents
+    episodes = [agent.episodic_memory.retrieve_all()[-1] for agent in agents]
+    assert all(episode is episodes[0] for episode in episodes)
+    with pytest.raises(TypeError):
+        episodes[0]["content"] = "Something else"
+
+    # sharing survives encoding and decoding
+    agents[0].decode_complete_state(agents[0].encode_complete_state())
+    assert agents[0].episodic_memory.retrieve_all()[-1] is episodes[1]
+
+    # writing requires a copy, which does not affect the shared episode
+    truncated = utils.truncate_actions_or_stimuli([episodes[0]], max_content_length=5)
+    assert truncated[0]["content"]["stimuli"][0]["content"] != "The meeting starts now."
+    assert episodes[0]["content"]["stimuli"][0]["content"] == "The meeting starts now."
+
+def test_decode_legacy_state(setup):
+    from tinytroupe.agent import TinyPerson
+
+    agent, friend, colleague = TinyPerson("Legacy Agent"), TinyPerson("Legacy Friend"), TinyPerson("Legacy Colleague")
+    agent.make_agent_accessible(friend, relation_description="My friend")
+
+    # states cached by older versions list the accessible agents, and have no everyone_accessible entry
+    state = agent.encode_complete_state()
+    state["_mental_state"]["accessible_agents"] = [{"name": "Legacy Friend", "relation_description": "My friend"}]
+    del state["_mental_state"]["everyone_accessible"]
+
+    agent.decode_complete_state(state)
+    assert agent.accessible_agents() == [friend]
+    assert agent._accessible_agents_for_prompt()[0] == [{"name": "Legacy Friend", "relation_description": "My friend"}]
+
+    agent.make_agent_accessible(colleague, relation_description="My colleague")
+    assert agent._mental_state["accessible_agents"] == {"Legacy Friend": "My friend", "Legacy Colleague": "My colleague"}
+    assert agent._mental_state["everyone_accessible"] is None
+
 def test_save_specification(setup):   
     for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
         # save to a file
@@ -144,3 +187,183 @@ def test_programmatic_definitions(setup):
         agent.listen_and_act("Tell me a bit about your life.")
     
     
+
+def test_stimuli_coalescing(setup):
+    from tinytroupe.agent import TinyPerson, EpisodicMemory
+
+    agent = TinyPerson("Busy listener", episodic_memory=EpisodicMemory(coalesce_stimuli=True, max_coalesced_stimuli=3))
+    agent._produce_message = lambda: ("assistant", {"action": {"type": "DONE", "content": "", "target": ""},
+                                                    "cognitive_state": {"goals": "", "attention": "", "emotions": ""}})
+
+    for i in range(4):
+        agent.listen(f"Message {i}")
+
+    # stimuli received in a row are merged into a single episode, up to the configured maximum
+    episodes = agent.episodic_memory.retrieve_all()
+    assert len(episodes) == 2
+    assert [s["content"] for s in episodes[0]["content"]["stimuli"]] == ["Message 0", "Message 1", "Message 2"]
+    assert [s["content"] for s in episodes[1]["content"]["stimuli"]] == ["Message 3"]
+
+    # acting closes the episode, so later stimuli start a new one
+    agent.act()
+    agent.listen("Message 4")
+    episodes = agent.episodic_memory.retrieve_all()
+    assert [episode["type"] for episode in episodes] == ["stimulus", "stimulus", "action", "stimulus"]
+
+    # coalescing is opt-in, so by default each stimulus is an episode of its own
+    other = TinyPerson("Calm listener")
+    other.listen("Message A")
+    other.listen("Message B")
+    assert other.episodic_memory.count() == 2
+
+def test_memory_consolidation(setup):
+    from tinytroupe.agent import TinyPerson, MemoryConsolidator
+
+    summarized = []
+    def summarizer(episodes):
+        summarized.append(len(episodes))
+        return f"{len(episodes)} things happened."
+
+    consolidator = MemoryConsolidator(recent_window_tokens=200, batch_size=10, background=False,
+                                      push_to_semantic_memory=False, summarizer=summarizer)
+    agent = TinyPerson("Forgetful", memory_consolidator=consolidator)
+    agent._produce_message = lambda: ("assistant", {"action": {"type": "DONE", "content": "", "target": ""},
+                                                    "cognitive_state": {"goals": "", "attention": "", "emotions": ""}})
+
+    for i in range(30):
+        agent.listen(f"This is the message number {i}, which is long enough to take a few tokens.")
+        agent.act()
+
+    memory = agent.episodic_memory
+    assert memory.count() == 60 # nothing is removed from memory
+    assert summarized == [10] * (memory.consolidated_until // 10) and len(summarized) > 0
+
+    # the prompt uses the summaries instead of the consolidated episodes, and a bounded recent window
+    recent = memory.retrieve_recent()
+    assert recent[0]["type"] == "summary" and "10 things happened." in recent[0]["content"]
+    assert len(recent) == len(memory.summaries) + memory.count() - memory.consolidated_until
+    assert sum(MemoryConsolidator.estimate_tokens(episode) for episode in recent[len(memory.summaries):]) < 200 + 10 * 40
+
+def test_background_memory_consolidation(setup):
+    from tinytroupe.agent import TinyPerson, MemoryConsolidator
+    from tinytroupe import metrics
+
+    labels_seen = []
+    def summarizer(episodes):
+        labels_seen.append(metrics.current_labels().get("agent"))
+        return f"{len(episodes)} things happened."
+
+    consolidators = [MemoryConsolidator(recent_window_tokens=200, batch_size=10, background=True,
+                                        push_to_semantic_memory=False, summarizer=summarizer) for _ in range(2)]
+    agents = [TinyPerson(f"Forgetful {i}", memory_consolidator=consolidator) for i, consolidator in enumerate(consolidators)]
+    for agent in agents:
+        for i in range(30):
+            agent.listen(f"This is the message number {i}, which is long enough to take a few tokens.")
+        with metrics.labels(agent=agent.name):
+            agent.optimize_memory()
+        agent._memory_consolidator.apply_pending(agent)
+        assert len(agent.episodic_memory.summaries) > 0
+
+    # all consolidators share the same threads, and summaries are computed in the context they were requested from
+    assert MemoryConsolidator._executor is not None
+    assert set(labels_seen) == {agent.name for agent in agents}
+
+    MemoryConsolidator.shutdown()
+    assert MemoryConsolidator._executor is None
+
+def test_prompt_token_budget(setup):
+    from tinytroupe.agent import TinyPerson, PromptComposer
+
+    agent = TinyPerson("Chatty")
+    for i in range(40):
+        agent.listen(f"Message number {i}, with some extra words to make it a bit longer.")
+        agent._actions_buffer = []
+        agent.store_in_memory({'role': 'assistant', 'type': 'action', 'simulation_timestamp': None,
+                               'content': {"action": {"type": "TALK", "content": f"Reply {i}", "target": ""}}})
+
+    # without a budget, everything is included, and the breakdown tells where the tokens went
+    agent.prompt_composer = PromptComposer(token_budget=10**6)
+    agent.reset_prompt()
+    full = agent.last_prompt_breakdown
+    assert full["total"] == sum(full["sections"].values())
+    assert full["sections"]["episodes"] > 0 and full["sections"]["persona"] > 0
+    assert full["reduced"] == {}
+    n_messages = len(agent.current_messages)
+
+    # with a tight budget, the oldest episodes are dropped first, but the most recent ones are kept
+    budget = full["total"] - full["sections"]["episodes"] // 2
+    agent.prompt_composer = PromptComposer(token_budget=budget)
+    agent.reset_prompt()
+    reduced = agent.last_prompt_breakdown
+    assert reduced["total"] <= budget
+    assert list(reduced["reduced"].keys()) == ["episodes"]
+    assert len(agent.current_messages) < n_messages
+    assert agent.current_messages[-2]["content"]["action"]["content"] == "Reply 39"
+
+def test_stable_prompt_prefix(setup):
+    from tinytroupe import litellm_utils
+
+    agent = TinyPerson("Steady")
+    agent.listen("Hello, how are you?")
+    agent.reset_prompt()
+    first = agent.current_messages
+
+    # the volatile cognitive state changes, but the system message does not
+    agent._update_cognitive_state(goals="Find a new job.", attention="The job ads.", emotions="Hopeful.")
+    agent.reset_prompt()
+    second = agent.current_messages
+
+    assert json.dumps(first[0]) == json.dumps(second[0])
+    assert "Find a new job." not in second[0]["content"]
+    assert "Find a new job." in second[-1]["content"]
+    assert second[-1]["content"].endswith(TinyPerson.ACTION_INSTRUCTION)
+    assert agent.last_prompt_breakdown["stable_prefix_messages"] == len(second) - 1
+    assert agent.last_prompt_breakdown["sections"]["cognitive_state"] > 0
+
+    # the stable prefix is measured per call
+    client = litellm_utils.LiteLLMClient(cache_api_calls=False)
+    client._track_prefix_stability("Steady", first)
+    client._track_prefix_stability("Steady", second)
+    stats = client.get_prefix_stability_report()["Steady"]
+    assert stats["calls"] == 2
+    assert stats["last_stable_prefix_bytes"] >= len(json.dumps(first[:-1]))
+
+    # explicit cache hints are only added for providers that need them
+    hinted = client._add_cache_control_hints(second, "anthropic/claude-3-5-sonnet-20240620", len(second) - 1)
+    assert hinted[0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+    assert hinted[-1] is second[-1]
+    assert client._add_cache_control_hints(second, "gpt-4o-mini", len(second) - 1) is second
+
+def test_action_output_repair(setup, monkeypatch):
+    from tinytroupe import litellm_utils
+
+    valid = {"action": {"type": "DONE", "content": "", "target": ""},
+             "cognitive_state": {"goals": "Rest.", "attention": "Nothing.", "emotions": "Calm."}}
+    requests = []
+
+    def send_message(current_messages, **kwargs):
+        requests.append(current_messages)
+        if len(requests) == 1:
+            # the cognitive state is missing
+            return {"role": "assistant", "content": json.dumps({"action": valid["action"]})}
+        return {"role": "assistant", "content": json.dumps(valid)}
+
+    client = litellm_utils.LiteLLMClient(cache_api_calls=False)
+    monkeypatch.setattr(client, "send_message", send_message)
+    monkeypatch.setattr(litellm_utils, "client", lambda: client)
+
+    agent = TinyPerson("Fixable")
+    agent.listen("Are you ok?")
+    agent.act()
+
+    assert agent._mental_state["goals"] == "Rest."
+
+    # the repair request is short, with just the invalid output and the schema, not the whole prompt
+    assert len(requests) == 2
+    assert len(requests[1]) == 2 and "cognitive_state" in requests[1][1]["content"]
+    assert len(json.dumps(requests[1])) < len(json.dumps(requests[0])) / 4
+
+    report = client.get_structured_output_report()[litellm_utils.default["model"]]
+    assert report["calls"] == 1 and report["repaired"] == 1 and report["repair_requests"] == 1
+    assert report["retry_rate"] == 1.0
+    assert report["wasted_tokens"] > 0
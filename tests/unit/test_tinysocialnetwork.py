@@ -0,0 +1,111 @@
+import pytest
+import logging
+logger = logging.getLogger("tinytroupe")
+
+import sys
+sys.path.append('../../tinytroupe/')
+sys.path.append('../../')
+sys.path.append('..')
+
+from tinytroupe.agent import TinyPerson
+from tinytroupe.environment import TinySocialNetwork
+from testing_utils import *
+
+def test_relations(setup):
+    alice, bob, carol = TinyPerson("Alice"), TinyPerson("Bob"), TinyPerson("Carol")
+
+    network = TinySocialNetwork("Social network")
+    network.add_relation(alice, bob, name="friends")
+    network.add_relation(bob, carol, name="colleagues")
+
+    assert set(network.agents) == {alice, bob, carol}
+
+    # relations are undirected
+    assert network.is_in_relation_with(alice, bob)
+    assert network.is_in_relation_with(bob, alice, relation_name="friends")
+    assert not network.is_in_relation_with(bob, alice, relation_name="colleagues")
+    assert not network.is_in_relation_with(alice, carol)
+    assert not network.is_in_relation_with(alice, None)
+
+    assert network.neighbors_of(bob) == {"Alice", "Carol"}
+    assert network.neighbors_of(bob, relation_name="friends") == {"Alice"}
+
+def test_accessibility_updates(setup):
+    alice, bob, carol = TinyPerson("Alice"), TinyPerson("Bob"), TinyPerson("Carol")
+
+    network = TinySocialNetwork("Social network")
+    network.add_relation(alice, bob)
+    network._update_agents_contexts()
+
+    assert alice.accessible_agents() == [bob]
+    assert bob.accessible_agents() == [alice]
+    assert carol.accessible_agents() == []
+
+    # only the new relation is applied, existing ones are not touched again
+    network.add_relation(alice, carol)
+    network._update_agents_contexts()
+
+    assert set(alice.accessible_agents()) == {bob, carol}
+    assert list(alice._mental_state["accessible_agents"]) == ["Bob", "Carol"]
+    assert carol.accessible_agents() == [alice]
+
+    # removed relations are also reflected
+    network.remove_relation(bob, alice)
+    network._update_agents_contexts()
+    assert alice.accessible_agents() == [carol]
+    assert list(alice._mental_state["accessible_agents"]) == ["Carol"]
+    assert bob.accessible_agents() == []
+    
+    network.add_relation(alice, bob)
+    network._update_agents_contexts()
+
+    # the state can be encoded and decoded, keeping the relations
+    state = network.encode_complete_state()
+    assert state["relations"] == {"default": [("Alice", "Carol"), ("Alice", "Bob")]}
+
+    network.decode_complete_state(state)
+    assert network.relations["default"] == [(alice, carol), (alice, bob)]
+    assert network.is_in_relation_with(carol, alice)
+
+def test_accessibility_when_agents_join_and_leave(setup):
+    alice, bob, carol = TinyPerson("Alice"), TinyPerson("Bob"), TinyPerson("Carol")
+
+    network = TinySocialNetwork("Social network")
+    network.add_relation(alice, bob)
+    network._update_agents_contexts()
+
+    # agents leaving the network are no longer accessible to anyone
+    network.remove_agent(bob)
+    network._update_agents_contexts()
+    assert alice.accessible_agents() == []
+
+    # newcomers start from a clean slate
+    carol.make_agent_accessible(bob)
+    network.add_agent(carol)
+    network.add_relation(alice, carol)
+    network._update_agents_contexts()
+    assert carol.accessible_agents() == [alice]
+    assert alice.accessible_agents() == [carol]
+
+def test_accessibility_changed_outside_the_network(setup):
+    alice, bob, carol = TinyPerson("Alice"), TinyPerson("Bob"), TinyPerson("Carol")
+
+    network = TinySocialNetwork("Social network")
+    network.add_relation(alice, bob)
+    network.add_agent(carol)
+    network._update_agents_contexts()
+
+    # whatever is changed from outside, the relations are restored at the next update
+    alice.make_all_agents_inaccessible()
+    bob.make_agent_accessible(carol)
+    network.make_everyone_accessible()
+    network._update_agents_contexts()
+    assert alice.accessible_agents() == [bob]
+    assert bob.accessible_agents() == [alice]
+    assert carol.accessible_agents() == []
+    assert bob._mental_state["everyone_accessible"] is None
+
+    # encoding the state leaves the network itself unchanged
+    network.encode_complete_state()
+    assert network.relations["default"] == [(alice, bob)]
+    assert network._adjacency["default"]["Alice"] == {"Bob"}
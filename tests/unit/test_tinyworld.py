@@ -1,4 +1,5 @@
 import pytest
+import json
 import logging
 logger = logging.getLogger("tinytroupe")
 
@@ -76,3 +77,203 @@ def test_decode_complete_state(setup, focus_group_world):
     assert len(world_2.agents) == n_agents_1, "The world should have the same number of agents."
 
 
+
+def test_event_driven_scheduling(setup):
+    from tinytroupe.agent import TinyPerson
+
+    turns = []
+
+    def scripted_agent(name, script):
+        agent = TinyPerson(name)
+
+        # scripted actions instead of LLM calls
+        actions = list(script)
+        def produce_message():
+            turns.append(name)
+            action = actions.pop(0) if len(actions) > 0 else {"type": "DONE", "content": "", "target": ""}
+            return "assistant", {"action": action, 
+                                 "cognitive_state": {"goals": "", "attention": "", "emotions": ""}}
+        agent._produce_message = produce_message
+        return agent
+
+    alice = scripted_agent("Alice", [{"type": "TALK", "content": "Hi Bob!", "target": "Bob"}, 
+                                     {"type": "DONE", "content": "", "target": ""}])
+    bob = scripted_agent("Bob", [])
+    carol = scripted_agent("Carol", [])
+
+    world = TinyWorld("Event-driven land", [alice, bob, carol], scheduling=TinyWorld.SCHEDULING_EVENT_DRIVEN)
+    alice.listen("Please greet Bob.")
+
+    # Alice has something to react to, and Bob reacts to her within the same step. Carol stays idle.
+    world.run(1)
+    assert turns == ["Alice", "Alice", "Bob"]
+
+    # nothing happened since, so nobody acts
+    turns.clear()
+    world.run(2)
+    assert turns == []
+
+    # agents can ask for a turn
+    carol.request_turn()
+    world.run(1)
+    assert turns == ["Carol"]
+
+    # idle agents can be woken up periodically
+    turns.clear()
+    world.set_idle_wakeup_interval(bob, 2)
+    world.run(4)
+    assert turns == ["Bob", "Bob"]
+
+    # by default, everyone acts at every step
+    turns.clear()
+    world.scheduling = TinyWorld.SCHEDULING_ALL
+    world.run(1)
+    assert turns == ["Alice", "Bob", "Carol"]
+
+def test_make_everyone_accessible(setup):
+    from tinytroupe.agent import TinyPerson
+
+    agents = [TinyPerson(f"Person {i}") for i in range(30)]
+    world = TinyWorld("Crowded land", agents)
+    world.make_everyone_accessible()
+
+    first = agents[0]
+    # a single group, rather than one relation per agent
+    assert first._mental_state["accessible_agents"] == {}
+    assert len(first.accessible_agents()) == 29
+    assert first.is_agent_accessible(agents[29])
+    assert not first.is_agent_accessible(first)
+
+    # agents that join later are also accessible
+    newcomer = TinyPerson("Newcomer")
+    world.add_agent(newcomer)
+    assert first.is_agent_accessible(newcomer)
+
+    # the prompt lists a bounded number of agents, and summarizes the rest
+    listed, summary = first._accessible_agents_for_prompt()
+    assert len(listed) == TinyPerson.MAX_ACCESSIBLE_AGENTS_IN_PROMPT
+    assert len(summary) == 1 and "(10 more agents)" in summary[0]
+
+    prompt = first.generate_agent_cognitive_state_prompt()
+    assert "Person 1:" in prompt
+    assert "Everyone else in Crowded land (10 more agents)" in prompt
+    assert "Newcomer:" not in prompt
+
+def test_channels(setup):
+    from tinytroupe.agent import TinyPerson
+
+    agents = [TinyPerson(f"Resident {i}") for i in range(5)]
+    world = TinyWorld("Town hall", agents)
+    speaker, listeners, outsider = agents[0], agents[1:4], agents[4]
+
+    for agent in [speaker] + listeners:
+        world.subscribe(agent, "townhall")
+    assert world.subscribers_of("townhall") == [speaker] + listeners
+
+    # channels can be addressed by name, like agents
+    world._handle_talk(speaker, "The budget was approved.", "townhall")
+
+    # a single episode is shared by all recipients, and the source is excluded
+    episodes = [agent.episodic_memory.retrieve_all()[-1] for agent in listeners]
+    assert all(episode is episodes[0] for episode in episodes)
+    assert episodes[0]["content"]["stimuli"][0]["content"] == "The budget was approved."
+    assert all(agent.has_unprocessed_stimuli() for agent in listeners)
+    assert not speaker.has_unprocessed_stimuli()
+    assert not outsider.has_unprocessed_stimuli()
+
+    # the delivery is displayed only once
+    assert world._displayed_communications_buffer[-1]["target"] == "townhall"
+
+    world.unsubscribe(listeners[0], "townhall")
+    world.remove_agent(listeners[1])
+    assert world.subscribers_of("townhall") == [speaker, listeners[2]]
+
+    with pytest.raises(ValueError):
+        world.subscribe(outsider, "Resident 1")
+
+def test_streamed_actions_dispatched_early(setup, monkeypatch):
+    from tinytroupe.agent import TinyPerson
+    from tinytroupe import litellm_utils
+
+    alice, bob = TinyPerson("Alice"), TinyPerson("Bob")
+    world = TinyWorld("Chat room", [alice, bob])
+    alice.make_agent_accessible(bob)
+
+    def heard_by_bob():
+        return [stimulus["content"] for episode in bob.episodic_memory.retrieve_all() if episode["type"] == "stimulus"
+                for stimulus in episode["content"]["stimuli"]].count("Hi Bob!")
+
+    heard_before_completion = []
+    calls = {"Alice": 0, "Bob": 0}
+
+    def send_message(current_messages, prefix_key=None, stream=False, stream_callback=None, **kwargs):
+        calls[prefix_key] += 1
+        action = {"type": "TALK", "content": "Hi Bob!", "target": "Bob"} if prefix_key == "Alice" and calls["Alice"] == 1 \
+                 else {"type": "DONE", "content": "", "target": ""}
+        text = json.dumps({"action": action, "cognitive_state": {"goals": "Chat.", "attention": "Bob.", "emotions": "Happy."}})
+
+        assert stream
+        cut = text.index('"cognitive_state"')
+        stream_callback(text[:cut])
+        heard_before_completion.append(heard_by_bob())
+        stream_callback(text[cut:])
+
+        return {"role": "assistant", "content": text}
+
+    client = litellm_utils.LiteLLMClient(cache_api_calls=False)
+    monkeypatch.setattr(client, "send_message", send_message)
+    monkeypatch.setattr(litellm_utils, "client", lambda: client)
+    monkeypatch.setitem(litellm_utils.default, "stream", True)
+
+    world.scheduling = TinyWorld.SCHEDULING_ALL
+    world._step()
+
+    # Bob heard Alice before her response was complete, and only once
+    assert heard_before_completion[0] == 1
+    assert heard_by_bob() == 1
+    assert alice._early_dispatched_actions == []
+
+def test_streamed_action_differing_from_final_one(setup, monkeypatch):
+    from tinytroupe.agent import TinyPerson
+    from tinytroupe import litellm_utils
+
+    alice, bob = TinyPerson("Alice"), TinyPerson("Bob")
+    world = TinyWorld("Chat room", [alice, bob])
+    alice.make_agent_accessible(bob)
+
+    def heard_by_bob():
+        return [stimulus["content"] for episode in bob.episodic_memory.retrieve_all() if episode["type"] == "stimulus"
+                for stimulus in episode["content"]["stimuli"]]
+
+    calls = {"Alice": 0, "Bob": 0}
+    cognitive_state = {"goals": "Chat.", "attention": "Bob.", "emotions": "Happy."}
+
+    def send_message(current_messages, prefix_key=None, stream=False, stream_callback=None, **kwargs):
+        calls[prefix_key] += 1
+        if prefix_key == "Alice" and calls["Alice"] == 1:
+            # the streamed action is then changed in the final response (e.g., by a repair)
+            streamed = json.dumps({"action": {"type": "TALK", "content": "Hi Bob!", "target": "Bob"}, "cognitive_state": cognitive_state})
+            stream_callback(streamed[:streamed.index('"cognitive_state"')])
+            return {"role": "assistant", 
+                    "content": json.dumps({"action": {"type": "TALK", "content": "Hello Bob!", "target": "Bob"}, "cognitive_state": cognitive_state})}
+
+        text = json.dumps({"action": {"type": "DONE", "content": "", "target": ""}, "cognitive_state": cognitive_state})
+        stream_callback(text)
+        return {"role": "assistant", "content": text}
+
+    client = litellm_utils.LiteLLMClient(cache_api_calls=False)
+    monkeypatch.setattr(client, "send_message", send_message)
+    monkeypatch.setattr(litellm_utils, "client", lambda: client)
+    monkeypatch.setitem(litellm_utils.default, "stream", True)
+
+    world.scheduling = TinyWorld.SCHEDULING_ALL
+    world._step()
+
+    # Bob got only the dispatched action, and that is also what Alice remembers doing
+    assert heard_by_bob().count("Hi Bob!") == 1
+    assert "Hello Bob!" not in heard_by_bob()
+    alice_actions = [episode["content"]["action"]["content"] for episode in alice.episodic_memory.retrieve_all() 
+                     if episode["role"] == "assistant"]
+    assert "Hi Bob!" in alice_actions
+    assert "Hello Bob!" not in alice_actions
+    assert alice._early_dispatched_actions == []
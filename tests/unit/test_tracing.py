@@ -0,0 +1,96 @@
+import pytest
+import logging
+logger = logging.getLogger("tinytroupe")
+
+import sys
+sys.path.append('../../tinytroupe/')
+sys.path.append('../../')
+sys.path.append('..')
+
+import json
+
+import litellm
+
+import tinytroupe.control as control
+import tinytroupe.tracing as tracing
+from tinytroupe.agent import TinyPerson
+from tinytroupe.environment import TinyWorld
+from testing_utils import *
+
+
+def _scripted_agents(monkeypatch):
+    mock_completion = litellm.completion
+    output = json.dumps({"action": {"type": "DONE", "content": "", "target": ""},
+                         "cognitive_state": {"goals": "None.", "attention": "None.", "emotions": "Calm."}})
+
+    monkeypatch.setattr(litellm, "completion", 
+                        lambda **params: mock_completion(model="gpt-4o-mini", messages=params["messages"], mock_response=output))
+
+
+def test_spans_are_nested(setup, monkeypatch, tmp_path):
+    _scripted_agents(monkeypatch)
+    exporter = tracing.InMemoryExporter()
+    tracing.enable(exporter)
+    try:
+        control.begin(str(tmp_path / "tracing.cache.json"))
+        world = TinyWorld("Traced world", [TinyPerson("Traced agent")])
+        world._step()
+        control.checkpoint()
+        control.end()
+    finally:
+        tracing.disable()
+
+    spans = {span.span_id: span for span in exporter.spans}
+    def ancestors(span):
+        names = []
+        while span.parent_span_id is not None:
+            span = spans[span.parent_span_id]
+            names.append(span.name)
+        return names
+
+    [request] = [span for span in exporter.spans if span.name == "llm.request"]
+    assert ancestors(request) == ["LiteLLMClient.send_message", "TinyPerson._produce_message", "TinyPerson.act", "TinyWorld._step"]
+    assert len({span.trace_id for span in exporter.spans if span.name == "llm.request" or span.name == "TinyWorld._step"}) == 1
+
+    [send_message] = [span for span in exporter.spans if span.name == "LiteLLMClient.send_message"]
+    assert send_message.attributes["call_site"] == "agent.act" and send_message.attributes["model"] is not None
+    assert [span for span in exporter.spans if span.name == "TinyPerson.act"][0].attributes == {"agent": "Traced agent"}
+
+    names = {span.name for span in exporter.spans}
+    assert {"Transaction.encode_state", "checkpoint.write"} <= names
+    assert all(span.duration_ns >= 0 for span in exporter.spans)
+
+
+def test_span_exporters(tmp_path):
+    jsonl_file_name = str(tmp_path / "trace.jsonl")
+    tracing.enable(tracing.exporter_for(jsonl_file_name))
+    try:
+        with tracing.span("outer", agent="Oscar"):
+            with pytest.raises(ValueError):
+                with tracing.span("inner", tokens=10):
+                    raise ValueError("Oops")
+    finally:
+        tracing.disable()
+
+    with open(jsonl_file_name) as f:
+        inner, outer = [json.loads(line) for line in f]
+    assert inner["parentSpanId"] == outer["spanId"] and inner["traceId"] == outer["traceId"]
+    assert inner["attributes"] == [{"key": "tokens", "value": {"intValue": "10"}}]
+    assert inner["status"]["code"] == "STATUS_CODE_ERROR" and outer["status"]["code"] == "STATUS_CODE_OK"
+
+    chrome_file_name = str(tmp_path / "trace.json")
+    tracing.enable(tracing.exporter_for(chrome_file_name))
+    try:
+        with tracing.span("outer", agent="Oscar"):
+            pass
+    finally:
+        tracing.disable()
+
+    with open(chrome_file_name) as f:
+        [event] = json.load(f)["traceEvents"]
+    assert event["name"] == "outer" and event["ph"] == "X" and event["args"] == {"agent": "Oscar"}
+
+    # disabled, spans do nothing
+    with tracing.span("ignored") as span:
+        span.set_attribute("key", "value")
+    assert not tracing.is_enabled()
@@ -1,4 +1,6 @@
 import pytest
+import json
+import copy
 from unittest.mock import MagicMock
 
 import sys
@@ -7,7 +9,7 @@ sys.path.append('../../')
 sys.path.append('..')
 
 
-from tinytroupe.utils import name_or_empty, extract_json, repeat_on_error
+from tinytroupe.utils import name_or_empty, extract_json, JSONExtractor, JSONExtractionError, repeat_on_error, freeze, thaw
 from testing_utils import *
 from tinytroupe.utils.llm import llm
 
@@ -37,6 +39,34 @@ def test_extract_json():
     result = extract_json(text)
     assert result == {}
 
+    # Test with braces inside strings and trailing text with more braces
+    text = 'Here it is: ```json\n{"key": "a } tricky \\" value {", "list": [1, 2]}\n``` and {not json}'
+    result = extract_json(text)
+    assert result == {"key": 'a } tricky " value {', "list": [1, 2]}
+
+    # Errors can also be raised explicitly
+    with pytest.raises(JSONExtractionError):
+        extract_json('Some text before {"key": "value",} some text after', strict=True)
+    with pytest.raises(JSONExtractionError):
+        extract_json('{"key": "never closed"', strict=True)
+
+def test_json_extractor_incremental():
+    text = 'Sure! {"action": {"type": "TALK", "content": "Hi, {there}!", "target": "Bob"}, ' +\
+           '"cognitive_state": {"goals": "Chat.", "attention": "Bob.", "emotions": "Happy."}} Hope it helps.'
+
+    extractor = JSONExtractor()
+    action_complete_at = None
+    for i in range(0, len(text), 7):
+        extractor.feed(text[i:i+7])
+        if action_complete_at is None and "action" in extractor.completed_fields:
+            action_complete_at = i
+
+    # the action is available well before the whole object is complete
+    assert extractor.completed_fields["action"] == {"type": "TALK", "content": "Hi, {there}!", "target": "Bob"}
+    assert action_complete_at < text.index('"cognitive_state"')
+    assert extractor.is_complete()
+    assert extractor.result() == json.loads(text[text.index("{"):text.rindex("}") + 1])
+
 
 def test_name_or_empty():
     class MockEntity:
@@ -52,6 +82,29 @@ def test_name_or_empty():
     result = name_or_empty(None)
     assert result == ""
 
+def test_freeze_and_thaw():
+    original = {"role": "user", "content": {"stimuli": [{"type": "CONVERSATION", "content": "Hi"}]}}
+    frozen = freeze(original)
+
+    assert frozen == {"role": "user", "content": {"stimuli": ({"type": "CONVERSATION", "content": "Hi"},)}}
+    assert json.dumps(frozen) == json.dumps(original)
+    assert hash(frozen) == hash(freeze(original))
+
+    with pytest.raises(TypeError):
+        frozen["role"] = "assistant"
+    with pytest.raises(TypeError):
+        frozen["content"]["stimuli"][0]["content"] = "Bye"
+
+    # frozen objects are shared, rather than copied
+    assert freeze(frozen) is frozen
+    assert copy.deepcopy(frozen) is frozen
+
+    # thawing makes a mutable copy
+    thawed = thaw(frozen)
+    thawed["content"]["stimuli"][0]["content"] = "Bye"
+    assert frozen["content"]["stimuli"][0]["content"] == "Hi"
+    assert thawed["content"] == {"stimuli": [{"type": "CONVERSATION", "content": "Bye"}]}
+
 
 def test_repeat_on_error():
     class DummyException(Exception):
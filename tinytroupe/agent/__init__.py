@@ -51,10 +51,11 @@ class CognitiveActionModel(BaseModel):
 # Exposed API
 ###########################################################################
 # from. grounding ... ---> not exposing this, clients should not need to know about detailed grounding mechanisms
-from .memory import SemanticMemory, EpisodicMemory
+from .memory import SemanticMemory, EpisodicMemory, MemoryConsolidator
 from .mental_faculty import CustomMentalFaculty, RecallFaculty, FilesAndWebGroundingFaculty, TinyToolUse
+from .prompt_composer import PromptComposer
 from .tiny_person import TinyPerson
 
-__all__ = ["SemanticMemory", "EpisodicMemory", 
+__all__ = ["SemanticMemory", "EpisodicMemory", "MemoryConsolidator",
            "CustomMentalFaculty", "RecallFaculty", "FilesAndWebGroundingFaculty", "TinyToolUse",
-           "TinyPerson"]
\ No newline at end of file
+           "PromptComposer", "TinyPerson"]
\ No newline at end of file
@@ -1,10 +1,18 @@
 from tinytroupe.agent.mental_faculty import TinyMentalFaculty
 from tinytroupe.agent.grounding import BaseSemanticGroundingConnector
 import tinytroupe.utils as utils
+import tinytroupe.tracing as tracing
 
 from llama_index.core import Document
-from typing import Any
+from typing import Any, Callable
 import copy
+import contextvars
+import json
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from tinytroupe.agent import logger
 
 #######################################################################################################################
 # Memory mechanisms 
@@ -75,19 +83,57 @@ class TinyMemory(TinyMentalFaculty):
         raise NotImplementedError("Subclasses must implement this method.")
 
 
+# Episodes stored in episodic memories are immutable and interned, so that equal episodes (e.g., the same broadcast 
+# stimulus received by many agents, or copies produced by decoding a simulation state) are kept only once.
+_interned_episodes = weakref.WeakValueDictionary() # episode -> episode
+_interned_episodes_lock = threading.Lock()
+
+def intern_episode(episode: dict) -> utils.FrozenDict:
+    """
+    Returns the immutable, shared, version of the specified episode.
+    """
+    episode = utils.freeze(episode)
+    try:
+        with _interned_episodes_lock:
+            return _interned_episodes.setdefault(episode, episode)
+    except TypeError:
+        # some content cannot be hashed (e.g., custom objects), so this episode is just not shared
+        return episode
+
+def _intern_episodes(episodes: list) -> list:
+    return [intern_episode(episode) for episode in episodes]
+
+
 class EpisodicMemory(TinyMemory):
     """
     Provides episodic memory capabilities to an agent. Cognitively, episodic memory is the ability to remember specific events,
     or episodes, in the past. This class provides a simple implementation of episodic memory, where the agent can store and retrieve
     messages from memory.
+
+    Stored episodes are immutable (see intern_episode()), so they can be shared among agents and state snapshots without copying. 
+    To change an episode, make a mutable copy with utils.thaw().
     
     Subclasses of this class can be used to provide different memory implementations.
     """
 
-    MEMORY_BLOCK_OMISSION_INFO = {'role': 'assistant', 'content': "Info: there were other messages here, but they were omitted for brevity.", 'simulation_timestamp': None}
+    MEMORY_BLOCK_OMISSION_INFO = utils.freeze({'role': 'assistant', 'content': "Info: there were other messages here, but they were omitted for brevity.", 'simulation_timestamp': None})
+
+    # episodes are interned again when loaded, since each agent's serialized memory has its own copies
+    custom_serialization_initializers = {"memory": _intern_episodes}
+
+    # How many of the most recent summaries of consolidated episodes are included in the prompt. Older ones 
+    # are still kept, and can also be found in semantic memory (see MemoryConsolidator).
+    MAX_SUMMARIES_IN_PROMPT = 5
+
+    # Defaults for memories decoded from states saved before these options existed.
+    coalesce_stimuli = False
+    max_coalesced_stimuli = None
+    consolidated_until = 0 # episodes before this index are represented by summaries when prompting
+    summaries = ()
 
     def __init__(
-        self, fixed_prefix_length: int = 100, lookback_length: int = 100
+        self, fixed_prefix_length: int = 100, lookback_length: int = 100,
+        coalesce_stimuli: bool = False, max_coalesced_stimuli: int = 20
     ) -> None:
         """
         Initializes the memory.
@@ -95,17 +141,55 @@ class EpisodicMemory(TinyMemory):
         Args:
             fixed_prefix_length (int): The fixed prefix length. Defaults to 20.
             lookback_length (int): The lookback length. Defaults to 20.
+            coalesce_stimuli (bool): Whether stimuli received in a row (i.e., between two actions) are merged into a single 
+              episode, rather than stored as one episode each. This keeps the prompt shorter, without losing any stimulus, 
+              but merged episodes belong to a single agent, so they are no longer shared with the other agents that received 
+              the same stimuli (see intern_episode()). Defaults to False.
+            max_coalesced_stimuli (int, optional): The maximum number of stimuli in a single episode. When reached, a new episode 
+              is started. If None, there is no limit. Defaults to 20.
         """
         self.fixed_prefix_length = fixed_prefix_length
         self.lookback_length = lookback_length
+        self.coalesce_stimuli = coalesce_stimuli
+        self.max_coalesced_stimuli = max_coalesced_stimuli
 
         self.memory = []
 
+    def _preprocess_value_for_storage(self, value: Any) -> Any:
+        return intern_episode(value)
+
     def _store(self, value: Any) -> None:
         """
         Stores a value in memory.
         """
-        self.memory.append(value)
+        if self._can_coalesce_with_last(value):
+            # The merged episode is specific to this agent, so it is not worth interning (which would hash all of
+            # its stimuli again at each merge). Its parts are frozen already, so it is frozen without copying them.
+            last = self.memory[-1]
+            stimuli = tuple(last["content"]["stimuli"]) + tuple(value["content"]["stimuli"])
+            self.memory[-1] = utils.FrozenDict({**last, "content": utils.FrozenDict({**last["content"], "stimuli": stimuli})})
+        else:
+            self.memory.append(value)
+
+    def _can_coalesce_with_last(self, value: Any) -> bool:
+        """
+        Checks whether the value can be merged into the last episode. That is the case for stimuli that follow other stimuli
+        with the same timestamp, as long as the episode does not become too large. Anything else (e.g., an action) starts a
+        new episode.
+        """
+        if not self.coalesce_stimuli or len(self.memory) == 0:
+            return False
+
+        last = self.memory[-1]
+        if not (isinstance(value, dict) and value.get("type") == "stimulus" and last.get("type") == "stimulus"):
+            return False
+        if last.get("role") != value.get("role") or last.get("simulation_timestamp") != value.get("simulation_timestamp"):
+            return False
+        if not all(isinstance(episode.get("content"), dict) and "stimuli" in episode["content"] for episode in (last, value)):
+            return False
+
+        n_stimuli = len(last["content"]["stimuli"]) + len(value["content"]["stimuli"])
+        return self.max_coalesced_stimuli is None or n_stimuli <= self.max_coalesced_stimuli
 
     def count(self) -> int:
         """
@@ -141,10 +225,23 @@ class EpisodicMemory(TinyMemory):
 
     def retrieve_recent(self, include_omission_info:bool=True) -> list:
         """
-        Retrieves the n most recent values from memory.
+        Retrieves the n most recent values from memory. If some episodes were consolidated, their summaries
+        are retrieved instead of them.
         """
         omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
 
+        if self.consolidated_until > 0:
+            summaries = list(self.summaries[-EpisodicMemory.MAX_SUMMARIES_IN_PROMPT:])
+            recent = self.memory[self.consolidated_until:]
+            if len(recent) > self.lookback_length:
+                return summaries + omisssion_info + recent[-self.lookback_length:]
+            else:
+                return summaries + recent
+
+        # nothing to omit
+        if len(self.memory) <= self.fixed_prefix_length + self.lookback_length:
+            return list(self.memory)
+
         # compute fixed prefix
         fixed_prefix = self.memory[: self.fixed_prefix_length] + omisssion_info
 
@@ -159,6 +256,28 @@ class EpisodicMemory(TinyMemory):
         else:
             return fixed_prefix + self.memory[-remaining_lookback:]
 
+    def add_summary(self, summary:str, until:int) -> None:
+        """
+        Adds a summary of the episodes from the last consolidated one up to (but excluding) the specified index.
+        From then on, these episodes are represented by the summary when retrieving recent memories, though 
+        they remain in memory.
+
+        Args:
+            summary (str): The summary of the episodes.
+            until (int): The index of the first episode not covered by the summary.
+        """
+        if until <= self.consolidated_until or until > len(self.memory):
+            raise ValueError(f"Invalid consolidation range: episodes {self.consolidated_until} to {until}, out of {len(self.memory)}.")
+
+        covered = self.memory[self.consolidated_until:until]
+        episode = utils.freeze({'role': 'assistant', 
+                                'content': f"Info: summary of earlier interactions, from {covered[0].get('simulation_timestamp')} to {covered[-1].get('simulation_timestamp')}: {summary}",
+                                'type': 'summary',
+                                'simulation_timestamp': covered[-1].get('simulation_timestamp')})
+
+        self.summaries = list(self.summaries) + [episode]
+        self.consolidated_until = until
+
     def retrieve_all(self) -> list:
         """
         Retrieves all values from memory.
@@ -229,13 +348,20 @@ class SemanticMemory(TinyMemory):
                      f"I have received the following stimulus at date and time {value['simulation_timestamp']}:\n\n"+\
                      f" {value['content']}"
 
+        elif value['type'] == 'summary':
+            engram = f"# Summary\n" +\
+                     f"This is a summary of what I have experienced until date and time {value['simulation_timestamp']}:\n\n"+\
+                     f" {value['content']}"
+
         # else: # Anything else here?
 
         return engram
 
+    @tracing.traced("SemanticMemory.store")
     def _store(self, value: Any) -> None:
-        engram_doc = self._build_document_from(self._preprocess_value_for_storage(value))
-        self.semantic_grounding_connector.add_document(engram_doc)
+        # the value was already preprocessed into an engram
+        self.memories.append(value)
+        self.semantic_grounding_connector.add_document(self._build_document_from(value))
     
     def retrieve_relevant(self, relevance_target:str, top_k=20) -> list:
         """
@@ -247,11 +373,170 @@ class SemanticMemory(TinyMemory):
     # Auxiliary compatibility methods
     #####################################
 
-    def _build_document_from(memory) -> Document:
+    def _build_document_from(self, memory) -> Document:
         # TODO: add any metadata as well?
         return Document(text=str(memory))
     
     def _build_documents_from(self, memories: list) -> list:
         return [self._build_document_from(memory) for memory in memories]
     
-   
\ No newline at end of file
+   
+
+#######################################################################################################################
+# Memory consolidation
+#######################################################################################################################
+
+class MemoryConsolidator:
+    """
+    Consolidates the episodic memory of an agent, so that the prompt does not keep growing as the simulation advances. 
+    Only a recent window of episodes, bounded by a number of tokens, is kept as is. Older episodes are summarized in batches 
+    (typically with a cheaper model than the one used for acting), and these summaries are then used in the prompt instead 
+    of the episodes themselves. Summaries are also stored in the agent's semantic memory, so that the consolidated facts 
+    can still be retrieved when relevant.
+
+    Summarization can run in the background, overlapping with the other agents' turns. In that case, the summaries are 
+    only applied at the next consolidation of the agent, so that the simulation remains deterministic. All consolidators
+    share the same pool of background threads, which can be stopped with MemoryConsolidator.shutdown().
+    """
+
+    # How many summaries can be computed in the background at the same time, across all agents.
+    MAX_BACKGROUND_WORKERS = 4
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, recent_window_tokens:int=2000, batch_size:int=20, model:str=None,
+                 push_to_semantic_memory:bool=True, background:bool=True, summarizer:Callable=None):
+        """
+        Initializes the consolidator.
+
+        Args:
+            recent_window_tokens (int): The approximate number of tokens of the most recent episodes, which are never consolidated.
+            batch_size (int): How many episodes are summarized together.
+            model (str, optional): The model used for summarization. Defaults to None (i.e., the default model).
+            push_to_semantic_memory (bool): Whether summaries are also stored in semantic memory.
+            background (bool): Whether to summarize in a background thread.
+            summarizer (Callable, optional): A function that takes a list of episodes and returns their summary. 
+              Defaults to an LLM-based summarization.
+        """
+        self.recent_window_tokens = recent_window_tokens
+        self.batch_size = batch_size
+        self.model = model
+        self.push_to_semantic_memory = push_to_semantic_memory
+        self.background = background
+        self.summarizer = summarizer if summarizer is not None else self._summarize_with_llm
+
+        self._pending = [] # [(future, until), ...], in memory order
+
+    def consolidate(self, agent) -> None:
+        """
+        Applies the summaries computed so far to the agent's memory, and starts summarizing the episodes that left
+        the recent window since then.
+        """
+        self.apply_pending(agent)
+
+        memory = agent.episodic_memory
+        window_start = self._recent_window_start(memory)
+
+        start = memory.consolidated_until
+        while window_start - start >= self.batch_size:
+            until = start + self.batch_size
+            batch = memory.memory[start:until]
+
+            if self.background:
+                # the summary is computed in the current context, so that it is attributed to the same simulation and agent
+                future = MemoryConsolidator._background_executor().submit(contextvars.copy_context().run, self.summarizer, batch)
+                self._pending.append((future, until))
+            else:
+                self._apply(agent, self.summarizer(batch), until)
+
+            start = until
+
+    def apply_pending(self, agent) -> None:
+        """
+        Waits for the summaries being computed in the background, and applies them to the agent's memory.
+        """
+        pending, self._pending = self._pending, []
+        for future, until in pending:
+            self._apply(agent, future.result(), until)
+
+    def discard_pending(self) -> None:
+        """
+        Discards the summaries being computed in the background (e.g., because the agent's state was replaced).
+        """
+        for future, _ in self._pending:
+            future.cancel()
+        self._pending = []
+
+    @staticmethod
+    def shutdown(wait:bool=True) -> None:
+        """
+        Stops the background threads shared by all consolidators. Summaries still pending are computed first if `wait` 
+        is True, or else cancelled. The threads are started again if needed later.
+        """
+        with MemoryConsolidator._executor_lock:
+            executor, MemoryConsolidator._executor = MemoryConsolidator._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    @staticmethod
+    def _background_executor() -> ThreadPoolExecutor:
+        with MemoryConsolidator._executor_lock:
+            if MemoryConsolidator._executor is None:
+                MemoryConsolidator._executor = ThreadPoolExecutor(max_workers=MemoryConsolidator.MAX_BACKGROUND_WORKERS,
+                                                                  thread_name_prefix="tinytroupe-memory-consolidation")
+            return MemoryConsolidator._executor
+
+    def _apply(self, agent, summary:str, until:int) -> None:
+        memory = agent.episodic_memory
+        memory.add_summary(summary, until)
+
+        if self.push_to_semantic_memory:
+            try:
+                agent.semantic_memory.store(memory.summaries[-1])
+            except Exception as e:
+                # the summary is still used in episodic memory, so this is not fatal
+                logger.warning(f"[{agent.name}] Could not store memory summary in semantic memory: {e}")
+
+    def _recent_window_start(self, memory) -> int:
+        """
+        Returns the index of the first episode of the recent window, which always includes at least the last episode.
+        """
+        tokens = 0
+        i = len(memory.memory)
+        while i > memory.consolidated_until:
+            tokens += MemoryConsolidator.estimate_tokens(memory.memory[i - 1])
+            if tokens > self.recent_window_tokens and i < len(memory.memory):
+                break
+            i -= 1
+
+        return i
+
+    @staticmethod
+    def estimate_tokens(episode) -> int:
+        """
+        Roughly estimates the number of tokens of an episode, as it is sent to the model.
+        """
+        return len(json.dumps(episode.get("content"), default=str)) // 4 + 4
+
+    def _summarize_with_llm(self, episodes:list) -> str:
+        # local import to avoid circular dependencies
+        from tinytroupe import litellm_utils
+
+        model_params = {"model": self.model} if self.model is not None else {}
+        return litellm_utils.LLMRequest(
+                    system_prompt="""
+                    You are given a sequence of interactions of an agent, in JSON format, from the agent's own point of view:
+                    stimuli it received (e.g., what others said to it, what it saw) and actions it performed (e.g., what it said, thought or did).
+                    You must then summarize them in a short paragraph, written in the first person, as the agent's own recollection.
+                    Keep all facts that might matter later, such as who said or did what, decisions, commitments, names, numbers and dates.
+                    Leave out repetitions and small talk. Do not add anything that is not in the interactions.
+                    """,
+
+                    user_prompt=f"""
+                    **Interactions:** {json.dumps([{"role": episode["role"], "content": episode["content"], "timestamp": episode.get("simulation_timestamp")} for episode in episodes], default=str)}
+                    """,
+                    call_site="agent.memory",
+                    **model_params).call()
+
@@ -0,0 +1,269 @@
+import json
+
+from tinytroupe.agent import logger
+import tinytroupe.utils as utils
+
+
+class PromptComposer:
+    """
+    Composes the prompt of an agent, that is, the system message, the recent episodes and the final instruction,
+    within a token budget. Each piece of the prompt is counted, and if the total exceeds the budget, the reducible
+    sections are reduced, the least important ones first, until the prompt fits. The breakdown of where the tokens
+    went is returned together with the messages, so that prompt sizes can be inspected and monitored.
+
+    The reducible sections are:
+      - "memory_context": the semantic memories retrieved for the current situation, least relevant first;
+      - "episodes": the recent episodes, oldest first (summaries of consolidated episodes are dropped last);
+      - "accessible_agents": the agents listed individually, which are then just counted;
+      - "persona": the persona specification, which is first compacted, and then truncated.
+
+    The rest of the prompt (e.g., the directives in the template and the actions definitions) is never reduced.
+
+    If a renderer for the cognitive state is given, the prompt is laid out so that consecutive prompts share the longest
+    possible prefix, which providers can then cache: the system message holds only what rarely changes (directives,
+    faculties, persona), while the volatile cognitive state (e.g., datetime, goals, memory context) is rendered into the
+    final message, together with the instruction, after the episodes.
+    """
+
+    # The default order in which sections are reduced, from the first to be reduced to the last.
+    REDUCIBLE_SECTIONS = ["memory_context", "episodes", "accessible_agents", "persona"]
+
+    # Per-model token budgets, which override the default ones. See token_budget_for().
+    token_budgets = {} # model -> budget
+
+    def __init__(self, token_budget:int=None, reducible_sections:list=None, min_recent_episodes:int=2):
+        """
+        Initializes the prompt composer.
+
+        Args:
+            token_budget (int, optional): The token budget for the prompts composed by this composer, regardless of the model.
+              Defaults to None, in which case the budget depends on the model (see token_budget_for()).
+            reducible_sections (list, optional): The sections that can be reduced, from the first to be reduced to the last.
+              Defaults to PromptComposer.REDUCIBLE_SECTIONS.
+            min_recent_episodes (int): The number of most recent episodes which are never dropped.
+        """
+        self.token_budget = token_budget
+        self.reducible_sections = reducible_sections if reducible_sections is not None else PromptComposer.REDUCIBLE_SECTIONS
+        self.min_recent_episodes = min_recent_episodes
+
+        for section in self.reducible_sections:
+            if section not in PromptComposer.REDUCIBLE_SECTIONS:
+                raise ValueError(f"Unknown prompt section: {section}. Valid sections are: {PromptComposer.REDUCIBLE_SECTIONS}.")
+
+    @staticmethod
+    def set_token_budget(model:str, token_budget:int):
+        """
+        Sets the token budget for prompts sent to the specified model. If None, the budget is removed.
+        """
+        if token_budget is None:
+            PromptComposer.token_budgets.pop(model, None)
+        else:
+            PromptComposer.token_budgets[model] = token_budget
+
+    @staticmethod
+    def token_budget_for(model:str) -> int:
+        """
+        Returns the token budget for the specified model: the budget set for that model, if any, or else the configured
+        default (MAX_PROMPT_TOKENS), or else the model's maximum input, if known. Returns None if there is no budget.
+        """
+        # local import to avoid circular dependencies
+        from tinytroupe import litellm_utils
+
+        if model in PromptComposer.token_budgets:
+            return PromptComposer.token_budgets[model]
+
+        if litellm_utils.default["max_prompt_tokens"] is not None:
+            return litellm_utils.default["max_prompt_tokens"]
+
+        return litellm_utils.ModelCapabilities.of(model)["max_input_tokens"] if model is not None else None
+
+    def compose(self, render, template_variables:dict, episodes:list, instruction:dict, model:str=None, render_state=None) -> tuple:
+        """
+        Composes the prompt messages within the token budget.
+
+        Args:
+            render (callable): A function that renders the system message from the template variables.
+            template_variables (dict): The template variables of the system message.
+            episodes (list): The episodes to include after the system message.
+            instruction (dict): The final message, instructing the agent what to do.
+            model (str, optional): The model the prompt is meant for, which determines the token budget.
+            render_state (callable, optional): A function that renders the current cognitive state from the template variables.
+              If given, the cognitive state is prepended to the content of the final message, instead of being part of the
+              system message.
+
+        Returns:
+            tuple: The list of messages, and the breakdown of tokens by section (a dict). The breakdown also tells how many
+              leading messages form the stable prefix of the prompt, that is, those that do not depend on the cognitive state.
+        """
+        budget = self.token_budget if self.token_budget is not None else PromptComposer.token_budget_for(model)
+
+        template_variables = dict(template_variables)
+        episodes = list(episodes)
+
+        system_message = render(template_variables)
+        final_message = self._final_message(render_state, template_variables, instruction)
+        sections = self._count_sections(system_message, template_variables, episodes, instruction, final_message)
+        total = sum(sections.values())
+
+        reduced = {}
+        if budget is not None and total > budget:
+            excess = total - budget
+            for section in self.reducible_sections:
+                if excess <= 0:
+                    break
+
+                freed = getattr(self, f"_reduce_{section}")(template_variables, episodes, excess)
+                if freed > 0:
+                    reduced[section] = freed
+                    excess -= freed
+
+            # count again, now exactly
+            system_message = render(template_variables)
+            final_message = self._final_message(render_state, template_variables, instruction)
+            sections = self._count_sections(system_message, template_variables, episodes, instruction, final_message)
+            total = sum(sections.values())
+
+            if total > budget:
+                logger.warning(f"Prompt has {total} tokens even after reductions, exceeding the budget of {budget} tokens for model {model}.")
+
+        messages = [{"role": "system", "content": system_message}] + episodes + [final_message]
+
+        # without a separate cognitive state, the system message itself changes whenever the state does
+        stable_prefix_messages = len(messages) - 1 if render_state is not None else 0
+
+        breakdown = {"model": model, "budget": budget, "total": total, "sections": sections, "reduced": reduced,
+                     "stable_prefix_messages": stable_prefix_messages}
+
+        return messages, breakdown
+
+    @staticmethod
+    def _final_message(render_state, template_variables:dict, instruction:dict) -> dict:
+        if render_state is None:
+            return instruction
+
+        return {"role": instruction["role"], "content": f"{render_state(template_variables)}\n\n{instruction['content']}"}
+
+    ############################################################################
+    # Token counting
+    ############################################################################
+
+    @staticmethod
+    def count_message_tokens(message:dict) -> int:
+        """
+        Counts the tokens of a message, whose content is sent as JSON, plus a small per-message overhead.
+        """
+        return utils.count_tokens(json.dumps(message["content"])) + 4
+
+    def _count_sections(self, system_message:str, template_variables:dict, episodes:list, instruction:dict, final_message:dict) -> dict:
+        persona = utils.count_tokens(template_variables.get("persona") or "")
+        faculties = utils.count_tokens((template_variables.get("actions_definitions_prompt") or "") +
+                                       (template_variables.get("actions_constraints_prompt") or ""))
+        memory_context = sum(utils.count_tokens(memory) for memory in (template_variables.get("memory_context") or []))
+        accessible_agents = sum(utils.count_tokens(line) for line in _accessible_agents_lines(template_variables))
+
+        system = PromptComposer.count_message_tokens({"content": system_message})
+        instruction_tokens = PromptComposer.count_message_tokens(instruction)
+
+        if final_message is instruction:
+            # the cognitive state is rendered as part of the system message
+            system -= memory_context + accessible_agents
+            cognitive_state = 0
+        else:
+            cognitive_state = max(0, PromptComposer.count_message_tokens(final_message) - instruction_tokens - 
+                                     memory_context - accessible_agents)
+
+        return {"template": max(0, system - persona - faculties),
+                "persona": persona,
+                "faculties": faculties,
+                "cognitive_state": cognitive_state,
+                "memory_context": memory_context,
+                "accessible_agents": accessible_agents,
+                "episodes": sum(PromptComposer.count_message_tokens(episode) for episode in episodes),
+                "instruction": instruction_tokens}
+
+    ############################################################################
+    # Section reductions. Each one reduces its section in place, by about the
+    # required number of tokens if possible, and returns the tokens freed.
+    ############################################################################
+
+    def _reduce_memory_context(self, template_variables:dict, episodes:list, excess:int) -> int:
+        memories = list(template_variables.get("memory_context") or [])
+
+        freed = 0
+        while freed < excess and len(memories) > 0:
+            # memories are sorted by relevance, so the last one is the least relevant
+            freed += utils.count_tokens(memories.pop())
+
+        template_variables["memory_context"] = memories
+        return freed
+
+    def _reduce_episodes(self, template_variables:dict, episodes:list, excess:int) -> int:
+        droppable = len(episodes) - self.min_recent_episodes
+        if droppable <= 0:
+            return 0
+
+        # raw episodes go first, and only then the summaries of older ones, which are more informative per token
+        candidates = [i for i in range(droppable) if episodes[i].get("type") != "summary"] + \
+                     [i for i in range(droppable) if episodes[i].get("type") == "summary"]
+
+        freed = 0
+        to_drop = set()
+        for i in candidates:
+            if freed >= excess:
+                break
+            to_drop.add(i)
+            freed += PromptComposer.count_message_tokens(episodes[i])
+
+        episodes[:] = [episode for i, episode in enumerate(episodes) if i not in to_drop]
+        return freed
+
+    def _reduce_accessible_agents(self, template_variables:dict, episodes:list, excess:int) -> int:
+        listed = list(template_variables.get("accessible_agents") or [])
+        summary = list(template_variables.get("accessible_agents_summary") or [])
+
+        freed = 0
+        omitted = 0
+        while freed < excess and len(listed) > 0:
+            agent = listed.pop()
+            freed += utils.count_tokens(_accessible_agent_line(agent))
+            omitted += 1
+
+        if omitted > 0:
+            line = f"... and {omitted} other agents."
+            freed -= utils.count_tokens(line)
+            summary.append(line)
+
+        template_variables["accessible_agents"] = listed
+        template_variables["accessible_agents_summary"] = summary
+        return freed
+
+    def _reduce_persona(self, template_variables:dict, episodes:list, excess:int) -> int:
+        persona = template_variables.get("persona")
+        if not persona:
+            return 0
+
+        original_tokens = utils.count_tokens(persona)
+
+        # first, just remove the indentation
+        try:
+            persona = json.dumps(json.loads(persona), separators=(",", ":"))
+        except json.JSONDecodeError:
+            pass
+
+        # if that is not enough, truncate it
+        tokens = utils.count_tokens(persona)
+        if original_tokens - tokens < excess:
+            target_tokens = max(0, original_tokens - excess)
+            persona = utils.break_text_at_length(persona, max_length=int(len(persona) * target_tokens / max(tokens, 1)))
+            tokens = utils.count_tokens(persona)
+
+        template_variables["persona"] = persona
+        return original_tokens - tokens
+
+
+def _accessible_agent_line(agent:dict) -> str:
+    return f"  - {agent['name']}: {agent['relation_description']}"
+
+def _accessible_agents_lines(template_variables:dict) -> list:
+    return [_accessible_agent_line(agent) for agent in (template_variables.get("accessible_agents") or [])] + \
+           [f"  - {line}" for line in (template_variables.get("accessible_agents_summary") or [])]
@@ -1,9 +1,12 @@
-from tinytroupe.agent import logger, default, Self, AgentOrWorld, CognitiveActionModel
+from tinytroupe.agent import logger, default, Self, AgentOrWorld, Action, CognitiveActionModel
 from tinytroupe.agent.memory import EpisodicMemory, SemanticMemory
+from tinytroupe.agent.prompt_composer import PromptComposer
 import tinytroupe.litellm_utils as litellm_utils
+import tinytroupe.metrics as metrics
+import tinytroupe.tracing as tracing
 from tinytroupe.utils import JsonSerializableRegistry, repeat_on_error, name_or_empty
 import tinytroupe.utils as utils
-from tinytroupe.control import transactional, current_simulation
+from tinytroupe.control import transactional, current_simulation, ScopedRegistry
 
 
 import os
@@ -27,14 +30,28 @@ class TinyPerson(JsonSerializableRegistry):
     # This prevents the agent from acting without ever stopping.
     MAX_ACTIONS_BEFORE_DONE = 15
 
+    # The maximum number of accessible agents that are individually listed in the prompt. Beyond that, 
+    # they are summarized, so that large worlds do not blow up the prompt.
+    MAX_ACCESSIBLE_AGENTS_IN_PROMPT = 20
+
     PP_TEXT_WIDTH = 100
 
+    # How many times an invalid action output is repaired (with a short request), before the whole prompt is sent again.
+    MAX_OUTPUT_REPAIR_ATTEMPTS = 2
+
+    # The final message of every prompt, which instigates the agent to act properly.
+    ACTION_INSTRUCTION = "Now you **must** generate a sequence of actions following your interaction directives, " +\
+                         "and complying with **all** instructions and contraints related to the action you use." +\
+                         "DO NOT repeat the exact same action more than once in a row!" +\
+                         "DO NOT keep saying or doing very similar things, but instead try to adapt and make the interactions look natural." +\
+                         "These actions **MUST** be rendered following the JSON specification perfectly, including all required keys (even if their value is empty), **ALWAYS**."
+
     serializable_attributes = ["_persona", "_mental_state", "_mental_faculties", "episodic_memory", "semantic_memory"]
     serializable_attributes_renaming = {"_mental_faculties": "mental_faculties", "_persona": "persona", "_mental_state": "mental_state"}
 
 
     # A dict of all agents instantiated so far.
-    all_agents = {}  # name -> agent
+    all_agents = ScopedRegistry("agents")  # name -> agent, for the simulation running in the current context
 
     # The communication style for all agents: "simplified" or "full".
     communication_style:str="simplified"
@@ -42,12 +59,16 @@ class TinyPerson(JsonSerializableRegistry):
     # Whether to display the communication or not. True is for interactive applications, when we want to see simulation
     # outputs as they are produced.
     communication_display:bool=True
+
+    # How prompts are composed within the token budget of the model, for all agents. Can be overridden per agent.
+    prompt_composer:PromptComposer=PromptComposer()
     
 
     def __init__(self, name:str=None, 
                  episodic_memory=None,
                  semantic_memory=None,
-                 mental_faculties:list=None):
+                 mental_faculties:list=None,
+                 memory_consolidator=None):
         """
         Creates a TinyPerson.
 
@@ -56,6 +77,8 @@ class TinyPerson(JsonSerializableRegistry):
             episodic_memory (EpisodicMemory, optional): The memory implementation to use. Defaults to EpisodicMemory().
             semantic_memory (SemanticMemory, optional): The memory implementation to use. Defaults to SemanticMemory().
             mental_faculties (list, optional): A list of mental faculties to add to the agent. Defaults to None.
+            memory_consolidator (MemoryConsolidator, optional): If given, older episodes are consolidated into summaries after
+              each action, so that the prompt size is bounded. Defaults to None (no consolidation).
         """
 
         # NOTE: default values will be given in the _post_init method, as that's shared by 
@@ -70,6 +93,9 @@ class TinyPerson(JsonSerializableRegistry):
         # Mental faculties
         if mental_faculties is not None:
             self._mental_faculties = mental_faculties
+
+        if memory_consolidator is not None:
+            self._memory_consolidator = memory_consolidator
         
         assert name is not None, "A TinyPerson must have a name."
         self.name = name
@@ -88,6 +114,9 @@ class TinyPerson(JsonSerializableRegistry):
         ############################################################
 
         self.current_messages = []
+
+        # where the tokens of the last prompt went, by section (see PromptComposer)
+        self.last_prompt_breakdown = None
         
         # the current environment in which the agent is acting
         self.environment = None
@@ -96,9 +125,24 @@ class TinyPerson(JsonSerializableRegistry):
         # consumed by the environment yet.
         self._actions_buffer = []
 
-        # The list of agents that this agent can currently interact with.
+        # The action being produced, if it was already dispatched (i.e., displayed and passed on to the environment) 
+        # while the rest of the model's response was still streaming.
+        self._early_action = None
+
+        # The actions in the buffer above that were already dispatched while streaming, and that the environment 
+        # must therefore not handle again. Consumed together with the buffer.
+        self._early_dispatched_actions = []
+
+        # The agents that this agent can currently interact with, by name.
         # This can change over time, as agents move around the world.
-        self._accessible_agents = []
+        self._accessible_agents = {}
+
+        # How many stimuli were received since the agent last acted, and whether the agent asked for a turn. 
+        # Event-driven environments use these to decide which agents need to act.
+        if not hasattr(self, '_unprocessed_stimuli'):
+            self._unprocessed_stimuli = 0
+        if not hasattr(self, '_turn_requested'):
+            self._turn_requested = False
 
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
@@ -112,6 +156,9 @@ class TinyPerson(JsonSerializableRegistry):
             # This default value MUST NOT be in the method signature, otherwise it will be shared across all instances.
             self.semantic_memory = SemanticMemory()
         
+        if not hasattr(self, '_memory_consolidator'):
+            self._memory_consolidator = None
+
         # _mental_faculties
         if not hasattr(self, '_mental_faculties'):
             # This default value MUST NOT be in the method signature, otherwise it will be shared across all instances.
@@ -147,15 +194,21 @@ class TinyPerson(JsonSerializableRegistry):
                 "attention": None,
                 "emotions": "Feeling nothing in particular, just calm.",
                 "memory_context": None,
-                "accessible_agents": []  # [{"agent": agent_1, "relation": "My friend"}, {"agent": agent_2, "relation": "My colleague"}, ...]
+                "accessible_agents": {},  # {agent_name_1: "My friend", agent_name_2: "My colleague", ...}
+                "everyone_accessible": None # if not None, everyone in the environment is accessible, with this relation description
             }
         
+        self._upgrade_mental_state()
+        
         if not hasattr(self, '_extended_agent_summary'):
             self._extended_agent_summary = None
 
         self._prompt_template_path = os.path.join(
             os.path.dirname(__file__), "prompts/tiny_person.mustache"
         )
+        self._cognitive_state_prompt_template_path = os.path.join(
+            os.path.dirname(__file__), "prompts/tiny_person_cognitive_state.mustache"
+        )
         self._init_system_message = None  # initialized later
 
 
@@ -200,10 +253,25 @@ class TinyPerson(JsonSerializableRegistry):
         self._persona["name"] = self.name
 
 
-    def generate_agent_system_prompt(self):
+    def generate_agent_system_prompt(self, template_variables:dict=None):
         with open(self._prompt_template_path, "r") as f:
             agent_prompt_template = f.read()
 
+        if template_variables is None:
+            template_variables = self._prompt_template_variables()
+
+        return chevron.render(agent_prompt_template, template_variables)
+
+    def generate_agent_cognitive_state_prompt(self, template_variables:dict=None):
+        with open(self._cognitive_state_prompt_template_path, "r") as f:
+            cognitive_state_prompt_template = f.read()
+
+        if template_variables is None:
+            template_variables = self._prompt_template_variables()
+
+        return chevron.render(cognitive_state_prompt_template, template_variables)
+
+    def _prompt_template_variables(self) -> dict:
         # let's operate on top of a copy of the configuration, because we'll need to add more variables, etc.
         template_variables = self._persona.copy()    
         template_variables["persona"] = json.dumps(self._persona.copy(), indent=4)    
@@ -220,34 +288,33 @@ class TinyPerson(JsonSerializableRegistry):
         template_variables['actions_definitions_prompt'] = textwrap.indent(actions_definitions_prompt.strip(), "  ")
         template_variables['actions_constraints_prompt'] = textwrap.indent(actions_constraints_prompt.strip(), "  ")
 
+        # Current mental state, with the accessible agents in a form that remains compact for large worlds
+        template_variables.update(self._mental_state)
+        template_variables["accessible_agents"], template_variables["accessible_agents_summary"] = self._accessible_agents_for_prompt()
+
         # RAI prompt components, if requested
         template_variables = utils.add_rai_template_variables_if_enabled(template_variables)
 
-        return chevron.render(agent_prompt_template, template_variables)
+        return template_variables
 
     def reset_prompt(self):
 
-        # render the template with the current configuration
-        self._init_system_message = self.generate_agent_system_prompt()
-
         # TODO actually, figure out another way to update agent state without "changing history"
 
-        # reset system message
-        self.current_messages = [
-            {"role": "system", "content": self._init_system_message}
-        ]
-
-        # sets up the actual interaction messages to use for prompting
-        self.current_messages += self.retrieve_recent_memories()
-
-        # add a final user message, which is neither stimuli or action, to instigate the agent to act properly
-        self.current_messages.append({"role": "user", 
-                                      "content": "Now you **must** generate a sequence of actions following your interaction directives, " +\
-                                                 "and complying with **all** instructions and contraints related to the action you use." +\
-                                                 "DO NOT repeat the exact same action more than once in a row!" +\
-                                                 "DO NOT keep saying or doing very similar things, but instead try to adapt and make the interactions look natural." +\
-                                                 "These actions **MUST** be rendered following the JSON specification perfectly, including all required keys (even if their value is empty), **ALWAYS**."
-                                     })
+        # Compose the system message (rendered from the current configuration) and the actual interaction messages, 
+        # within the token budget of the model. Then add a final user message, which is neither stimuli or action, 
+        # with the current cognitive state and the instruction to act properly. Keeping the volatile cognitive state 
+        # at the end means that the system message and the episodes form a prefix that is stable from one call to the 
+        # next, and thus can be cached by the LLM provider.
+        self.current_messages, self.last_prompt_breakdown = \
+            self.prompt_composer.compose(render=self.generate_agent_system_prompt,
+                                         template_variables=self._prompt_template_variables(),
+                                         episodes=self.retrieve_recent_memories(),
+                                         instruction={"role": "user", "content": TinyPerson.ACTION_INSTRUCTION},
+                                         model=litellm_utils.call_site_settings("agent.act")["model"],
+                                         render_state=self.generate_agent_cognitive_state_prompt)
+
+        self._init_system_message = self.current_messages[0]["content"]
 
     def get(self, key):
         """
@@ -404,6 +471,7 @@ class TinyPerson(JsonSerializableRegistry):
         
         return self
 
+    @tracing.traced("TinyPerson.act", lambda self, *args, **kwargs: {"agent": self.name})
     @transactional
     def act(
         self,
@@ -439,21 +507,43 @@ class TinyPerson(JsonSerializableRegistry):
             pass # self.think("I will now think, reflect and act a bit, and then issue DONE.")        
 
         # Aux function to perform exactly one action.
-        # Occasionally, the model will return JSON missing important keys, so we just ask it to try again
-        # Sometimes `content` contains EpisodicMemory's MEMORY_BLOCK_OMISSION_INFO message, which raises a TypeError on line 443
-        @repeat_on_error(retries=5, exceptions=[KeyError, TypeError])
+        # Invalid outputs are first repaired within _produce_message(). Only if that fails (raising a ValueError), 
+        # or the output is otherwise unusable, we ask the model to try again from scratch.
+        @repeat_on_error(retries=5, exceptions=[KeyError, TypeError, ValueError])
         def aux_act_once():
-            role, content = self._produce_message()
+            self._early_action = None
+            try:
+                role, content = self._produce_message()
 
-            cognitive_state = content["cognitive_state"]
+                cognitive_state = content["cognitive_state"]
 
 
-            action = content['action']
-            logger.debug(f"{self.name}'s action: {action}")
+                action = content['action']
+                logger.debug("%s's action: %s", self.name, action)
 
-            goals = cognitive_state['goals']
-            attention = cognitive_state['attention']
-            emotions = cognitive_state['emotions']
+                goals = cognitive_state['goals']
+                attention = cognitive_state['attention']
+                emotions = cognitive_state['emotions']
+
+            except (KeyError, TypeError, ValueError):
+                if self._early_action is None:
+                    raise # nothing was dispatched yet, so the action can be produced again
+
+                # The action was already delivered while streaming, so it is kept as this turn's action, rather than 
+                # producing another one. The cognitive state stays as it was.
+                logger.warning(f"[{self.name}] The response was unusable, but its action had already been dispatched while streaming, so it is kept.")
+                role = "assistant"
+                cognitive_state = {"goals": self._mental_state["goals"], 
+                                   "attention": self._mental_state["attention"], 
+                                   "emotions": self._mental_state["emotions"]}
+                content = {"action": self._early_action, "cognitive_state": cognitive_state}
+                action = self._early_action
+
+            if self._early_action is not None and action != self._early_action:
+                # e.g., the response was repaired after the action was dispatched. What was delivered is what the agent did.
+                logger.warning(f"[{self.name}] The action dispatched while streaming differs from the final one, after validation. The dispatched one is kept.")
+                action = self._early_action
+                content = {**content, "action": action}
 
             self.store_in_memory({'role': role, 'content': content, 
                                   'type': 'action', 
@@ -465,7 +555,7 @@ class TinyPerson(JsonSerializableRegistry):
                                         emotions=cognitive_state['emotions'])
             
             contents.append(content)          
-            if TinyPerson.communication_display:
+            if TinyPerson.communication_display and self._early_action is None: # otherwise, already displayed
                 self._display_communication(role=role, content=content, kind='action', simplified=True, max_content_length=max_content_length)
             
             #
@@ -505,6 +595,12 @@ class TinyPerson(JsonSerializableRegistry):
                 aux_pre_act()
                 aux_act_once()
 
+        # whatever was received so far has now been taken into account
+        self._unprocessed_stimuli = 0
+        self._turn_requested = False
+
+        self.optimize_memory()
+
         if return_actions:
             return contents
 
@@ -611,7 +707,9 @@ class TinyPerson(JsonSerializableRegistry):
 
         content = {"stimuli": stimuli}
 
-        logger.debug(f"[{self.name}] Observing stimuli: {content}")
+        logger.debug("[%s] Observing stimuli: %s", self.name, content)
+
+        self._unprocessed_stimuli += 1
 
         # whatever comes from the outside will be interpreted as coming from 'user', simply because
         # this is the counterpart of 'assistant'
@@ -631,6 +729,37 @@ class TinyPerson(JsonSerializableRegistry):
 
         return self  # allows easier chaining of methods
 
+    def _receive_stimuli(self, episode: dict):
+        """
+        Receives an already built stimuli episode, which the environment may share among many agents (e.g., when 
+        broadcasting). Unlike _observe(), nothing is displayed, since the environment displays the delivery only once.
+        """
+        self._unprocessed_stimuli += len(episode["content"]["stimuli"])
+        self.store_in_memory(episode)
+
+        return self  # allows easier chaining of methods
+
+    def has_unprocessed_stimuli(self) -> bool:
+        """
+        Checks whether the agent received stimuli since it last acted.
+        """
+        return self._unprocessed_stimuli > 0
+
+    def request_turn(self):
+        """
+        Asks the environment for a turn to act, even if no new stimuli were received. This is meant for
+        agents (or mental faculties) that have their own schedule or pending goals, in environments that 
+        only activate agents when something happens to them.
+        """
+        self._turn_requested = True
+        return self  # allows easier chaining of methods
+
+    def has_requested_turn(self) -> bool:
+        """
+        Checks whether the agent asked for a turn to act.
+        """
+        return self._turn_requested
+
     @transactional
     def listen_and_act(
         self,
@@ -739,11 +868,9 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Makes an agent accessible to this agent.
         """
-        if agent not in self._accessible_agents:
-            self._accessible_agents.append(agent)
-            self._mental_state["accessible_agents"].append(
-                {"name": agent.name, "relation_description": relation_description}
-            )
+        if agent.name not in self._accessible_agents:
+            self._accessible_agents[agent.name] = agent
+            self._mental_state["accessible_agents"][agent.name] = relation_description
         else:
             logger.warning(
                 f"[{self.name}] Agent {agent.name} is already accessible to {self.name}."
@@ -754,8 +881,9 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Makes an agent inaccessible to this agent.
         """
-        if agent in self._accessible_agents:
-            self._accessible_agents.remove(agent)
+        if agent.name in self._accessible_agents:
+            del self._accessible_agents[agent.name]
+            self._mental_state["accessible_agents"].pop(agent.name, None)
         else:
             logger.warning(
                 f"[{self.name}] Agent {agent.name} is already inaccessible to {self.name}."
@@ -766,9 +894,65 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Makes all agents inaccessible to this agent.
         """
-        self._accessible_agents = []
-        self._mental_state["accessible_agents"] = []
+        self._accessible_agents = {}
+        self._mental_state["accessible_agents"] = {}
+        self._mental_state["everyone_accessible"] = None
+
+    @transactional
+    def make_everyone_accessible(self, relation_description: str = "Someone in the same environment, with whom I can currently interact."):
+        """
+        Makes all the agents in the agent's current environment accessible to this agent, including those that join later.
+        This is represented as a single group, rather than agent by agent, so it remains compact for large environments.
+        """
+        self._mental_state["everyone_accessible"] = relation_description
+
+    def accessible_agents(self) -> list:
+        """
+        Returns the agents that this agent can currently interact with.
+        """
+        accessible = list(self._accessible_agents.values())
+        if self._mental_state["everyone_accessible"] is not None and self.environment is not None:
+            accessible += [agent for agent in self.environment.agents 
+                           if agent is not self and agent.name not in self._accessible_agents]
+        return accessible
+
+    def is_agent_accessible(self, agent: Self) -> bool:
+        """
+        Checks whether the specified agent is accessible to this agent.
+        """
+        if agent.name in self._accessible_agents:
+            return True
+        
+        return self._mental_state["everyone_accessible"] is not None and self.environment is not None and \
+               agent is not self and self.environment.get_agent_by_name(agent.name) is agent
+
+    def _accessible_agents_for_prompt(self) -> tuple:
+        """
+        Returns the accessible agents to list in the prompt, as [{"name", "relation_description"}, ...], together with
+        a list of summary lines for those that are not listed individually.
+        """
+        limit = TinyPerson.MAX_ACCESSIBLE_AGENTS_IN_PROMPT
+        individually = [{"name": name, "relation_description": description} 
+                        for name, description in self._mental_state["accessible_agents"].items()]
+        summary = []
+
+        if len(individually) > limit:
+            summary.append(f"... and {len(individually) - limit} other agents, with the relationships mentioned above or similar ones.")
+            individually = individually[:limit]
+
+        everyone_description = self._mental_state["everyone_accessible"]
+        if everyone_description is not None and self.environment is not None:
+            others = [agent.name for agent in self.environment.agents 
+                      if agent is not self and agent.name not in self._mental_state["accessible_agents"]]
+            
+            room = max(limit - len(individually), 0)
+            individually += [{"name": name, "relation_description": everyone_description} for name in others[:room]]
+            if len(others) > room:
+                summary.append(f"Everyone else in {self.environment.name} ({len(others) - room} more agents): {everyone_description}")
+
+        return individually, summary
 
+    @tracing.traced("TinyPerson._produce_message", lambda self: {"agent": self.name})
     @transactional
     def _produce_message(self):
         # logger.debug(f"Current messages: {self.current_messages}")
@@ -781,15 +965,52 @@ class TinyPerson(JsonSerializableRegistry):
             for msg in self.current_messages
         ]
 
-        logger.debug(f"[{self.name}] Sending messages to LiteLLM API")
-        logger.debug(f"[{self.name}] Last interaction: {messages[-1]}")
+        logger.debug("[%s] Sending messages to LiteLLM API", self.name)
+        logger.debug("[%s] Last interaction: %s", self.name, messages[-1])
+
+        # If streaming, the action is dispatched as soon as it is complete, before the cognitive state arrives.
+        stream_callback = None
+        if litellm_utils.default["stream"]:
+            extractor = utils.JSONExtractor()
 
-        # Pass in response_model instead of the class to avoid serialization issues
-        next_message = litellm_utils.client().send_message(messages)
+            def stream_callback(text):
+                extractor.feed(text)
+                if self._early_action is None and "action" in extractor.completed_fields:
+                    self._dispatch_early_action(extractor.completed_fields["action"])
 
-        logger.debug(f"[{self.name}] Received message: {next_message}")
+        # The output is requested (and, where supported, enforced) in the structure of CognitiveActionModel. 
+        # Invalid outputs are repaired with short, targeted requests, rather than by sending the whole prompt again.
+        with metrics.labels(agent=self.name):
+            role, content = litellm_utils.client().send_structured_message(messages, CognitiveActionModel,
+                                                                           max_repair_attempts=TinyPerson.MAX_OUTPUT_REPAIR_ATTEMPTS,
+                                                                           stable_prefix_length=self.last_prompt_breakdown["stable_prefix_messages"],
+                                                                           prefix_key=self.name,
+                                                                           stream=litellm_utils.default["stream"],
+                                                                           stream_callback=stream_callback,
+                                                                           call_site="agent.act")
+
+        logger.debug("[%s] Received message: %s", self.name, content)
+
+        return role, content
+
+    def _dispatch_early_action(self, action:dict):
+        """
+        Displays an action and passes it on to the environment, if any, while the rest of the model's response is still 
+        being streamed. Actions that are not (yet) valid are ignored, and thus dispatched only after the response is complete.
+        """
+        try:
+            Action.model_validate(action)
+        except ValueError:
+            return
 
-        return next_message["role"], utils.extract_json(next_message["content"])
+        self._early_action = action
+
+        if TinyPerson.communication_display:
+            self._display_communication(role="assistant", content={"action": action}, kind='action', simplified=True)
+
+        if self.environment is not None:
+            self._early_dispatched_actions.append(action)
+            self.environment._handle_early_action(self, action)
 
     ###########################################################
     # Internal cognitive state changes
@@ -838,8 +1059,25 @@ class TinyPerson(JsonSerializableRegistry):
 
         self.episodic_memory.store(value)
 
+    @transactional
     def optimize_memory(self):
-        pass #TODO
+        """
+        Consolidates older episodes into summaries, if a memory consolidator was set. This is done automatically after acting.
+        """
+        if self._memory_consolidator is not None:
+            self._memory_consolidator.consolidate(self)
+
+        return self  # allows easier chaining of methods
+
+    def set_memory_consolidator(self, memory_consolidator):
+        """
+        Sets (or, if None, removes) the memory consolidator of the agent. See MemoryConsolidator.
+        """
+        if self._memory_consolidator is not None:
+            self._memory_consolidator.apply_pending(self)
+        self._memory_consolidator = memory_consolidator
+
+        return self  # allows easier chaining of methods
 
     def retrieve_memories(self, first_n: int, last_n: int, include_omission_info:bool=True, max_content_length:int=None) -> list:
         episodes = self.episodic_memory.retrieve(first_n=first_n, last_n=last_n, include_omission_info=include_omission_info)
@@ -863,6 +1101,7 @@ class TinyPerson(JsonSerializableRegistry):
 
         return relevant
 
+    @tracing.traced("TinyPerson.retrieve_relevant_memories_for_current_context", lambda self, *args, **kwargs: {"agent": self.name})
     def retrieve_relevant_memories_for_current_context(self, top_k=7) -> list:
         # current context is composed of th recent memories, plus context, goals, attention, and emotions
         context = self._mental_state["context"]
@@ -881,7 +1120,7 @@ class TinyPerson(JsonSerializableRegistry):
         {recent_memories}
         """
 
-        logger.debug(f"Retrieving relevant memories for contextual target: {target}")
+        logger.debug("Retrieving relevant memories for contextual target: %s", target)
 
         return self.retrieve_relevant_memories(target, top_k=top_k)
 
@@ -958,14 +1197,30 @@ class TinyPerson(JsonSerializableRegistry):
         self._displayed_communications_buffer = []
 
     @transactional
-    def pop_latest_actions(self) -> list:
+    def pop_latest_actions(self, skip_early_dispatched:bool=False) -> list:
         """
         Returns the latest actions performed by this agent. Typically used
         by an environment to consume the actions and provide the appropriate
         environmental semantics to them (i.e., effects on other agents).
+
+        Args:
+            skip_early_dispatched (bool): Whether to leave out the actions that were already passed on to the 
+              environment while being streamed. They are consumed anyway.
         """
         actions = self._actions_buffer
+        early_dispatched = self._early_dispatched_actions
         self._actions_buffer = []
+        self._early_dispatched_actions = []
+
+        if skip_early_dispatched:
+            undispatched = []
+            for action in actions:
+                if action in early_dispatched:
+                    early_dispatched.remove(action)
+                else:
+                    undispatched.append(action)
+            actions = undispatched
+
         return actions
 
     @transactional
@@ -1030,7 +1285,8 @@ class TinyPerson(JsonSerializableRegistry):
                                                 **Short biography:** {base_biography}
 
                                                 **Detailed specification:** {self._persona}
-                                                """).call()
+                                                """,
+                                                call_site="agent.minibio").call()
 
         if extended:
             biography = f"{base_biography} {self._extended_agent_summary}"
@@ -1270,8 +1526,9 @@ class TinyPerson(JsonSerializableRegistry):
         # delete the logger and other attributes that cannot be serialized
         del to_copy["environment"]
         del to_copy["_mental_faculties"]
+        del to_copy["_memory_consolidator"]
 
-        to_copy["_accessible_agents"] = [agent.name for agent in self._accessible_agents]
+        to_copy["_accessible_agents"] = list(self._accessible_agents.keys())
         to_copy['episodic_memory'] = self.episodic_memory.to_json()
         to_copy['semantic_memory'] = self.semantic_memory.to_json()
         to_copy["_mental_faculties"] = [faculty.to_json() for faculty in self._mental_faculties]
@@ -1280,6 +1537,16 @@ class TinyPerson(JsonSerializableRegistry):
 
         return state
 
+    def _upgrade_mental_state(self):
+        """
+        Converts a mental state from an older specification or cached state to the current structure.
+        """
+        # older versions list accessible agents as [{"name": ..., "relation_description": ...}, ...]
+        if isinstance(self._mental_state.get("accessible_agents"), list):
+            self._mental_state["accessible_agents"] = {accessible["name"]: accessible["relation_description"] 
+                                                       for accessible in self._mental_state["accessible_agents"]}
+        self._mental_state.setdefault("everyone_accessible", None)
+
     def decode_complete_state(self, state: dict) -> Self:
         """
         Loads the complete state of the TinyPerson, including the current messages,
@@ -1287,7 +1554,12 @@ class TinyPerson(JsonSerializableRegistry):
         """
         state = copy.deepcopy(state)
         
-        self._accessible_agents = [TinyPerson.get_agent_by_name(name) for name in state["_accessible_agents"]]
+        self._accessible_agents = {name: TinyPerson.get_agent_by_name(name) for name in state["_accessible_agents"]}
+
+        # summaries still being computed refer to the memory being replaced
+        if self._memory_consolidator is not None:
+            self._memory_consolidator.discard_pending()
+
         self.episodic_memory = EpisodicMemory.from_json(state['episodic_memory'])
         self.semantic_memory = SemanticMemory.from_json(state['semantic_memory'])
         
@@ -1303,6 +1575,8 @@ class TinyPerson(JsonSerializableRegistry):
         # restore other fields
         self.__dict__.update(state)
 
+        # states cached by older versions have an older mental state
+        self._upgrade_mental_state()
 
         return self
     
@@ -1327,7 +1601,7 @@ class TinyPerson(JsonSerializableRegistry):
     @staticmethod
     def add_agent(agent):
         """
-        Adds an agent to the global list of agents. Agent names must be unique,
+        Adds an agent to the list of agents of the current context. Agent names must be unique,
         so this method will raise an exception if the name is already in use.
         """
         if agent.name in TinyPerson.all_agents:
@@ -1372,6 +1646,6 @@ class TinyPerson(JsonSerializableRegistry):
     @staticmethod
     def clear_agents():
         """
-        Clears the global list of agents.
+        Clears the list of agents of the current context.
         """
-        TinyPerson.all_agents = {}        
+        TinyPerson.all_agents.clear()
@@ -4,19 +4,408 @@ Simulation controlling mechanisms.
 import json
 import os
 import tempfile
+import time
+import threading
+import contextvars
+import functools
 
 import tinytroupe
 import tinytroupe.utils as utils
+import tinytroupe.tracing as tracing
 
 import logging
 logger = logging.getLogger("tinytroupe")
 
+class SimulationCacheTree:
+    """
+    A branchable cache of simulation states. Each node corresponds to a transaction that was executed, and is keyed 
+    by the digest of the state it started from (the parent state) together with the hash of the event (i.e., the 
+    function call) that was executed. The digest of the state a node reaches is the node's own key. This means that 
+    different runs of a simulation, as well as different branches of the same scenario (e.g., different ads shown after 
+    the same setup), automatically share their common prefixes, and no branch ever needs to be discarded in order to 
+    explore another.
+    """
+
+    # the digest of the (empty) state from which every simulation starts
+    ROOT_DIGEST = "root"
+
+    FORMAT_VERSION = 2
+
+    def __init__(self, nodes:dict=None):
+        # node_id -> {"parent_digest", "event_hash", "event_output", "state", "state_digest", "last_used"}
+        self.nodes = {}
+
+        # parent_digest -> [node_id, ...], to navigate the tree downwards
+        self._children = {}
+
+        # the ids of the nodes removed by garbage collection, so that they are also removed from the cache file when
+        # the tree is merged with it (see _write_cache_file())
+        self.removed_node_ids = set()
+
+        if nodes is not None:
+            for node_id, node in nodes.items():
+                self._index(node_id, node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @staticmethod
+    def node_id_for(parent_digest:str, event_hash:str) -> str:
+        """
+        Computes the (content-addressed) id of the node reached by executing the given event from the given parent state.
+        """
+        return utils.custom_hash((parent_digest, event_hash))
+
+    def get(self, parent_digest:str, event_hash:str) -> dict:
+        """
+        Returns the node reached by executing the given event from the given parent state, or None if there's no such node.
+        """
+        return self.nodes.get(SimulationCacheTree.node_id_for(parent_digest, event_hash))
+
+    def add(self, parent_digest:str, event_hash:str, event_output, state:dict) -> str:
+        """
+        Adds a new node to the tree, replacing any existing node with the same key. Returns the id of the node.
+        """
+        node_id = SimulationCacheTree.node_id_for(parent_digest, event_hash)
+
+        # The state reached is identified by the key of the node itself, that is, by the state it started from and
+        # the event executed, so the (potentially large) state never needs to be serialized just to be digested.
+        node = {"parent_digest": parent_digest,
+                "event_hash": event_hash,
+                "event_output": event_output,
+                "state": state,
+                "state_digest": node_id,
+                "last_used": time.time()}
+
+        if node_id in self.nodes:
+            self._unindex(node_id)
+        self._index(node_id, node)
+        self.removed_node_ids.discard(node_id)
+
+        return node_id
+
+    def touch(self, node_id:str):
+        """
+        Marks the given node as used now, which protects it from age-based garbage collection.
+        """
+        self.nodes[node_id]["last_used"] = time.time()
+
+    def children_of(self, state_digest:str) -> list:
+        """
+        Returns the ids of the nodes that have the given state as parent.
+        """
+        return list(self._children.get(state_digest, []))
+
+    def merge(self, other:"SimulationCacheTree", overwrite:bool=False):
+        """
+        Merges the nodes of another tree into this one. Since nodes are content-addressed, 
+        this is a simple union. Existing nodes are kept unless `overwrite` is True.
+        """
+        for node_id, node in other.nodes.items():
+            if node_id not in self.nodes:
+                self._index(node_id, node)
+            elif overwrite:
+                self._unindex(node_id)
+                self._index(node_id, node)
+
+    def descendants_of(self, state_digest:str) -> set:
+        """
+        Returns the ids of all nodes reachable from the given state.
+        """
+        result = set()
+        pending = [state_digest]
+        visited_digests = set()
+        while pending:
+            digest = pending.pop()
+            if digest in visited_digests:
+                continue
+            visited_digests.add(digest)
+
+            for child_id in self._children.get(digest, []):
+                result.add(child_id)
+                pending.append(self.nodes[child_id]["state_digest"])
+
+        return result
+
+    def collect_garbage(self, retain:set=None, max_age:float=None) -> int:
+        """
+        Removes branches that can no longer be reached, optionally pruning the tree further beforehand.
+
+        Args:
+            retain (set, optional): If given, only these node ids are kept, everything else is dropped.
+            max_age (float, optional): If given, nodes not used in the last `max_age` seconds are dropped,
+              unless they are in `retain`.
+
+        Returns:
+            int: The number of removed nodes.
+        """
+        initial_size = len(self.nodes)
+        initial_node_ids = set(self.nodes.keys())
+        retain = set(retain) if retain is not None else None
+
+        # explicit pruning
+        if retain is not None:
+            for node_id in list(self.nodes.keys()):
+                if node_id not in retain:
+                    self._unindex(node_id)
+
+        if max_age is not None:
+            oldest_allowed = time.time() - max_age
+            for node_id, node in list(self.nodes.items()):
+                if node.get("last_used", 0) < oldest_allowed and (retain is None or node_id not in retain):
+                    self._unindex(node_id)
+
+        # sweep everything that is no longer reachable from the root
+        reachable = self.descendants_of(SimulationCacheTree.ROOT_DIGEST)
+        for node_id in list(self.nodes.keys()):
+            if node_id not in reachable:
+                self._unindex(node_id)
+
+        self.removed_node_ids |= initial_node_ids - self.nodes.keys()
+
+        return initial_size - len(self.nodes)
+
+    def remove(self, node_ids):
+        """
+        Removes the given nodes, if present, as well as whatever can no longer be reached from the root without them.
+        """
+        for node_id in node_ids:
+            if node_id in self.nodes:
+                self._unindex(node_id)
+
+        self.collect_garbage()
+
+    def to_json(self) -> dict:
+        return {"format_version": SimulationCacheTree.FORMAT_VERSION, "nodes": self.nodes}
+
+    def snapshot(self) -> dict:
+        """
+        Returns a JSON representation of the tree that is not affected by later changes to the tree, so that it can be 
+        safely written to disk by another thread. Each node is copied, since its usage time keeps being updated, 
+        but not the states and outputs within it, which are never modified after being added. The nodes removed by 
+        garbage collection are listed too, so that they can be removed from the cache file as well.
+        """
+        return {"format_version": SimulationCacheTree.FORMAT_VERSION, 
+                "nodes": {node_id: dict(node) for node_id, node in self.nodes.items()},
+                "removed_nodes": list(self.removed_node_ids)}
+
+    @staticmethod
+    def from_json(data) -> "SimulationCacheTree":
+        """
+        Builds a tree from its JSON representation. The legacy (linear list) cache format is also accepted, and 
+        converted into a single branch.
+        """
+        if data is None:
+            return SimulationCacheTree()
+
+        elif isinstance(data, list):
+            tree = SimulationCacheTree()
+            parent_digest = SimulationCacheTree.ROOT_DIGEST
+            for _, event_hash, event_output, state in data:
+                node_id = tree.add(parent_digest, event_hash, event_output, state)
+                parent_digest = tree.nodes[node_id]["state_digest"]
+            return tree
+
+        elif isinstance(data, dict) and "nodes" in data:
+            return SimulationCacheTree(data["nodes"])
+
+        else:
+            raise ValueError("Unrecognized simulation cache format.")
+
+    def _index(self, node_id:str, node:dict):
+        self.nodes[node_id] = node
+        self._children.setdefault(node["parent_digest"], []).append(node_id)
+
+    def _unindex(self, node_id:str):
+        node = self.nodes.pop(node_id)
+        siblings = self._children.get(node["parent_digest"], [])
+        if node_id in siblings:
+            siblings.remove(node_id)
+        if not siblings:
+            self._children.pop(node["parent_digest"], None)
+
+
+class CheckpointWriter:
+    """
+    Writes simulation cache checkpoints to disk in a background thread, so that simulation steps do not stall on disk I/O.
+    
+    Pending checkpoints are kept in a bounded queue with one slot per cache file: if a newer checkpoint for the same 
+    file is submitted before the previous one was written, they are coalesced and only the newest one is written.
+    Each write is flushed with fsync and then atomically renamed over the previous file. The file is only read back
+    and merged with the checkpoint if someone else changed it since it was last loaded or written by this writer.
+    """
+
+    def __init__(self, name:str="default"):
+        self.name = name
+
+        self._condition = threading.Condition()
+        self._pending = {} # cache_path -> snapshot
+        self._busy = False
+        self._closing = False
+        self._thread = None
+
+        # cache_path -> signature of the file as last loaded or written, to tell whether others changed it since
+        self._file_signatures = {}
+
+        # status information
+        self.writes = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_checkpoint_time = None
+
+    def submit(self, cache_path:str, snapshot:dict):
+        """
+        Schedules the given cache snapshot to be written to the given path. Never blocks.
+        """
+        with self._condition:
+            if cache_path in self._pending:
+                self.coalesced += 1
+            self._pending[cache_path] = snapshot
+
+            self._ensure_started()
+            self._condition.notify_all()
+
+    def wait_until_idle(self, timeout:float=None) -> bool:
+        """
+        Waits until all pending checkpoints are written. Returns False if the timeout expired before that.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._busy, timeout=timeout)
+
+    def status(self) -> dict:
+        """
+        Returns information about the checkpoints written so far, including the last error, if any.
+        """
+        with self._condition:
+            return {"pending": len(self._pending),
+                    "busy": self._busy,
+                    "writes": self.writes,
+                    "coalesced": self.coalesced,
+                    "failures": self.failures,
+                    "last_error": self.last_error,
+                    "last_checkpoint_time": self.last_checkpoint_time}
+
+    def mark_in_sync(self, cache_path:str, signature):
+        """
+        Records that the file at the given path, with the given signature (see _file_signature()), is known to be 
+        already contained in the checkpoints to be written, e.g., because it was just loaded.
+        """
+        with self._condition:
+            self._file_signatures[cache_path] = signature
+
+    def close(self):
+        """
+        Writes the pending checkpoints and stops the background thread. The thread is started again if more checkpoints 
+        are submitted later.
+        """
+        with self._condition:
+            thread = self._thread
+            self._closing = True
+            self._condition.notify_all()
+
+        if thread is not None:
+            thread.join()
+
+        with self._condition:
+            self._closing = False
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=f"tinytroupe-checkpoint-{self.name}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closing)
+                if not self._pending:
+                    self._thread = None
+                    return
+
+                cache_path, snapshot = self._pending.popitem()
+                in_sync = self._file_signatures.get(cache_path)
+                self._busy = True
+
+            try:
+                merge = in_sync is None or in_sync != _file_signature(cache_path)
+                _write_cache_file(cache_path, snapshot, merge=merge)
+                error = None
+            except Exception as e:
+                logger.error(f"Failed to write simulation checkpoint to {cache_path}: {e}")
+                error = f"{type(e).__name__}: {e}"
+
+            with self._condition:
+                if error is None:
+                    self._file_signatures[cache_path] = _file_signature(cache_path)
+                    self.writes += 1
+                    self.last_error = None
+                    self.last_checkpoint_time = time.time()
+                else:
+                    self.failures += 1
+                    self.last_error = error
+
+                self._busy = False
+                self._condition.notify_all()
+
+
+def _file_signature(path:str):
+    """
+    Returns what identifies the current version of a file (its inode, size and modification time), or None if 
+    there's no such file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+@tracing.traced("checkpoint.write", lambda cache_path, cache_json, merge=True: {"path": cache_path, "merge": merge})
+def _write_cache_file(cache_path:str, cache_json:dict, merge:bool=True):
+    """
+    Writes the given cache tree (in its JSON representation) to the given path. Since the file can be shared by 
+    different runs, unless `merge` is False, whatever is already in the file is merged with the given tree before 
+    writing, except for the nodes that the given tree removed by garbage collection. The data is flushed to disk 
+    and atomically renamed over the previous file, so the file is never left half-written.
+    """
+    # merge with the branches that other runs might have saved in the meantime
+    if merge and os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            merged_tree = SimulationCacheTree.from_json(json.load(f))
+        merged_tree.merge(SimulationCacheTree.from_json(cache_json), overwrite=True)
+        if cache_json.get("removed_nodes"):
+            merged_tree.remove(cache_json["removed_nodes"])
+        cache_json = merged_tree.to_json()
+    else:
+        cache_json = {key: value for key, value in cache_json.items() if key != "removed_nodes"}
+
+    # Create a temporary file in the same directory, so that the replacement is atomic
+    cache_dir = os.path.dirname(os.path.abspath(cache_path))
+    with tempfile.NamedTemporaryFile('w', delete=False, dir=cache_dir) as temp:
+        json.dump(cache_json, temp, indent=4)
+        temp.flush()
+        os.fsync(temp.fileno())
+
+    # Replace the original file with the temporary file
+    os.replace(temp.name, cache_path)
+
+    # make sure the rename itself is persisted too (not supported on all platforms)
+    try:
+        dir_fd = os.open(cache_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
 class Simulation:
 
     STATUS_STOPPED = "stopped"
     STATUS_STARTED = "started"
 
-    def __init__(self, id="default", cached_trace:list=None):
+    def __init__(self, id="default", cached_trace=None):
         self.id = id
 
         self.agents = []
@@ -28,6 +417,11 @@ class Simulation:
         self.name_to_factory = {} # {factory_name: factory, ...}
 
         self.name_to_environment = {} # {environment_name: environment, ...}
+
+        # the agents, environments and factories created while this simulation is the current one. These back the
+        # class-level registries (e.g., TinyPerson.all_agents), so that concurrent simulations do not see each other's entities.
+        self.registries = _empty_registries()
+
         self.status = Simulation.STATUS_STOPPED
 
         self.cache_path = f"./tinytroupe-{id}.cache.json" # default cache path
@@ -38,30 +432,30 @@ class Simulation:
         # whether there are changes not yet saved to the cache file
         self.has_unsaved_cache_changes = False
 
-        # whether the agent is under a transaction or not, used for managing
-        # simulation caching later
-        self._under_transaction = False
+        # checkpoints are written in the background, so that the simulation does not stall on disk I/O
+        self._checkpoint_writer = CheckpointWriter(name=id)
 
-        # Cache chain mechanism.
+        # Cache tree mechanism.
         # 
-        # stores a list of simulation states.
-        # Each state is a tuple (prev_node_hash, event_hash, event_output, state), where prev_node_hash is a hash of the previous node in this chain,
-        # if any, event_hash is a hash of the event that triggered the transition to this state, if any, event_output is the output of the event,
-        # if any, and state is the actual complete state that resulted.
-        if cached_trace is None:
-            self.cached_trace = []
-        else:
+        # Stores all the simulation states computed so far, across runs and branches, in a SimulationCacheTree. Each node
+        # is keyed by (parent state digest, event hash), where the parent state digest identifies the state from which the 
+        # event (i.e., transaction) was executed, and stores the output of the event and the complete state that resulted.
+        # For backward compatibility, a legacy linear trace (list) can also be given.
+        if isinstance(cached_trace, SimulationCacheTree):
             self.cached_trace = cached_trace
+        else:
+            self.cached_trace = SimulationCacheTree.from_json(cached_trace)
         
         self.cache_misses = 0
         self.cache_hits = 0
 
         # Execution chain mechanism.
         #
-        # The actual, current, execution trace. Each state is a tuple (prev_node_hash, event_hash, state), where prev_node_hash is a hash 
-        # of the previous node in this chain, if any, event_hash is a hash of the event that triggered the transition to this state, if any, 
-        # event_output is the output of the event, if any, and state is the actual complete state that resulted.
+        # The actual, current, execution trace. It is a list of the ids of the cache tree nodes visited so far, 
+        # whether they were computed or reused from the cache. It is therefore a path in the cache tree, starting 
+        # from the root. The digest of the state at the end of this path is kept in _current_state_digest.
         self.execution_trace = []
+        self._current_state_digest = SimulationCacheTree.ROOT_DIGEST
 
     def begin(self, cache_path:str=None, auto_checkpoint:bool=False):
         """
@@ -75,11 +469,6 @@ class Simulation:
 
         logger.debug(f"Starting simulation, cache_path={cache_path}, auto_checkpoint={auto_checkpoint}.")
 
-        # local import to avoid circular dependencies
-        from tinytroupe.agent import TinyPerson
-        from tinytroupe.environment import TinyWorld
-        from tinytroupe.factory.tiny_factory import TinyFactory
-
         if self.status == Simulation.STATUS_STOPPED:
             self.status = Simulation.STATUS_STARTED
         else:
@@ -92,38 +481,64 @@ class Simulation:
         self.auto_checkpoint = auto_checkpoint
 
         # clear the agents, environments and other simulated entities, we'll track them from now on
-        TinyPerson.clear_agents()
-        TinyWorld.clear_environments()
-        TinyFactory.clear_factories()
+        self.registries = _empty_registries()
 
         # All automated fresh ids will start from 0 again for this simulation
         utils.reset_fresh_id()
 
+        # the execution restarts from the root of the cache tree
+        self.execution_trace = []
+        self._current_state_digest = SimulationCacheTree.ROOT_DIGEST
+
         # load the cache file, if any
         if self.cache_path is not None:
             self._load_cache_file(self.cache_path)
 
     def end(self):
         """
-        Marks the end of the simulation being controlled.
+        Marks the end of the simulation being controlled. Waits until all pending checkpoints are written.
         """
         logger.debug("Ending simulation.")
         if self.status == Simulation.STATUS_STARTED:
             self.status = Simulation.STATUS_STOPPED
-            self.checkpoint()
+            try:
+                self.checkpoint(wait=True)
+            finally:
+                self._checkpoint_writer.close()
+
+                # what was created in the simulation remains available afterwards, as free entities
+                _release_registries(self.registries)
         else:
             raise ValueError("Simulation is already stopped.")
 
-    def checkpoint(self):
+    def checkpoint(self, wait:bool=True):
         """
-        Saves current simulation trace to a file.
+        Saves current simulation trace to a file. The actual writing happens in a background thread.
+
+        Args:
+            wait (bool, optional): Whether to wait until the checkpoint (and any other pending one) is written to disk. 
+              Defaults to True.
         """
         logger.debug("Checkpointing simulation state.")
-        # save the cache file
-        if self.has_unsaved_cache_changes:
-            self._save_cache_file(self.cache_path)
+        # save the cache file, also retrying if the last attempt failed
+        if self.has_unsaved_cache_changes or self._checkpoint_writer.last_error is not None:
+            if self.cache_path is None:
+                raise ValueError("Cannot checkpoint the simulation, since it has no cache path.")
+
+            self._checkpoint_writer.submit(self.cache_path, self.cached_trace.snapshot())
+            self.has_unsaved_cache_changes = False
         else:
             logger.debug("No unsaved cache changes to save to file.")
+        
+        if wait:
+            self._checkpoint_writer.wait_until_idle()
+
+    def checkpoint_status(self) -> dict:
+        """
+        Returns the status of the background checkpoint writer, including the number of writes, 
+        failures and the last error, if any.
+        """
+        return self._checkpoint_writer.status()
 
     def add_agent(self, agent):
         """
@@ -134,6 +549,7 @@ class Simulation:
         agent.simulation_id = self.id
         self.agents.append(agent)
         self.name_to_agent[agent.name] = agent
+        self.registries["agents"].setdefault(agent.name, agent)
 
     
     def add_environment(self, environment):
@@ -145,6 +561,7 @@ class Simulation:
         environment.simulation_id = self.id
         self.environments.append(environment)
         self.name_to_environment[environment.name] = environment
+        self.registries["environments"].setdefault(environment.name, environment)
     
     def add_factory(self, factory):
         """
@@ -155,6 +572,7 @@ class Simulation:
         factory.simulation_id = self.id
         self.factories.append(factory)
         self.name_to_factory[factory.name] = factory
+        self.registries["factories"].setdefault(factory.name, factory)
 
     ###################################################################################################
     # Cache and execution chain mechanisms
@@ -172,128 +590,118 @@ class Simulation:
         event = str((function_name, args, kwargs))
         return event
 
-    def _skip_execution_with_cache(self):
+    def _cached_node_for(self, event_hash) -> dict:
         """
-        Skips the current execution, assuming there's a cached state at the same position.
+        Returns the cached node that results from executing the given event from the current state, 
+        or None if there's no such node.
         """
-        assert len(self.cached_trace) > self._execution_trace_position() + 1, "There's no cached state at the current execution position."
-        
-        self.execution_trace.append(self.cached_trace[self._execution_trace_position() + 1])
-    
-    def _is_transaction_event_cached(self, event_hash) -> bool:
+        return self.cached_trace.get(self._current_state_digest, event_hash)
+
+    def _skip_execution_with_cache(self, event_hash) -> dict:
         """
-        Checks whether the given event hash matches the corresponding cached one, if any.
-        If there's no corresponding cached state, returns True.
-        """
-        # there's cache that could be used
-        if len(self.cached_trace) > self._execution_trace_position() + 1:
-            if self._execution_trace_position() >= -1:
-                # here's a graphical depiction of the logic:
-                #
-                # Cache:         c0:(c_prev_node_hash_0, c_event_hash_0, _,  c_state_0) ------------------> c1:(c_prev_node_hash_1, c_event_hash_1,  _,  c_state_1) -> ...
-                # Execution:     e0:(e_prev_node_hash_0, e_event_hash_0, _,  e_state_0) -<being computed>-> e1:(e_prev_node_hash_1, <being computed>, <being computed>, <being computed>)
-                #   position = 0 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
-                #
-                #   Must satisfy: 
-                #     - event_hash == c_event_hash_1
-                #     - hash(e0) == c_prev_node_hash_1
-                event_hash_match = event_hash == self.cached_trace[self._execution_trace_position() + 1][1]
-                prev_node_match = True 
-
-                return event_hash_match and prev_node_match
-            
-            else: 
-                raise ValueError("Execution trace position is invalid, must be >= -1, but is ", self._execution_trace_position())
-        
-        else: # no cache to use
-            return False
+        Skips the current execution, assuming there's a cached state for the given event at the current position.
+        Returns the corresponding cached node.
+        """
+        node_id = SimulationCacheTree.node_id_for(self._current_state_digest, event_hash)
+        assert node_id in self.cached_trace.nodes, "There's no cached state at the current execution position."
+
+        self.cached_trace.touch(node_id)
+        self._add_to_execution_trace(node_id)
+
+        return self.cached_trace.nodes[node_id]
     
-    def _drop_cached_trace_suffix(self):
+    def _is_transaction_event_cached(self, event_hash) -> bool:
         """
-        Drops the cached trace suffix starting at the current execution trace position. This effectively
-        refreshes the cache to the current execution state and starts building a new cache from there.
+        Checks whether the given event, executed from the current state, is in the cache tree.
         """
-        self.cached_trace = self.cached_trace[:self._execution_trace_position()+1]
+        return self._cached_node_for(event_hash) is not None
         
-    def _add_to_execution_trace(self, state: dict, event_hash: int, event_output):
+    def _add_to_execution_trace(self, node_id:str):
         """
-        Adds a state to the execution_trace list and computes the appropriate hash.
-        The computed hash is compared to the hash of the cached trace at the same position,
-        and if they don't match, the execution is aborted. Similarly, the event_hash is compared
-        to the hash of the event in the cached trace at the same position, and if they don't match, the execution
-        is aborted.
+        Advances the execution trace to the given cache tree node.
         """
-        
-        # Compute the hash of the previous execution pair, if any
-        previous_hash = None
-
-        # Create a tuple of (hash, state) and append it to the execution_trace list
-        self.execution_trace.append((previous_hash, event_hash, event_output, state))
+        self.execution_trace.append(node_id)
+        self._current_state_digest = self.cached_trace.nodes[node_id]["state_digest"]
 
-    def _add_to_cache_trace(self, state: dict, event_hash: int, event_output):
+    def _add_to_cache_trace(self, state: dict, event_hash: int, event_output) -> str:
         """
-        Adds a state to the cached_trace list and computes the appropriate hash.
+        Adds a state to the cache tree, as a child of the current state, and returns the id of the new node.
+        Any other branches leaving the current state are preserved.
         """
-        # Compute the hash of the previous cached pair, if any
-        previous_hash = None
-        if self.cached_trace:
-            previous_hash = utils.custom_hash(self.cached_trace[-1])
-        
-        # Create a tuple of (hash, state) and append it to the cached_trace list
-        self.cached_trace.append((previous_hash, event_hash, event_output, state))
+        node_id = self.cached_trace.add(self._current_state_digest, event_hash, event_output, state)
 
         self.has_unsaved_cache_changes = True
+
+        return node_id
+
+    def collect_cache_garbage(self, only_current_branch:bool=False, max_age:float=None) -> int:
+        """
+        Removes unreachable branches from the cache tree.
+
+        Args:
+            only_current_branch (bool, optional): If True, keeps only the current execution path and whatever was cached
+              beyond it, dropping all other branches. Defaults to False.
+            max_age (float, optional): If given, also drops branches that have not been used in the last `max_age` seconds.
+              The current execution path is always kept.
+
+        Returns:
+            int: The number of removed nodes.
+        """
+        current_path = set(self.execution_trace)
+        retain = None
+        if only_current_branch:
+            retain = current_path | self.cached_trace.descendants_of(self._current_state_digest)
+        elif max_age is not None:
+            # the current path must survive age-based collection, but everything else is eligible 
+            for node_id in current_path:
+                if node_id in self.cached_trace.nodes:
+                    self.cached_trace.touch(node_id)
+
+        removed = self.cached_trace.collect_garbage(retain=retain, max_age=max_age)
+
+        if removed > 0:
+            self.has_unsaved_cache_changes = True
+
+        return removed
     
+    @tracing.traced("checkpoint.load", lambda self, cache_path: {"path": cache_path})
     def _load_cache_file(self, cache_path:str):
         """
         Loads the cache file from the given path.
         """
+        # taken before reading, so that any change made in the meantime is still merged when saving
+        signature = _file_signature(cache_path)
         try:
-            self.cached_trace = json.load(open(cache_path, "r"))
+            with open(cache_path, "r") as f:
+                self.cached_trace = SimulationCacheTree.from_json(json.load(f))
+            self._checkpoint_writer.mark_in_sync(cache_path, signature)
         except FileNotFoundError:
             logger.info(f"Cache file not found on path: {cache_path}.")
-            self.cached_trace = []
+            self.cached_trace = SimulationCacheTree()
         
-    def _save_cache_file(self, cache_path:str):
-        """
-        Saves the cache file to the given path. Always overwrites.
-        """
-        try:
-            # Create a temporary file
-            with tempfile.NamedTemporaryFile('w', delete=False) as temp:
-                json.dump(self.cached_trace, temp, indent=4)
-
-            # Replace the original file with the temporary file
-            os.replace(temp.name, cache_path)
-        except Exception as e:
-            print(f"An error occurred: {e}")
-
-        self.has_unsaved_cache_changes = False
-
-    
-
     ###################################################################################################
     # Transactional control
     ###################################################################################################
 
     def begin_transaction(self):
         """
-        Starts a transaction.
+        Starts a transaction, in the current context only.
         """
-        self._under_transaction = True
+        _simulations_under_transaction.set(_simulations_under_transaction.get() | {self.id})
         self._clear_communications_buffers() # TODO <----------------------------------------------------------------
     
     def end_transaction(self):
         """
-        Ends a transaction.
+        Ends a transaction, in the current context.
         """
-        self._under_transaction = False
+        _simulations_under_transaction.set(_simulations_under_transaction.get() - {self.id})
     
     def is_under_transaction(self):
         """
-        Checks if the agent is under a transaction.
+        Checks if the simulation is under a transaction in the current context. Other threads running under the same 
+        simulation (e.g., through in_current_context()) only are if they were started from within that transaction.
         """
-        return self._under_transaction
+        return self.id in _simulations_under_transaction.get()
 
     def _clear_communications_buffers(self):
         """
@@ -308,6 +716,7 @@ class Simulation:
     # Simulation state handling
     ###################################################################################################
     
+    @tracing.traced("Transaction.encode_state")
     def _encode_simulation_state(self) -> dict:
         """
         Encodes the current simulation state, including agents, environments, and other
@@ -332,6 +741,7 @@ class Simulation:
                 
         return state
         
+    @tracing.traced("Transaction.decode_state")
     def _decode_simulation_state(self, state: dict):
         """
         Decodes the given simulation state, including agents, environments, and other
@@ -344,10 +754,11 @@ class Simulation:
         from tinytroupe.agent import TinyPerson
         from tinytroupe.environment import TinyWorld
 
-        logger.debug(f"Decoding simulation state: {state['factories']}")
-        logger.debug(f"Registered factories: {self.name_to_factory}")
-        logger.debug(f"Registered agents: {self.name_to_agent}")
-        logger.debug(f"Registered environments: {self.name_to_environment}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Decoding simulation state: %s", state['factories'])
+            logger.debug("Registered factories: %s", self.name_to_factory)
+            logger.debug("Registered agents: %s", self.name_to_agent)
+            logger.debug("Registered environments: %s", self.name_to_environment)
 
         # Decode factories
         for factory_state in state["factories"]:
@@ -405,12 +816,12 @@ class Transaction:
                     raise ValueError(f"Object {obj_under_transaction} is already captured by a different simulation (id={obj_under_transaction.simulation_id}), \
                                     and cannot be captured by simulation id={simulation.id}.")
                 
-                logger.debug(f">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Object {obj_under_transaction} is already captured by simulation {simulation.id}.")
+                logger.debug(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Object %s is already captured by simulation %s.", obj_under_transaction, simulation.id)
             else:
                 # if is a TinyPerson, add the agent to the simulation
                 if isinstance(obj_under_transaction, TinyPerson):
                     simulation.add_agent(obj_under_transaction)
-                    logger.debug(f">>>>>>>>>>>>>>>>>>>>>>> Added agent {obj_under_transaction} to simulation {simulation.id}.")
+                    logger.debug(">>>>>>>>>>>>>>>>>>>>>>> Added agent %s to simulation %s.", obj_under_transaction, simulation.id)
 
                 # if is a TinyWorld, add the environment to the simulation
                 elif isinstance(obj_under_transaction, TinyWorld):
@@ -419,7 +830,7 @@ class Transaction:
                 # if is a TinyFactory, add the factory to the simulation
                 elif isinstance(obj_under_transaction, TinyFactory):
                     simulation.add_factory(obj_under_transaction)
-                    logger.debug(f">>>>>>>>>>>>>>>>>>>>>>> Added factory {obj_under_transaction} to simulation {simulation.id}.")
+                    logger.debug(">>>>>>>>>>>>>>>>>>>>>>> Added factory %s to simulation %s.", obj_under_transaction, simulation.id)
 
                 else:
                     raise ValueError(f"Object {obj_under_transaction} (type = {type(obj_under_transaction)}) is not a TinyPerson or TinyWorld instance, and cannot be captured by the simulation.")
@@ -435,56 +846,54 @@ class Transaction:
             output = self.function(*self.args, **self.kwargs)
         
         elif self.simulation.status == Simulation.STATUS_STARTED:
-            # Compute the event hash
-            event_hash = self.simulation._function_call_hash(self.function_name, *self.args, **self.kwargs)
+            # reentrant transactions are not cached, since what matters is the final result of
+            # the top-level transaction
+            if self.simulation.is_under_transaction():
+                output = self.function(*self.args, **self.kwargs)
 
-            # Check if the event hash is in the cache
-            if self.simulation._is_transaction_event_cached(event_hash):
-                self.simulation.cache_hits += 1
+            else:
+                # Compute the event hash
+                event_hash = self.simulation._function_call_hash(self.function_name, *self.args, **self.kwargs)
 
-                # Restore the full state and return the cached output
-                logger.info(f"Skipping execution of {self.function_name} with args {self.args} and kwargs {self.kwargs} because it is already cached.")
+                # Check if the event hash is in the cache, starting from the current state
+                if self.simulation._is_transaction_event_cached(event_hash):
+                    self.simulation.cache_hits += 1
 
-                self.simulation._skip_execution_with_cache()
-                state = self.simulation.cached_trace[self.simulation._execution_trace_position()][3] # state
-                self.simulation._decode_simulation_state(state)
-                
-                # Output encoding/decoding is used to preserve references to TinyPerson and TinyWorld instances
-                # mainly. Scalar values (int, float, str, bool) and composite values (list, dict) are 
-                # encoded/decoded as is.
-                encoded_output = self.simulation.cached_trace[self.simulation._execution_trace_position()][2] # output
-                output = self._decode_function_output(encoded_output)
-
-            else: # not cached
-                self.simulation.cache_misses += 1
-                
-                # reentrant transactions are not cached, since what matters is the final result of
-                # the top-level transaction
-                if not self.simulation.is_under_transaction():
-                    self.simulation.begin_transaction()
+                    # Restore the full state and return the cached output
+                    logger.info("Skipping execution of %s with args %s and kwargs %s because it is already cached.", self.function_name, self.args, self.kwargs)
 
-                    # immediately drop the cached trace suffix, since we are starting a new execution from this point on
-                    self.simulation._drop_cached_trace_suffix()
+                    cached_node = self.simulation._skip_execution_with_cache(event_hash)
+                    self.simulation._decode_simulation_state(cached_node["state"])
                     
-                    # Compute the function, cache the result and return it
-                    output = self.function(*self.args, **self.kwargs)
-
-                    encoded_output = self._encode_function_output(output)
-                    state = self.simulation._encode_simulation_state()
-                                  
-                    self.simulation._add_to_cache_trace(state, event_hash, encoded_output)
-                    self.simulation._add_to_execution_trace(state, event_hash, encoded_output)
+                    # Output encoding/decoding is used to preserve references to TinyPerson and TinyWorld instances
+                    # mainly. Scalar values (int, float, str, bool) and composite values (list, dict) are 
+                    # encoded/decoded as is.
+                    output = self._decode_function_output(cached_node["event_output"])
 
-                    self.simulation.end_transaction()
+                else: # not cached
+                    self.simulation.cache_misses += 1
+                    
+                    self.simulation.begin_transaction()
+                    try:
+                        # Compute the function, cache the result and return it. There's no need to drop
+                        # anything from the cache, since the new state just becomes a new branch in the cache tree.
+                        output = self.function(*self.args, **self.kwargs)
+
+                        encoded_output = self._encode_function_output(output)
+                        state = self.simulation._encode_simulation_state()
+                                    
+                        node_id = self.simulation._add_to_cache_trace(state, event_hash, encoded_output)
+                        self.simulation._add_to_execution_trace(node_id)
+
+                    finally:
+                        self.simulation.end_transaction()
                 
-                else: # reentrant transactions are just run, but not cached
-                    output = self.function(*self.args, **self.kwargs)
         else:
             raise ValueError(f"Simulation status is invalid at this point: {self.simulation.status}")
 
-        # Checkpoint if needed
+        # Checkpoint if needed, without waiting for the disk
         if self.simulation is not None and self.simulation.auto_checkpoint:
-            self.simulation.checkpoint()
+            self.simulation.checkpoint(wait=False)
 
         return output
   
@@ -542,12 +951,21 @@ def transactional(func):
     """
     A helper decorator that makes a function simulation-transactional.
     """
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         obj_under_transaction = args[0]
         simulation = current_simulation()
-        obj_sim_id = obj_under_transaction.simulation_id if hasattr(obj_under_transaction, 'simulation_id') else None
 
-        logger.debug(f"-----------------------------------------> Transaction: {func.__name__} with args {args[1:]} and kwargs {kwargs} under simulation {obj_sim_id}.")
+        # Fast path: if there's no simulation running, or if this is a reentrant call on an object that is already 
+        # captured by the simulation, a transaction would just call the function. So we do it directly.
+        if simulation is None or \
+           (simulation.is_under_transaction() and getattr(obj_under_transaction, 'simulation_id', None) == simulation.id):
+            return func(*args, **kwargs)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            obj_sim_id = getattr(obj_under_transaction, 'simulation_id', None)
+            logger.debug("-----------------------------------------> Transaction: %s with args %s and kwargs %s under simulation %s.", 
+                         func.__name__, args[1:], kwargs, obj_sim_id)
         
         transaction = Transaction(obj_under_transaction, simulation, func, *args, **kwargs)
         result = transaction.execute()
@@ -579,66 +997,191 @@ def reset():
     """	
     Resets the entire simulation control state.
     """
-    global _current_simulations, _current_simulation_id
-    _current_simulations = {"default": None}
+    global _current_simulations
+    with _simulations_lock:
+        _current_simulations = {"default": None}
+        for entities in _free_registries.values():
+            entities.clear()
 
-    # TODO Currently, only one simulation can be started at a time. In future versions, this should be
-    #      changed to allow multiple simulations to be started at the same time, e.g., for fast
-    #      analyses through parallelization.
-    _current_simulation_id = None
+    _current_simulation_id.set(None)
 
 def _simulation(id="default"):
-    global _current_simulations
-    if _current_simulations[id] is None:
-        _current_simulations[id] = Simulation()
+    with _simulations_lock:
+        if _current_simulations.get(id) is None:
+            _current_simulations[id] = Simulation(id=id)
     
-    return _current_simulations[id]
+        return _current_simulations[id]
+
+def _resolve_simulation_id(id=None):
+    """
+    Returns the given simulation id or, if None, the id of the simulation running in the current context 
+    (or "default" if there's none).
+    """
+    if id is not None:
+        return id
+    
+    current_id = _current_simulation_id.get()
+    return current_id if current_id is not None else "default"
 
 def begin(cache_path=None, id="default", auto_checkpoint=False):
     """
-    Marks the start of the simulation being controlled.
+    Marks the start of the simulation being controlled. Simulations with different ids can run concurrently,
+    as long as each runs in its own context (e.g., its own thread or asyncio task).
     """
-    global _current_simulation_id
-    if _current_simulation_id is None:
-        _simulation(id).begin(cache_path, auto_checkpoint)
-        _current_simulation_id = id
-    else:
-        raise ValueError(f"Simulation is already started under id {_current_simulation_id}. Currently only one simulation can be started at a time.")   
+    current_id = _current_simulation_id.get()
+    if current_id is not None:
+        raise ValueError(f"Simulation is already started under id {current_id} in this context. Only one simulation can be started per context (e.g., thread).")
     
-def end(id="default"):
+    simulation = _simulation(id)
+    token = _current_simulation_id.set(id)
+    try:
+        simulation.begin(cache_path, auto_checkpoint)
+    except Exception:
+        _current_simulation_id.reset(token)
+        raise
+    
+def end(id=None):
     """
     Marks the end of the simulation being controlled.
     """
-    global _current_simulation_id
+    id = _resolve_simulation_id(id)
     _simulation(id).end()
-    _current_simulation_id = None
+    
+    if _current_simulation_id.get() == id:
+        _current_simulation_id.set(None)
 
-def checkpoint(id="default"):
+def checkpoint(id=None):
     """
     Saves current simulation state.
     """
-    _simulation(id).checkpoint()
+    _simulation(_resolve_simulation_id(id)).checkpoint()
+
+def checkpoint_status(id=None):
+    """
+    Returns the status of the background checkpoint writer.
+    """
+    return _simulation(_resolve_simulation_id(id)).checkpoint_status()
 
 def current_simulation():
     """
-    Returns the current simulation.
+    Returns the simulation running in the current context, if any.
     """
-    global _current_simulation_id
-    if _current_simulation_id is not None:
-        return _simulation(_current_simulation_id)
-    else:
+    current_id = _current_simulation_id.get()
+    if current_id is None:
         return None
 
-def cache_hits(id="default"):
+    # this is called on every transaction, so we avoid taking the lock when the simulation already exists
+    simulation = _current_simulations.get(current_id)
+    return simulation if simulation is not None else _simulation(current_id)
+
+def cache_hits(id=None):
     """
     Returns the number of cache hits.
     """
-    return _simulation(id).cache_hits
+    return _simulation(_resolve_simulation_id(id)).cache_hits
 
-def cache_misses(id="default"):
+def cache_misses(id=None):
     """
     Returns the number of cache misses.
     """
-    return _simulation(id).cache_misses
+    return _simulation(_resolve_simulation_id(id)).cache_misses
+
+def collect_cache_garbage(id=None, only_current_branch=False, max_age=None):
+    """
+    Removes unreachable branches from the simulation cache tree. Returns the number of removed nodes.
+    """
+    return _simulation(_resolve_simulation_id(id)).collect_cache_garbage(only_current_branch=only_current_branch, max_age=max_age)
+
+def discard(id:str):
+    """
+    Forgets a stopped simulation, releasing its agents, environments, factories and cache from memory. 
+    Useful for long-lived processes that run many simulations one after the other.
+    """
+    with _simulations_lock:
+        simulation = _current_simulations.get(id)
+        if simulation is not None and simulation.status == Simulation.STATUS_STARTED:
+            raise ValueError(f"Simulation {id} is still running, and cannot be discarded.")
+
+        if simulation is not None:
+            simulation._checkpoint_writer.close()
+        
+        if id == "default":
+            _current_simulations[id] = None
+        else:
+            _current_simulations.pop(id, None)
+
+
+###################################################################################################
+# Simulation-scoped registries
+###################################################################################################
+
+def _empty_registries() -> dict:
+    return {"agents": {}, "environments": {}, "factories": {}}
+
+# entities created while no simulation is running in the current context, plus those of the simulations that ended
+_free_registries = _empty_registries()
+
+def _release_registries(registries:dict):
+    """
+    Makes the entities of a simulation that ended available as free entities, so that they can still be looked up 
+    (e.g., with TinyPerson.get_agent_by_name()) from any context once the simulation is over.
+    """
+    with _simulations_lock:
+        for kind, entities in registries.items():
+            _free_registries[kind].update(entities)
+
+def registry(kind:str) -> dict:
+    """
+    Returns the registry of the given kind ("agents", "environments" or "factories") for the current context.
+    That is, the registry of the simulation running in the current context or, if there's none, the registry
+    of free entities.
+    """
+    current_id = _current_simulation_id.get()
+    if current_id is not None:
+        simulation = _current_simulations.get(current_id)
+        if simulation is not None:
+            return simulation.registries[kind]
+    
+    return _free_registries[kind]
+
+def in_current_context(func):
+    """
+    Returns a function that calls the given one within a copy of the current context, wherever it is called from. 
+    Threads do not inherit the context they are started from, so this is how work handed to another thread (e.g., 
+    threading.Thread(target=control.in_current_context(f))) keeps running under the same simulation, and keeps the
+    same metrics labels and trace spans.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # each call gets its own copy, since a context cannot be entered by several threads at once
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+class ScopedRegistry:
+    """
+    A class attribute descriptor that resolves to the registry of the given kind for the current context. 
+    This allows, e.g., TinyPerson.all_agents to keep working as a plain dict, while being separate for 
+    each concurrently running simulation.
+    """
+
+    def __init__(self, kind:str):
+        self.kind = kind
     
+    def __get__(self, instance, owner) -> dict:
+        return registry(self.kind)
+
+# the id of the simulation running in the current context (thread, asyncio task, etc.), if any
+_current_simulation_id = contextvars.ContextVar("tinytroupe_current_simulation_id", default=None)
+
+# the ids of the simulations with a transaction running in the current context. This is per context, rather than per
+# simulation, so that a top-level transaction of one thread is not mistaken for a reentrant call of another's.
+_simulations_under_transaction = contextvars.ContextVar("tinytroupe_simulations_under_transaction", default=frozenset())
+
+# all simulations known so far, by id
+_current_simulations = {"default": None}
+_simulations_lock = threading.RLock()
+
 reset() # initialize the control state
\ No newline at end of file
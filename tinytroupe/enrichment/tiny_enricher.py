@@ -24,7 +24,7 @@ class TinyEnricher(JsonSerializableRegistry):
                                                                      base_module_folder = "enrichment",
                                                                      rendering_configs=rendering_configs)
         
-        next_message = litellm_utils.client().send_message(messages, temperature=1.0, frequency_penalty=0.0, presence_penalty=0.0)
+        next_message = litellm_utils.client().send_message(messages, frequency_penalty=0.0, presence_penalty=0.0, call_site="enrichment")
         
         debug_msg = f"Enrichment result message: {next_message}"
         logger.debug(debug_msg)
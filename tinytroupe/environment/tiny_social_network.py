@@ -15,7 +15,10 @@ AgentOrWorld = Union["TinyPerson", "TinyWorld"]
 
 class TinySocialNetwork(TinyWorld):
 
-    def __init__(self, name, broadcast_if_no_target=True):
+    # relations refer to agents, so they are encoded by agent names instead
+    fields_encoded_separately = TinyWorld.fields_encoded_separately + ["relations", "_adjacency"]
+
+    def __init__(self, name, broadcast_if_no_target=True, scheduling=TinyWorld.SCHEDULING_ALL, idle_wakeup_interval=None):
         """
         Create a new TinySocialNetwork environment.
 
@@ -23,11 +26,17 @@ class TinySocialNetwork(TinyWorld):
             name (str): The name of the environment.
             broadcast_if_no_target (bool): If True, broadcast actions through an agent's available relations
               if the target of an action is not found.
+            scheduling (str): Which agents act at each step. See TinyWorld.
+            idle_wakeup_interval (int, optional): The maximum number of steps an agent can stay idle under event-driven scheduling. See TinyWorld.
         """
         
-        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target)
+        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target, 
+                         scheduling=scheduling, idle_wakeup_interval=idle_wakeup_interval)
 
         self.relations = {}
+
+        # Adjacency index, for fast lookups: {relation_name: {agent_name: set(neighbor_names)}}
+        self._adjacency = {}
     
     @transactional
     def add_relation(self, agent_1, agent_2, name="default"):
@@ -40,44 +49,76 @@ class TinySocialNetwork(TinyWorld):
             name (str): The name of the relation.
         """
 
-        logger.debug(f"Adding relation {name} between {agent_1.name} and {agent_2.name}.")
+        logger.debug("Adding relation %s between %s and %s.", name, agent_1.name, agent_2.name)
 
         # agents must already be in the environment, if not they are first added
-        if agent_1 not in self.agents:
-            self.agents.append(agent_1)
-        if agent_2 not in self.agents:
-            self.agents.append(agent_2)
+        if agent_1.name not in self.name_to_agent:
+            self.add_agent(agent_1)
+        if agent_2.name not in self.name_to_agent:
+            self.add_agent(agent_2)
 
         if name in self.relations:
             self.relations[name].append((agent_1, agent_2))
         else:
             self.relations[name] = [(agent_1, agent_2)]
+        
+        adjacency = self._adjacency.setdefault(name, {})
+        adjacency.setdefault(agent_1.name, set()).add(agent_2.name)
+        adjacency.setdefault(agent_2.name, set()).add(agent_1.name)
 
         return self # for chaining
     
     @transactional
-    def _update_agents_contexts(self):
+    def remove_relation(self, agent_1, agent_2, name="default"):
         """
-        Updates the agents' observations based on the current state of the world.
+        Removes a relation between two agents, if it exists.
+
+        Args:
+            agent_1 (TinyPerson): The first agent.
+            agent_2 (TinyPerson): The second agent.
+            name (str): The name of the relation.
         """
+        logger.debug("Removing relation %s between %s and %s.", name, agent_1.name, agent_2.name)
+
+        if name in self.relations:
+            self.relations[name] = [(a, b) for a, b in self.relations[name] 
+                                    if (a, b) != (agent_1, agent_2) and (a, b) != (agent_2, agent_1)]
+            
+            adjacency = self._adjacency[name]
+            adjacency.get(agent_1.name, set()).discard(agent_2.name)
+            adjacency.get(agent_2.name, set()).discard(agent_1.name)
+
+        return self # for chaining
 
-        # clear all accessibility first
+    @transactional
+    def _update_agents_contexts(self):
+        """
+        Updates the agents' observations based on the current state of the world. Each agent's accessibility is 
+        compared with the one implied by the relations, and only what differs is changed. Since it is the agents' 
+        actual accessibility that is compared, changes made to it from outside the network are undone too.
+        """
         for agent in self.agents:
-            agent.make_all_agents_inaccessible()
+            # the accessibility implied by the relations, among the agents currently in the network
+            neighbors = (self.get_agent_by_name(name) for name in self.neighbors_of(agent))
+            target = {neighbor.name: neighbor for neighbor in neighbors if neighbor is not None}
+
+            if agent._mental_state["everyone_accessible"] is not None:
+                # only the relations grant accessibility here
+                agent.make_all_agents_inaccessible()
 
-        # now update accessibility based on relations
-        for relation_name, relation in self.relations.items():
-            logger.debug(f"Updating agents' observations for relation {relation_name}.")
-            for agent_1, agent_2 in relation:
-                agent_1.make_agent_accessible(agent_2)
-                agent_2.make_agent_accessible(agent_1)
+            current = agent._accessible_agents
+            for other_name in [name for name, other in current.items() if target.get(name) is not other]:
+                agent.make_agent_inaccessible(current[other_name])
+            
+            for other_name in target.keys() - current.keys():
+                agent.make_agent_accessible(target[other_name])
 
     @transactional
-    def _step(self):
+    def _step(self, timedelta_per_step=None):
         self._update_agents_contexts()
 
         #call super
-        super()._step()
+        return super()._step(timedelta_per_step=timedelta_per_step)
     
     @transactional
     def _handle_reach_out(self, source_agent: TinyPerson, content: str, target: str):
@@ -119,14 +160,59 @@ class TinySocialNetwork(TinyWorld):
         Returns:
             bool: True if the two agents are in the given relation, False otherwise.
         """
-        if relation_name is None:
-            for relation_name, relation in self.relations.items():
-                if (agent_1, agent_2) in relation or (agent_2, agent_1) in relation:
-                    return True
+        if agent_1 is None or agent_2 is None:
             return False
         
+        if relation_name is None:
+            return any(agent_2.name in adjacency.get(agent_1.name, ()) for adjacency in self._adjacency.values())
+        
         else:
-            if relation_name in self.relations:
-                return (agent_1, agent_2) in self.relations[relation_name] or (agent_2, agent_1) in self.relations[relation_name]
-            else:
-                return False
\ No newline at end of file
+            return agent_2.name in self._adjacency.get(relation_name, {}).get(agent_1.name, ())
+
+    def neighbors_of(self, agent:TinyPerson, relation_name=None) -> set:
+        """
+        Returns the names of the agents that are in a relation with the specified agent. If the relation name is given, 
+        only that relation is considered, otherwise all relations are.
+
+        Args:
+            agent (TinyPerson): The agent.
+            relation_name (str): The name of the relation to consider, or None to consider all relations.
+
+        Returns:
+            set: The names of the related agents.
+        """
+        if relation_name is not None:
+            return set(self._adjacency.get(relation_name, {}).get(agent.name, ()))
+        
+        neighbors = set()
+        for adjacency in self._adjacency.values():
+            neighbors.update(adjacency.get(agent.name, ()))
+        return neighbors
+
+    #######################################################################
+    # Serialization
+    #######################################################################
+
+    def encode_complete_state(self) -> dict:
+        """
+        Encodes the complete state of the social network. Relations are encoded by agent names.
+        """
+        state = super().encode_complete_state()
+
+        state["relations"] = {name: [(a.name, b.name) for a, b in relation] for name, relation in self.relations.items()}
+        state["_adjacency"] = {name: {agent_name: sorted(neighbors) for agent_name, neighbors in index.items()} 
+                               for name, index in self._adjacency.items()}
+        
+        return state
+
+    def decode_complete_state(self, state:dict):
+        """
+        Decodes the complete state of the social network.
+        """
+        super().decode_complete_state(state)
+
+        self.relations = {name: [(TinyPerson.get_agent_by_name(a), TinyPerson.get_agent_by_name(b)) for a, b in relation] 
+                          for name, relation in self.relations.items()}
+        self._adjacency = {name: {agent_name: set(neighbors) for agent_name, neighbors in index.items()} for name, index in self._adjacency.items()}
+        
+        return self
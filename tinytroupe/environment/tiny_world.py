@@ -7,8 +7,9 @@ import textwrap
 from tinytroupe.agent import *
 from tinytroupe.utils import name_or_empty, pretty_datetime
 import tinytroupe.control as control
-from tinytroupe.control import transactional
+from tinytroupe.control import transactional, ScopedRegistry
 from tinytroupe import utils
+import tinytroupe.tracing as tracing
  
 from rich.console import Console
 
@@ -21,16 +22,25 @@ class TinyWorld:
     """
 
     # A dict of all environments created so far.
-    all_environments = {} # name -> environment
+    all_environments = ScopedRegistry("environments") # name -> environment, for the simulation running in the current context
 
     # Whether to display environments communications or not, for all environments. 
     communication_display = True
 
+    # Fields that encode_complete_state() leaves out, for subclasses to encode themselves (e.g., fields that refer to agents).
+    fields_encoded_separately = []
+
+    # Scheduling policies: either all agents act at every step, or only those that have something to react to.
+    SCHEDULING_ALL = "all"
+    SCHEDULING_EVENT_DRIVEN = "event_driven"
+
     def __init__(self, name: str="A TinyWorld", agents=[], 
                  initial_datetime=datetime.now(),
                  interventions=[],
                  broadcast_if_no_target=True,
-                 max_additional_targets_to_display=3):
+                 max_additional_targets_to_display=3,
+                 scheduling=SCHEDULING_ALL,
+                 idle_wakeup_interval=None):
         """
         Initializes an environment.
 
@@ -43,6 +53,11 @@ class TinyWorld:
             broadcast_if_no_target (bool): If True, broadcast actions if the target of an action is not found.
             max_additional_targets_to_display (int): The maximum number of additional targets to display in a communication. If None, 
                 all additional targets are displayed.
+            scheduling (str): Which agents act at each step. With TinyWorld.SCHEDULING_ALL (the default), all agents act at every step. 
+                With TinyWorld.SCHEDULING_EVENT_DRIVEN, only agents that received stimuli since they last acted, or that requested a turn,
+                will act. This saves LLM calls when only a few agents are actually interacting.
+            idle_wakeup_interval (int, optional): Under event-driven scheduling, the maximum number of steps an agent can stay idle before 
+                it is given a turn anyway. If None, idle agents are never woken up. Can be overridden per agent with set_idle_wakeup_interval().
         """
 
         self.name = name
@@ -55,6 +70,16 @@ class TinyWorld:
 
         self._interventions = interventions
 
+        if scheduling not in [TinyWorld.SCHEDULING_ALL, TinyWorld.SCHEDULING_EVENT_DRIVEN]:
+            raise ValueError(f"Unknown scheduling policy: {scheduling}.")
+        self.scheduling = scheduling
+        self.idle_wakeup_interval = idle_wakeup_interval
+        self._idle_wakeup_intervals = {} # {agent_name: interval, ...}, overriding the default above
+        self._steps_since_last_turn = {} # {agent_name: steps, ...}
+
+        # channels (e.g., rooms or topics) that agents can subscribe to, in order to receive the messages published there
+        self._channels = {} # {channel: [agent_name, agent_name_2, ...], ...}
+
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
         self._displayed_communications_buffer = []
@@ -73,6 +98,7 @@ class TinyWorld:
     #######################################################################
     # Simulation control methods
     #######################################################################
+    @tracing.traced("TinyWorld._step", lambda self, *args, **kwargs: {"world": self.name, "datetime": self.current_datetime})
     @transactional
     def _step(self, timedelta_per_step=None):
         """
@@ -96,16 +122,53 @@ class TinyWorld:
                 
                 logger.debug(f"[{self.name}] Intervention '{intervention.name}' was applied.")
 
-        # agents can act
+        # agents can act. Whether an agent should act is decided right before its turn, so that it can 
+        # react to what the previous agents did in this same step.
         agents_actions = {}
         for agent in self.agents:
-            logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting.")
+            if not self._should_act(agent):
+                self._steps_since_last_turn[agent.name] = self._steps_since_last_turn.get(agent.name, 0) + 1
+                logger.debug("[%s] Agent %s has nothing to react to, skipping its turn.", self.name, agent.name)
+                continue
+
+            logger.debug("[%s] Agent %s is acting.", self.name, name_or_empty(agent))
             actions = agent.act(return_actions=True)
             agents_actions[agent.name] = actions
+            self._steps_since_last_turn[agent.name] = 0
 
-            self._handle_actions(agent, agent.pop_latest_actions())
+            self._handle_actions(agent, self._pop_unhandled_actions(agent))
         
         return agents_actions
+
+    def _should_act(self, agent: TinyPerson) -> bool:
+        """
+        Decides whether the specified agent should act in the current step, according to the scheduling policy.
+        """
+        if self.scheduling == TinyWorld.SCHEDULING_ALL:
+            return True
+        
+        # event-driven: new stimuli or an explicit request for a turn
+        if agent.has_unprocessed_stimuli() or agent.has_requested_turn():
+            return True
+        
+        # event-driven: idle for too long
+        interval = self._idle_wakeup_intervals.get(agent.name, self.idle_wakeup_interval)
+        if interval is not None and self._steps_since_last_turn.get(agent.name, 0) + 1 >= interval:
+            return True
+
+        return False
+
+    def set_idle_wakeup_interval(self, agent: TinyPerson, interval: int):
+        """
+        Sets the maximum number of steps the specified agent can stay idle before it is given a turn anyway,
+        under event-driven scheduling. If None, the agent is never woken up when idle.
+
+        Args:
+            agent (TinyPerson): The agent.
+            interval (int): The interval, in steps.
+        """
+        self._idle_wakeup_intervals[agent.name] = interval
+        return self # for chaining
         
 
     def _advance_datetime(self, timedelta):
@@ -321,6 +384,10 @@ class TinyWorld:
         self.agents.remove(agent)
         del self.name_to_agent[agent.name]
 
+        for subscribers in self._channels.values():
+            if agent.name in subscribers:
+                subscribers.remove(agent.name)
+
         return self # for chaining
     
     def remove_all_agents(self):
@@ -330,6 +397,7 @@ class TinyWorld:
         logger.debug(f"Removing all agents from the environment.")
         self.agents = []
         self.name_to_agent = {}
+        self._channels = {channel: [] for channel in self._channels}
 
         return self # for chaining
 
@@ -384,7 +452,7 @@ class TinyWorld:
             content = action["content"] if "content" in action else None
             target = action["target"] if "target" in action else None
 
-            logger.debug(f"[{self.name}] Handling action {action_type} from agent {name_or_empty(source)}. Content: {content}, target: {target}.")
+            logger.debug("[%s] Handling action %s from agent %s. Content: %s, target: %s.", self.name, action_type, name_or_empty(source), content, target)
 
             # only some actions require the enviroment to intervene
             if action_type == "REACH_OUT":
@@ -392,6 +460,25 @@ class TinyWorld:
             elif action_type == "TALK":
                 self._handle_talk(source, content, target)
 
+    @transactional
+    def _handle_early_action(self, source: TinyPerson, action: dict):
+        """
+        Handles an action as soon as it is complete, while the rest of the agent's response is still being produced
+        (i.e., streamed), so that its effects (e.g., delivering a TALK) are not delayed. The action is then skipped 
+        when the agent's actions are handled at the end of its turn.
+
+        Args:
+            source (TinyPerson): The agent that issued the action.
+            action (dict): The action, as a JSON specification.
+        """
+        self._handle_actions(source, [action])
+
+    def _pop_unhandled_actions(self, agent: TinyPerson) -> list:
+        """
+        Pops the latest actions of the specified agent, except those that were already handled while being produced.
+        """
+        return agent.pop_latest_actions(skip_early_dispatched=True)
+
     @transactional
     def _handle_reach_out(self, source_agent: TinyPerson, content: str, target: str):
         """
@@ -429,10 +516,12 @@ class TinyWorld:
         """
         target_agent = self.get_agent_by_name(target)
 
-        logger.debug(f"[{self.name}] Delivering message from {name_or_empty(source_agent)} to {name_or_empty(target_agent)}.")
+        logger.debug("[%s] Delivering message from %s to %s.", self.name, name_or_empty(source_agent), name_or_empty(target_agent))
 
         if target_agent is not None:
             target_agent.listen(content, source=source_agent)
+        elif target in self._channels:
+            self.publish(target, content, source=source_agent)
         elif self.broadcast_if_no_target:
             self.broadcast(content, source=source_agent)
 
@@ -448,12 +537,92 @@ class TinyWorld:
             speech (str): The content of the message.
             source (AgentOrWorld, optional): The agent or environment that issued the message. Defaults to None.
         """
-        logger.debug(f"[{self.name}] Broadcasting message: '{speech}'.")
+        logger.debug("[%s] Broadcasting message: '%s'.", self.name, speech)
 
-        for agent in self.agents:
-            # do not deliver the message to the source
-            if agent != source:
-                agent.listen(speech, source=source)
+        self._fan_out(self.agents, speech, source=source, target_label="everyone")
+
+    #######################################################################
+    # Channels
+    #
+    # Agents can subscribe to channels (e.g., rooms or topics), so that
+    # messages can be delivered to groups of agents at once.
+    #######################################################################
+    def subscribe(self, agent: TinyPerson, channel: str):
+        """
+        Subscribes an agent to a channel, creating the channel if needed. Agents can then address the channel 
+        by name, as the target of a TALK action.
+
+        Args:
+            agent (TinyPerson): The agent to subscribe. It must be in the environment.
+            channel (str): The name of the channel.
+        """
+        if self.get_agent_by_name(agent.name) is not agent:
+            raise ValueError(f"Agent '{agent.name}' is not in the environment {self.name}.")
+        if channel in self.name_to_agent:
+            raise ValueError(f"Channel names must not clash with agent names, but '{channel}' is an agent in the environment.")
+
+        subscribers = self._channels.setdefault(channel, [])
+        if agent.name not in subscribers:
+            subscribers.append(agent.name)
+
+        return self # for chaining
+
+    def unsubscribe(self, agent: TinyPerson, channel: str):
+        """
+        Unsubscribes an agent from a channel. Nothing happens if the agent was not subscribed.
+
+        Args:
+            agent (TinyPerson): The agent to unsubscribe.
+            channel (str): The name of the channel.
+        """
+        subscribers = self._channels.get(channel, [])
+        if agent.name in subscribers:
+            subscribers.remove(agent.name)
+
+        return self # for chaining
+
+    def subscribers_of(self, channel: str) -> list:
+        """
+        Returns the agents subscribed to the specified channel, in subscription order.
+        """
+        return [self.name_to_agent[name] for name in self._channels.get(channel, [])]
+
+    @transactional
+    def publish(self, channel: str, speech: str, source: AgentOrWorld=None):
+        """
+        Delivers a speech to all agents subscribed to the specified channel, except the source.
+
+        Args:
+            channel (str): The name of the channel.
+            speech (str): The content of the message.
+            source (AgentOrWorld, optional): The agent or environment that issued the message. Defaults to None.
+        """
+        logger.debug("[%s] Publishing message to channel %s: '%s'.", self.name, channel, speech)
+
+        self._fan_out(self.subscribers_of(channel), speech, source=source, target_label=channel)
+
+    def _fan_out(self, recipients: list, speech: str, source: AgentOrWorld, target_label: str):
+        """
+        Delivers a speech to many agents at once. A single stimuli episode is built and shared by reference
+        among all recipients, and the delivery is displayed only once, so the cost per recipient is
+        essentially that of appending to its memory.
+        """
+        recipients = [agent for agent in recipients if agent is not source] # do not deliver the message to the source
+        if len(recipients) == 0:
+            return
+
+        content = {"stimuli": [{"type": "CONVERSATION", "content": speech, "source": name_or_empty(source)}]}
+        episode = utils.freeze({'role': 'user', 'content': content,
+                                'type': 'stimulus',
+                                'simulation_timestamp': recipients[0].iso_datetime()})
+
+        for agent in recipients:
+            agent._receive_stimuli(episode)
+
+        if TinyPerson.communication_display:
+            rendering = self._pretty_fan_out(content, target_label, len(recipients))
+            self._push_and_display_latest_communication({"kind": 'stimuli', "rendering": rendering, "content": content, 
+                                                         "source": name_or_empty(source), "target": target_label})
     
     @transactional
     def broadcast_thought(self, thought: str, source: AgentOrWorld=None):
@@ -496,12 +665,11 @@ class TinyWorld:
 
     def make_everyone_accessible(self):
         """
-        Makes all agents in the environment accessible to each other.
+        Makes all agents in the environment accessible to each other. Each agent keeps this as a single group,
+        rather than one relation per agent, so this is linear in the number of agents.
         """
-        for agent_1 in self.agents:
-            for agent_2 in self.agents:
-                if agent_1 != agent_2:
-                    agent_1.make_agent_accessible(agent_2)
+        for agent in self.agents:
+            agent.make_everyone_accessible()
             
 
     ###########################################################
@@ -659,6 +827,21 @@ class TinyWorld:
 
         return rendering
 
+    def _pretty_fan_out(self, content, target_label, n_recipients, max_content_length=default["max_content_display_length"]):
+        stimulus = content["stimuli"][0]
+        actor = stimulus["source"] if stimulus["source"] != "" else "USER"
+
+        indent = " " * len(actor) + "      > "
+        text = textwrap.fill(
+            utils.break_text_at_length(stimulus["content"], max_length=max_content_length),
+            width=TinyPerson.PP_TEXT_WIDTH,
+            initial_indent=indent,
+            subsequent_indent=indent,
+        )
+
+        rich_style = utils.RichTextStyle.get_style_for("stimulus", stimulus["type"])
+        return f"[{rich_style}][underline]{actor}[/] --> [{rich_style}][underline]{target_label}[/] ({n_recipients} agents): [{stimulus['type']}] \n{text}[/]"
+
     def pp_current_interactions(self, simplified=True, skip_system=True):
         """
         Pretty prints the current messages from agents in this environment.
@@ -699,6 +882,8 @@ class TinyWorld:
         del to_copy['name_to_agent']
         del to_copy['current_datetime']
         del to_copy['_interventions'] # TODO: encode interventions
+        for field in self.fields_encoded_separately:
+            del to_copy[field]
 
         state = copy.deepcopy(to_copy)
 
@@ -794,4 +979,4 @@ class TinyWorld:
         """
         Clears the list of all environments.
         """
-        TinyWorld.all_environments = {}
+        TinyWorld.all_environments.clear()
@@ -7,5 +7,6 @@ logger = logging.getLogger("tinytroupe")
 ###########################################################################
 from .randomization import ABRandomizer
 from .proposition import Proposition, check_proposition
+from .runner import ExperimentRunner
 
-__all__ = ["ABRandomizer", "Proposition"]
\ No newline at end of file
+__all__ = ["ABRandomizer", "Proposition", "ExperimentRunner"]
\ No newline at end of file
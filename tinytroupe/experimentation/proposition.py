@@ -84,7 +84,8 @@ class Proposition:
                                     {additional_context}   
                                     """,
 
-                                    output_type=bool)
+                                    output_type=bool,
+                                    call_site="proposition")
         
 
         self.value = llm_request()
@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import pickle
+import tempfile
+import itertools
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from tinytroupe.experimentation import logger
+import tinytroupe.control as control
+import tinytroupe.utils as utils
+
+
+class ExperimentRunner:
+    """
+    Runs the same scenario across many independent variants (e.g., different seeds and treatments),
+    fanning them out across a pool of worker processes.
+
+    The scenario is defined by a picklable builder (i.e., a module-level function), which receives the variant
+    (a dict of parameters), builds and runs the simulation (e.g., a TinyWorld with agents from a TinyPersonFactory),
+    evaluates it (e.g., with Proposition or ResultsExtractor) and returns a dict with the structured results.
+
+    Each variant runs under its own simulation, with its own cache file, so that re-running a variant reuses
+    whatever was computed before. The status and results of each variant are persisted after each completion,
+    so that after a crash only the failed or unfinished variants need to be run again.
+    """
+
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    # The columns of results() that are not variant parameters, and that results can therefore not use either.
+    RESERVED_COLUMNS = ["variant_id", "result", "status", "error", "duration"]
+
+    def __init__(self, scenario_builder, variants:list, name:str="experiment", output_folder:str="./experiments",
+                 max_workers:int=None, llm_cache_file:str=None, mp_context=None):
+        """
+        Initializes the experiment runner.
+
+        Args:
+            scenario_builder (callable): A picklable function that takes a variant (dict) and returns a dict with the results.
+              Its keys become columns of results(), so they cannot be variant parameters or ExperimentRunner.RESERVED_COLUMNS;
+              variants whose results use them fail.
+            variants (list): The variants to run, as a list of dicts. See also ExperimentRunner.variant_grid().
+            name (str): The name of the experiment, used to name the files it produces.
+            output_folder (str): Where to store the results file and the simulation caches.
+            max_workers (int, optional): The number of worker processes. If 0, variants run in the current process,
+              which is useful for debugging. Defaults to the number of CPUs.
+            llm_cache_file (str, optional): If given, LLM responses are cached in a cache shared by all workers
+              (or by all variants, if they run in the current process), which is loaded from and saved to this file. 
+              Defaults to None (no shared cache).
+            mp_context (optional): The multiprocessing context to use for the worker processes. Defaults to None (platform default).
+        """
+        self.scenario_builder = scenario_builder
+        self.name = name
+        self.output_folder = output_folder
+        self.max_workers = max_workers
+        self.llm_cache_file = llm_cache_file
+        self.mp_context = mp_context
+
+        self.variants = {}  # variant_id -> variant
+        for variant in variants:
+            variant_id = ExperimentRunner.variant_id(variant)
+            if variant_id in self.variants:
+                raise ValueError(f"Variants must be unique, but {variant} is repeated.")
+            self.variants[variant_id] = variant
+
+        self.results_path = os.path.join(output_folder, f"{name}.results.json")
+        self.cache_folder = os.path.join(output_folder, f"{name}.caches")
+
+        # variant_id -> {"variant", "status", "result", "error", "duration"}
+        self.records = self._load_records()
+
+    @staticmethod
+    def variant_grid(**parameters) -> list:
+        """
+        Returns all combinations of the given parameter values. For example,
+        variant_grid(seed=[1, 2], treatment=["control", "ad"]) returns 4 variants.
+        """
+        names = list(parameters.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*[parameters[name] for name in names])]
+
+    @staticmethod
+    def variant_id(variant:dict) -> str:
+        """
+        Returns a stable id for the given variant.
+        """
+        return utils.custom_hash(json.dumps(variant, sort_keys=True, default=str))[:16]
+
+    def pending_variants(self) -> dict:
+        """
+        Returns the variants that were not yet successfully run (i.e., never started, unfinished or failed), by id.
+        """
+        return {variant_id: variant for variant_id, variant in self.variants.items()
+                if self.records.get(variant_id, {}).get("status") != ExperimentRunner.STATUS_DONE}
+
+    def run(self, resume:bool=True) -> pd.DataFrame:
+        """
+        Runs the experiment, and returns the results as a DataFrame.
+
+        Args:
+            resume (bool): Whether to run only the variants that were not yet successfully run. If False, all variants
+              are run again (though their simulation caches are still used). Defaults to True.
+        """
+        to_run = self.pending_variants() if resume else dict(self.variants)
+        logger.info(f"Experiment {self.name}: running {len(to_run)} of {len(self.variants)} variants.")
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+        for variant_id, variant in to_run.items():
+            self.records[variant_id] = {"variant": variant, "status": ExperimentRunner.STATUS_RUNNING,
+                                        "result": None, "error": None, "duration": None}
+        self._save_records()
+
+        if self.max_workers == 0:
+            self._run_in_process(to_run)
+        else:
+            self._run_in_pool(to_run)
+
+        return self.results()
+
+    def results(self) -> pd.DataFrame:
+        """
+        Returns the results obtained so far, one row per variant, with the variant parameters, the results
+        returned by the scenario builder and the status of the execution.
+        """
+        rows = []
+        for variant_id, variant in self.variants.items():
+            record = self.records.get(variant_id, {})
+            row = {"variant_id": variant_id, **variant}
+
+            result = record.get("result")
+            if isinstance(result, dict):
+                row.update(result)
+            elif result is not None:
+                row["result"] = result
+
+            row["status"] = record.get("status")
+            row["error"] = record.get("error")
+            row["duration"] = record.get("duration")
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def _run_in_process(self, to_run:dict):
+        client = None
+        api_cache = None
+        if self.llm_cache_file is not None:
+            from tinytroupe import litellm_utils
+            client = litellm_utils.client()
+            previous_cache_settings = (client.cache_api_calls, client.cache_file_name, client.api_cache)
+            api_cache = self._load_llm_cache()
+            client.set_api_cache(True, cache_file_name=None, api_cache=api_cache)
+
+        try:
+            for variant_id, variant in to_run.items():
+                self._record(variant_id, _run_variant(self.scenario_builder, variant_id, variant, self._cache_path(variant_id)))
+        finally:
+            if client is not None:
+                self._save_llm_cache(dict(api_cache))
+                client.set_api_cache(*previous_cache_settings)
+
+    def _run_in_pool(self, to_run:dict):
+        manager = None
+        shared_api_cache = None
+        if self.llm_cache_file is not None:
+            manager = multiprocessing.Manager() if self.mp_context is None else self.mp_context.Manager()
+            shared_api_cache = manager.dict(self._load_llm_cache())
+
+        try:
+            # workers are started once and reused across variants, so that imports and clients are initialized only once
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context,
+                                     initializer=_initialize_worker, initargs=(shared_api_cache,)) as executor:
+                futures = {executor.submit(_run_variant, self.scenario_builder, variant_id, variant, self._cache_path(variant_id)): variant_id
+                           for variant_id, variant in to_run.items()}
+
+                for future in as_completed(futures):
+                    variant_id = futures[future]
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        # the worker itself failed (e.g., it crashed or the result could not be pickled)
+                        outcome = {"status": ExperimentRunner.STATUS_FAILED, "result": None, "error": repr(e), "duration": None}
+
+                    self._record(variant_id, outcome)
+        finally:
+            if manager is not None:
+                self._save_llm_cache(dict(shared_api_cache))
+                manager.shutdown()
+
+    def _record(self, variant_id:str, outcome:dict):
+        self.records[variant_id].update(outcome)
+        self._save_records()
+
+        if outcome["status"] == ExperimentRunner.STATUS_FAILED:
+            logger.warning(f"Experiment {self.name}: variant {self.variants[variant_id]} failed: {outcome['error']}")
+        else:
+            logger.info(f"Experiment {self.name}: variant {self.variants[variant_id]} done in {outcome['duration']:.1f}s.")
+
+    def _cache_path(self, variant_id:str) -> str:
+        return os.path.join(self.cache_folder, f"{variant_id}.cache.json")
+
+    def _load_records(self) -> dict:
+        if os.path.exists(self.results_path):
+            with open(self.results_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def _save_records(self):
+        _atomic_write(self.results_path, lambda f: json.dump(self.records, f, indent=4, default=str), mode="w")
+
+    def _load_llm_cache(self) -> dict:
+        if os.path.exists(self.llm_cache_file):
+            try:
+                with open(self.llm_cache_file, "rb") as f:
+                    return pickle.load(f)
+            except Exception as e:
+                logger.error(f"Error loading LLM cache {self.llm_cache_file}: {e}")
+        return {}
+
+    def _save_llm_cache(self, api_cache:dict):
+        _atomic_write(self.llm_cache_file, lambda f: pickle.dump(api_cache, f), mode="wb")
+
+
+###########################################################################
+# Worker functions. These must be at module level, so that they can be
+# sent to the worker processes.
+###########################################################################
+
+def _initialize_worker(shared_api_cache):
+    """
+    Prepares a worker process, which is then reused for several variants.
+    """
+    if shared_api_cache is not None:
+        from tinytroupe import litellm_utils
+        litellm_utils.client().set_api_cache(True, cache_file_name=None, api_cache=shared_api_cache)
+
+def _run_variant(scenario_builder, variant_id:str, variant:dict, cache_path:str) -> dict:
+    """
+    Runs a single variant under its own simulation, and returns its outcome. Exceptions are reported in
+    the outcome, rather than raised, so that a failing variant does not affect the others.
+    """
+    start_time = time.time()
+    outcome = {"status": ExperimentRunner.STATUS_DONE, "result": None, "error": None}
+
+    try:
+        control.begin(cache_path, id=variant_id)
+        try:
+            result = scenario_builder(variant)
+            if isinstance(result, dict):
+                clashing = [key for key in result if key in variant or key in ExperimentRunner.RESERVED_COLUMNS]
+                if len(clashing) > 0:
+                    raise ValueError(f"The results use the names of variant parameters or reserved columns: {clashing}.")
+            outcome["result"] = result
+        finally:
+            control.end(id=variant_id)
+
+    except Exception as e:
+        outcome["status"] = ExperimentRunner.STATUS_FAILED
+        outcome["error"] = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+
+    finally:
+        # warm workers run many variants, so we must not keep their simulations around
+        if control.current_simulation() is None:
+            control.discard(variant_id)
+
+    outcome["duration"] = time.time() - start_time
+    return outcome
+
+def _atomic_write(path:str, write, mode:str):
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -37,7 +37,7 @@ class Normalizer:
                                                                      base_module_folder="extraction",
                                                                      rendering_configs=rendering_configs)
         
-        next_message = litellm_utils.client().send_message(messages, temperature=0.1)
+        next_message = litellm_utils.client().send_message(messages, call_site="normalization")
         
         debug_msg = f"Normalization result message: {next_message}"
         logger.debug(debug_msg)
@@ -93,7 +93,7 @@ class Normalizer:
                                                                      base_module_folder="extraction",
                                                                      rendering_configs=rendering_configs)
             
-            next_message = litellm_utils.client().send_message(messages, temperature=0.1)
+            next_message = litellm_utils.client().send_message(messages, call_site="normalization")
             
             debug_msg = f"Normalization result message: {next_message}"
             logger.debug(debug_msg)
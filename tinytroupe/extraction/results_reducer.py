@@ -24,16 +24,17 @@ class ResultsReducer:
                 continue # doing nothing for `system` role yet at least
 
             elif message['role'] == 'user':
-                # User role is related to stimuli only
-                stimulus_type = message['content']['stimuli'][0]['type']
-                stimulus_content = message['content']['stimuli'][0]['content']
-                stimulus_source = message['content']['stimuli'][0]['source']
-                stimulus_timestamp = message['simulation_timestamp']
-
-                if stimulus_type in self.rules:
-                    extracted = self.rules[stimulus_type](focus_agent=agent, source_agent=TinyPerson.get_agent_by_name(stimulus_source), target_agent=agent, kind='stimulus', event=stimulus_type, content=stimulus_content, timestamp=stimulus_timestamp)
-                    if extracted is not None:
-                        reduction.append(extracted)
+                # User role is related to stimuli only. A single message might carry several stimuli.
+                for stimulus in message['content']['stimuli']:
+                    stimulus_type = stimulus['type']
+                    stimulus_content = stimulus['content']
+                    stimulus_source = stimulus['source']
+                    stimulus_timestamp = message['simulation_timestamp']
+
+                    if stimulus_type in self.rules:
+                        extracted = self.rules[stimulus_type](focus_agent=agent, source_agent=TinyPerson.get_agent_by_name(stimulus_source), target_agent=agent, kind='stimulus', event=stimulus_type, content=stimulus_content, timestamp=stimulus_timestamp)
+                        if extracted is not None:
+                            reduction.append(extracted)
 
             elif message['role'] == 'assistant':
                 # Assistant role is related to actions only
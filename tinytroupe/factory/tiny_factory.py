@@ -2,6 +2,7 @@ import copy
 
 from tinytroupe.factory import logger
 import tinytroupe.utils as utils
+from tinytroupe.control import ScopedRegistry
 
 class TinyFactory:
     """
@@ -9,8 +10,8 @@ class TinyFactory:
     regarding transaction caching.
     """
 
-    # A dict of all factories created so far.
-    all_factories = {} # name -> factories
+    # A dict of all factories created so far, for the simulation running in the current context.
+    all_factories = ScopedRegistry("factories") # name -> factories
     
     def __init__(self, simulation_id:str=None) -> None:
         """
@@ -51,9 +52,9 @@ class TinyFactory:
     @staticmethod
     def clear_factories():
         """
-        Clears the global list of all factories.
+        Clears the list of all factories of the current context.
         """
-        TinyFactory.all_factories = {}
+        TinyFactory.all_factories.clear()
 
     ################################################################################################
     # Caching mechanisms
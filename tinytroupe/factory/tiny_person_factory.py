@@ -1,16 +1,28 @@
 import os
 import json
 import chevron
+import concurrent.futures
+import contextvars
+import threading
 
 from .tiny_factory import TinyFactory
 from tinytroupe.factory import logger
 from tinytroupe import litellm_utils
 from tinytroupe.agent import TinyPerson
 import tinytroupe.utils as utils
+from tinytroupe import control
 from tinytroupe.control import transactional
 
 class TinyPersonFactory(TinyFactory):
 
+    # How many people generate_people() generates at the same time, by default. Parallel generation is opt-in, since
+    # its requests differ from the sequential ones, and thus do not replay caches recorded without it.
+    DEFAULT_PARALLELISM = 1
+
+    # The names reserved for agents that are being created, by any factory, and the lock that guards all reservations.
+    _names_being_created = set()
+    _names_lock = threading.Lock()
+
     def __init__(self, context_text, simulation_id:str=None):
         """
         Initialize a TinyPersonFactory instance.
@@ -52,7 +64,7 @@ class TinyPersonFactory(TinyFactory):
 
         messages.append({"role": "user", "content": user_prompt})
 
-        response = litellm_utils.client().send_message(messages)
+        response = litellm_utils.client().send_message(messages, call_site="factory.context")
 
         if response is not None:
             result = utils.extract_json(response["content"])
@@ -85,7 +97,121 @@ class TinyPersonFactory(TinyFactory):
 
         logger.info(f"Starting the person generation based on that context: {self.context_text}")
 
-    
+        agent_spec = None
+        attempt = 0
+        while agent_spec is None and attempt < attepmpts:
+            attempt += 1
+            prompt = self._person_prompt(agent_particularities)
+            agent_spec = self._generate_spec(self._person_messages(prompt, attempt), temperature, frequency_penalty, presence_penalty, attempt)
+        
+        # create the fresh agent
+        if agent_spec is not None:
+            # the agent is created here. This is why the present method cannot be cached. Instead, an auxiliary method is used
+            # for the actual model call, so that it gets cached properly without skipping the agent creation.
+            person = self._create_person(agent_spec)
+            self.generated_minibios.append(person.minibio())
+            return person
+        else:
+            logger.error(f"Could not generate an agent after {attepmpts} attempts.")
+            return None
+
+    def generate_people(self, number_of_people:int, 
+                        agent_particularities:str=None, 
+                        temperature:float=1.5, 
+                        frequency_penalty:float=0.0,
+                        presence_penalty:float=0.0,
+                        attepmpts:int=10, 
+                        verbose:bool=False,
+                        parallelism:int=None) -> list:
+        """
+        Generate a list of TinyPerson instances using OpenAI's LLM.
+
+        With parallelism, the people are generated in rounds: the specifications of all the people still missing are 
+        sampled at the same time, and then their names are reserved in order. The people whose names clash, with each 
+        other or with existing agents, are the only ones generated again in the next round, now knowing the names taken.
+
+        Args:
+            number_of_people (int): The number of TinyPerson instances to generate.
+            agent_particularities (str): The particularities of the agent.
+            temperature (float): The temperature to use when sampling from the LLM.
+            verbose (bool): Whether to print verbose information.
+            parallelism (int, optional): How many people can be generated at the same time. If 1, they are generated one
+              after the other, each knowing the ones generated before, exactly as without parallelism. Defaults to 
+              TinyPersonFactory.DEFAULT_PARALLELISM (i.e., 1).
+
+        Returns:
+            list: A list of TinyPerson instances generated using the LLM.
+        """
+        if parallelism is None:
+            parallelism = TinyPersonFactory.DEFAULT_PARALLELISM
+        parallelism = max(1, min(parallelism, number_of_people))
+
+        if parallelism == 1:
+            people = []
+            for i in range(number_of_people):
+                person = self.generate_person(agent_particularities=agent_particularities, 
+                                                temperature=temperature, 
+                                                frequency_penalty=frequency_penalty,
+                                                presence_penalty=presence_penalty,
+                                                attepmpts=attepmpts)
+                if person is not None:
+                    people.append(person)
+                    self._log_generated(person, i, number_of_people, verbose)
+                else:
+                    logger.error(f"Could not generate person {i+1}/{number_of_people}.")
+
+            return people
+
+        logger.info(f"Starting the generation of {number_of_people} people, {parallelism} at a time, based on that context: {self.context_text}")
+
+        people = [None] * number_of_people
+        pending = list(range(number_of_people))
+        attempt = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="tinytroupe-person-generation") as executor:
+            while len(pending) > 0 and attempt < attepmpts:
+                attempt += 1
+                prompt = self._person_prompt(agent_particularities)
+                calls = [{"messages": self._person_messages(prompt, attempt, position=i, total=number_of_people),
+                          "temperature": temperature,
+                          "frequency_penalty": frequency_penalty,
+                          "presence_penalty": presence_penalty} for i in pending]
+
+                # the specifications are consumed (and names reserved) in order, so that the outcome of a round does not
+                # depend on which calls happen to finish first, and simulation caches see the calls in a deterministic order
+                batch = _GenerationBatch(self, calls, executor)
+                token = _current_batch.set(batch)
+                created = []
+                still_pending = []
+                try:
+                    for i, call in zip(pending, calls):
+                        agent_spec = self._generate_spec(call["messages"], temperature, frequency_penalty, presence_penalty, attempt)
+                        if agent_spec is None:
+                            still_pending.append(i)
+                        else:
+                            people[i] = self._create_person(agent_spec)
+                            created.append(i)
+                finally:
+                    _current_batch.reset(token)
+                    batch.cancel()
+
+                self._add_minibios([people[i] for i in created], executor)
+                for i in created:
+                    self._log_generated(people[i], i, number_of_people, verbose)
+
+                pending = still_pending
+
+        for i in pending:
+            logger.error(f"Could not generate person {i+1}/{number_of_people} after {attepmpts} attempts.")
+
+        return [person for person in people if person is not None]
+
+    def _log_generated(self, person, i:int, number_of_people:int, verbose:bool):
+        info_msg = f"Generated person {i+1}/{number_of_people}: {person.minibio()}"
+        logger.info(info_msg)
+        if verbose:
+            print(info_msg)
+
+    def _person_prompt(self, agent_particularities:str) -> str:
         # read example specs from files. 
         example_1 = json.load(open(os.path.join(os.path.dirname(__file__), '../examples/agents/Friedrich_Wolf.agent.json')))
         example_2 = json.load(open(os.path.join(os.path.dirname(__file__), '../examples/agents/Sophie_Lefevre.agent.json')))
@@ -95,7 +221,7 @@ class TinyPersonFactory(TinyFactory):
         #
         # For the minibios, we only need to keep track of the ones generated by this factory, since they are unique to each factory
         # and are used to guide the sampling process.
-        prompt = chevron.render(open(self.person_prompt_template_path).read(), {
+        return chevron.render(open(self.person_prompt_template_path).read(), {
             "context": self.context_text,
             "agent_particularities": agent_particularities,
             
@@ -108,17 +234,30 @@ class TinyPersonFactory(TinyFactory):
             "already_generated_names": TinyPerson.all_agents_names()
         })
 
-        def aux_generate(attempt):
+    def _person_messages(self, prompt:str, attempt:int, position:int=None, total:int=None) -> list:
+        messages = []
+        messages += [{"role": "system", "content": "You are a system that generates specifications for realistic simulations of people. You follow the generation rules and constraints carefully."},
+                    {"role": "user", "content": prompt}]
+
+        if position is not None:
+            # people generated at the same time cannot see each other, so they are told apart explicitly. This also keeps
+            # their requests distinct, so that they are not served the same cached response.
+            messages.append({"role": "user", "content": f"You are generating person {position+1} of {total}, who are all being generated at the same time "+ \
+                                                        "without seeing each other. Make sure this person is clearly distinct from the others (e.g., in name, age, occupation and background)."})
+        
+        if attempt > 1:
+            # we failed once already due to repetition, so we try to further reinforce the message to avoid repetition.
+            messages.append({"role": "user", "content": "IMPORTANT: Please ensure you **do not** generate the same name again. Agent names **must** be unique."+ \
+                                                        "Read the list of already generated names to avoid repetition. If necessary, generate a longer name to ensure it is new."})
 
-            messages = []
-            messages += [{"role": "system", "content": "You are a system that generates specifications for realistic simulations of people. You follow the generation rules and constraints carefully."},
-                        {"role": "user", "content": prompt}]
-            
-            if attempt > 1:
-                # we failed once already due to repetition, so we try to further reinforce the message to avoid repetition.
-                messages.append({"role": "user", "content": "IMPORTANT: Please ensure you **do not** generate the same name again. Agent names **must** be unique."+ \
-                                                            "Read the list of already generated names to avoid repetition. If necessary, generate a longer name to ensure it is new."})
+        return messages
 
+    def _generate_spec(self, messages:list, temperature:float, frequency_penalty:float, presence_penalty:float, attempt:int) -> dict:
+        """
+        Generates an agent specification and reserves its name. Returns None if no suitable specification was generated,
+        e.g., because its name was already taken.
+        """
+        try:
             # due to a technicality, we need to call an auxiliary method to be able to use the transactional decorator.
             message = self._aux_model_call(messages=messages, 
                                             temperature=temperature,
@@ -130,73 +269,77 @@ class TinyPersonFactory(TinyFactory):
 
                 logger.debug(f"At attempt {attempt}, generated person parameters:\n{json.dumps(result, indent=4, sort_keys=True)}")
 
-                # only accept the generated spec if the name is not already in the generated names, because they must be unique.
-                if result["name"].lower() not in self.generated_names:
+                # only accept the generated spec if its name can be reserved, because names must be unique.
+                if self._reserve_name(result["name"]):
                     return result
                 else:
                     logger.info(f"Person with name {result['name']} was already generated, cannot be reused.")
 
-            return None # no suitable agent was generated
-        
-        agent_spec = None
-        attempt = 0
-        while agent_spec is None and attempt < attepmpts:
-            try:
-                attempt += 1
-                agent_spec = aux_generate(attempt=attempt)
-            except Exception as e:
-                logger.error(f"Error while generating agent specification: {e}")
-        
-        # create the fresh agent
-        if agent_spec is not None:
-            # the agent is created here. This is why the present method cannot be cached. Instead, an auxiliary method is used
-            # for the actual model call, so that it gets cached properly without skipping the agent creation.
+        except Exception as e:
+            logger.error(f"Error while generating agent specification: {e}")
+
+        return None # no suitable agent was generated
+
+    def _create_person(self, agent_spec:dict):
+        """
+        Creates the agent of a specification whose name was reserved. From then on, the agent itself holds the name.
+        """
+        try:
             person = TinyPerson(agent_spec["name"])
             self._setup_agent(person, agent_spec)
-            self.generated_minibios.append(person.minibio())
-            self.generated_names.append(person.get("name").lower())
-            return person
+        except Exception:
+            self._release_name(agent_spec["name"], keep=False)
+            raise
+
+        self._release_name(agent_spec["name"], keep=True)
+        return person
+
+    def _add_minibios(self, people:list, executor):
+        """
+        Adds the minibios of the given people to the generated ones. Outside of simulations, they are produced at the same
+        time; within one, in order, since each is a transaction.
+        """
+        if control.current_simulation() is None:
+            futures = [executor.submit(contextvars.copy_context().run, person.minibio) for person in people]
+            minibios = [future.result() for future in futures]
         else:
-            logger.error(f"Could not generate an agent after {attepmpts} attempts.")
-            return None
+            minibios = [person.minibio() for person in people]
 
-    def generate_people(self, number_of_people:int, 
-                        agent_particularities:str=None, 
-                        temperature:float=1.5, 
-                        frequency_penalty:float=0.0,
-                        presence_penalty:float=0.0,
-                        attepmpts:int=10, 
-                        verbose:bool=False) -> list:
+        self.generated_minibios.extend(minibios)
+
+    ################################################################################################
+    # Name reservations
+    #
+    # Agent names must be unique, and all agents share the same name space, so a name is reserved 
+    # atomically before its agent is created, even if several factories generate people at once.
+    ################################################################################################
+
+    def _reserve_name(self, name:str) -> bool:
         """
-        Generate a list of TinyPerson instances using OpenAI's LLM.
+        Reserves a name for an agent to be created, unless it is taken by an agent already generated (or being generated)
+        by any factory, or by any existing agent. Returns whether the name was reserved.
+        """
+        key = name.lower()
+        with TinyPersonFactory._names_lock:
+            if key in self.generated_names or key in TinyPersonFactory._names_being_created or \
+               key in (agent_name.lower() for agent_name in TinyPerson.all_agents_names()):
+                return False
 
-        Args:
-            number_of_people (int): The number of TinyPerson instances to generate.
-            agent_particularities (str): The particularities of the agent.
-            temperature (float): The temperature to use when sampling from the LLM.
-            verbose (bool): Whether to print verbose information.
+            self.generated_names.append(key)
+            TinyPersonFactory._names_being_created.add(key)
+            return True
 
-        Returns:
-            list: A list of TinyPerson instances generated using the LLM.
+    def _release_name(self, name:str, keep:bool):
         """
-        people = []
-        for i in range(number_of_people):
-            person = self.generate_person(agent_particularities=agent_particularities, 
-                                            temperature=temperature, 
-                                            frequency_penalty=frequency_penalty,
-                                            presence_penalty=presence_penalty,
-                                            attepmpts=attepmpts)
-            if person is not None:
-                people.append(person)
-                info_msg = f"Generated person {i+1}/{number_of_people}: {person.minibio()}"
-                logger.info(info_msg)
-                if verbose:
-                    print(info_msg)
-            else:
-                logger.error(f"Could not generate person {i+1}/{number_of_people}.")
-
-        return people
-    
+        Releases the reservation of a name once its agent is created, in which case the name stays among the generated 
+        ones (keep=True), or if the agent could not be created, in which case the name is freed again (keep=False).
+        """
+        key = name.lower()
+        with TinyPersonFactory._names_lock:
+            TinyPersonFactory._names_being_created.discard(key)
+            if not keep and key in self.generated_names:
+                self.generated_names.remove(key)
+
     @transactional
     def _aux_model_call(self, messages, temperature, frequency_penalty, presence_penalty):
         """
@@ -204,11 +347,22 @@ class TinyPersonFactory(TinyFactory):
         due too a technicality - otherwise, the agent creation would be skipped during cache reutilization, and
         we don't want that.
         """
+        batch = _current_batch.get()
+        if batch is not None:
+            result = batch.result_for(messages=messages, temperature=temperature, 
+                                      frequency_penalty=frequency_penalty, presence_penalty=presence_penalty)
+            if result is not _GenerationBatch.NOT_IN_BATCH:
+                return result
+
+        return self._model_call(messages, temperature, frequency_penalty, presence_penalty)
+
+    def _model_call(self, messages, temperature, frequency_penalty, presence_penalty):
         return litellm_utils.client().send_message(messages, 
                                                   temperature=temperature, 
                                                   frequency_penalty=frequency_penalty, 
                                                   presence_penalty=presence_penalty,
-                                                  response_format={"type": "json_object"})
+                                                  response_format={"type": "json_object"},
+                                                  call_site="factory.person")
     
     @transactional
     def _setup_agent(self, agent, configuration):
@@ -218,4 +372,51 @@ class TinyPersonFactory(TinyFactory):
         agent.include_persona_definitions(configuration)
         
         # does not return anything, as we don't want to cache the agent object itself.
-    
+
+
+# The model calls of the people being generated at the same time in the current context, if any.
+_current_batch = contextvars.ContextVar("tinytroupe_person_generation_batch", default=None)
+
+class _GenerationBatch:
+    """
+    The model calls of a round of people generated at the same time. The calls are still consumed one by one, in order,
+    through the transactional _aux_model_call(), so that simulation caches record and replay them as if they were made
+    serially. But the first time one of them is actually executed (i.e., not replayed from a cache), it and all the 
+    following calls are submitted at once, so that they run in parallel.
+    """
+
+    # Returned by result_for() for calls that are not part of the batch.
+    NOT_IN_BATCH = object()
+
+    def __init__(self, factory, calls:list, executor):
+        self.factory = factory
+        self.calls = calls # a list of dicts with the arguments of each call, in order
+        self.executor = executor
+        self._futures = {} # call index -> future
+        self._next = 0
+
+    def result_for(self, **call):
+        """
+        Returns the result of the given call, made in parallel with the following ones, or NOT_IN_BATCH if the call
+        is not part of the batch.
+        """
+        index = next((i for i in range(self._next, len(self.calls)) if self.calls[i] == call), None)
+        if index is None:
+            return _GenerationBatch.NOT_IN_BATCH
+
+        self._next = index + 1
+        if index not in self._futures:
+            for i in range(index, len(self.calls)):
+                if i not in self._futures:
+                    # each call runs in a copy of the current context, so that it is attributed to the same simulation
+                    self._futures[i] = self.executor.submit(contextvars.copy_context().run, self.factory._model_call, **self.calls[i])
+
+        return self._futures.pop(index).result()
+
+    def cancel(self):
+        """
+        Cancels the calls whose results were not consumed.
+        """
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
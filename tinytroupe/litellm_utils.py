@@ -1,6 +1,12 @@
 import os
+import atexit
 import litellm
 import time
+import re
+import threading
+import collections
+import concurrent.futures
+import contextvars
 import json
 import pickle
 import logging
@@ -12,7 +18,9 @@ import hashlib
 import inspect
 
 from tinytroupe import utils
-from tinytroupe.control import transactional
+from tinytroupe import metrics
+from tinytroupe import tracing
+from tinytroupe.control import transactional, in_current_context
 
 logger = logging.getLogger("tinytroupe")
 
@@ -65,6 +73,7 @@ default["timeout"] = float(config["LLM"].get("TIMEOUT", "60.0"))
 default["max_attempts"] = int(config["LLM"].get("MAX_ATTEMPTS", "5"))
 default["waiting_time"] = float(config["LLM"].get("WAITING_TIME", "1"))
 default["exponential_backoff_factor"] = float(config["LLM"].get("EXPONENTIAL_BACKOFF_FACTOR", "5"))
+default["max_prompt_tokens"] = int(config["LLM"]["MAX_PROMPT_TOKENS"]) if config["LLM"].get("MAX_PROMPT_TOKENS") else None
 
 default["embedding_model"] = config["LLM"].get("EMBEDDING_MODEL", "text-embedding-3-small")
 
@@ -72,9 +81,107 @@ default["cache_api_calls"] = config["LLM"].getboolean("CACHE_API_CALLS", False)
 default["cache_file_name"] = config["LLM"].get("CACHE_FILE_NAME", "litellm_api_cache.pickle")
 
 # LiteLLM specific settings
+default["stream"] = config["LLM"].getboolean("STREAM", False)
+
+default["adaptive_max_tokens"] = config["LLM"].getboolean("ADAPTIVE_MAX_TOKENS", False)
+default["output_lengths_file_name"] = config["LLM"].get("OUTPUT_LENGTHS_FILE_NAME", "litellm_output_lengths.json") or None
+
+default["hedge_requests"] = config["LLM"].getboolean("HEDGE_REQUESTS", False)
+default["hedge_percentile"] = float(config["LLM"].get("HEDGE_PERCENTILE", "95"))
+default["hedge_max_extra_load"] = float(config["LLM"].get("HEDGE_MAX_EXTRA_LOAD", "0.1"))
+
 default["enable_fallbacks"] = config["LLM"].getboolean("ENABLE_FALLBACKS", False)
 default["fallback_models"] = config["LLM"].get("FALLBACK_MODELS", "").split(",") if config["LLM"].get("FALLBACK_MODELS", "") else []
 
+###########################################################################
+# Call sites
+###########################################################################
+
+# The named uses of the LLM in TinyTroupe (e.g., agent actions, proposition checks), each of which can have its own 
+# model, max_tokens and temperature, so that, for instance, cheaper and faster models serve the bulk of auxiliary calls 
+# while the main model serves agent dialogue. Settings here are the built-in ones for each call site, which are overridden 
+# by those in the [LLM_CALL_SITES] section of the config file (see config.ini), and then by the parameters of each call.
+# Anything not set falls back to the defaults above.
+CALL_SITE_SETTINGS = ["model", "max_tokens", "temperature"]
+
+call_sites = {
+    "agent.act": {},
+    "agent.minibio": {},
+    "agent.memory": {},
+    "proposition": {},
+    "semantics": {},
+    "extraction": {"temperature": 0.0},
+    "normalization": {"temperature": 0.1},
+    "enrichment": {"temperature": 1.0},
+    "story": {"temperature": 1.5},
+    "validation": {},
+    "factory.context": {},
+    "factory.person": {},
+}
+
+def configure_call_site(call_site:str, **settings):
+    """
+    Sets the model, max_tokens and/or temperature of a call site, creating it if needed. A setting of None is removed, 
+    so that the default applies again.
+    """
+    for setting in settings:
+        if setting not in CALL_SITE_SETTINGS:
+            raise ValueError(f"Unknown call site setting: {setting}. Valid settings are: {CALL_SITE_SETTINGS}.")
+
+    site = call_sites.setdefault(call_site, {})
+    for setting, value in settings.items():
+        if value is None:
+            site.pop(setting, None)
+        else:
+            site[setting] = value
+
+def call_site_settings(call_site:str=None) -> dict:
+    """
+    Returns the model, max_tokens and temperature used by the specified call site, which are the defaults for unknown 
+    call sites, or if the call site is None.
+    """
+    settings = {setting: default[setting] for setting in CALL_SITE_SETTINGS}
+    settings.update(call_sites.get(call_site, {}))
+    return settings
+
+if config.has_section("LLM_CALL_SITES"):
+    for key, value in config["LLM_CALL_SITES"].items():
+        call_site, _, setting = key.rpartition(".")
+        if setting == "model":
+            configure_call_site(call_site, model=value)
+        elif setting == "max_tokens":
+            configure_call_site(call_site, max_tokens=int(value))
+        elif setting == "temperature":
+            configure_call_site(call_site, temperature=float(value))
+        else:
+            raise ValueError(f"Invalid call site setting in config file: {key}. Expected <call site>.<setting>, where setting is one of {CALL_SITE_SETTINGS}.")
+
+###########################################################################
+# Metrics
+###########################################################################
+
+# Besides these labels, the agent and simulation id are taken from the context of each call (see tinytroupe.metrics).
+_LLM_LABELS = ["model", "call_site", "agent", "simulation_id"]
+
+_llm_calls = metrics.registry.counter("tinytroupe_llm_calls_total", 
+                                      "LLM calls answered by the model (i.e., not from the cache).", _LLM_LABELS)
+_llm_call_duration = metrics.registry.histogram("tinytroupe_llm_call_duration_seconds", 
+                                                "Duration of LLM calls answered by the model, including retries.", _LLM_LABELS)
+_llm_tokens = metrics.registry.counter("tinytroupe_llm_tokens_total", 
+                                       "Tokens of LLM calls, by kind (prompt, completion or cached_prompt).", _LLM_LABELS + ["kind"])
+_llm_errors = metrics.registry.counter("tinytroupe_llm_errors_total", 
+                                       "Failed attempts of LLM calls, by type of error.", _LLM_LABELS + ["error"])
+_llm_retries = metrics.registry.counter("tinytroupe_llm_retries_total", 
+                                        "Attempts of LLM calls after the first one.", _LLM_LABELS)
+_llm_rate_limit_wait = metrics.registry.counter("tinytroupe_llm_rate_limit_wait_seconds_total", 
+                                                "Time spent waiting to retry LLM calls that were rate-limited.", _LLM_LABELS)
+_llm_cache_hits = metrics.registry.counter("tinytroupe_llm_cache_hits_total", 
+                                           "LLM calls answered from the API cache.", _LLM_LABELS)
+_llm_cache_misses = metrics.registry.counter("tinytroupe_llm_cache_misses_total", 
+                                             "LLM calls not found in the API cache, when it is enabled.", _LLM_LABELS)
+_llm_in_flight = metrics.registry.gauge("tinytroupe_llm_calls_in_flight", 
+                                        "LLM calls currently waiting for the model.", ["model", "call_site", "simulation_id"])
+
 ###########################################################################
 # Model calling helpers
 ###########################################################################
@@ -325,6 +432,493 @@ class LLMScalarWithJustificationResponse(BaseModel):
     justification: str
     confidence: float
 
+###########################################################################
+# Model capabilities
+###########################################################################
+
+class ModelCapabilities:
+    """
+    A registry of what each model supports: which request parameters, whether it accepts a response format (and a JSON
+    schema in particular), and how large its context window and outputs can be. Requests are sanitized according to it
+    before being sent, so that they do not fail just because of a parameter the model does not accept.
+
+    Capabilities come from three sources, from the least to the most specific:
+      - what LiteLLM knows about the model (litellm.get_supported_openai_params, litellm.get_model_info);
+      - the declarative table below, indexed by model name prefix, which can be extended with register();
+      - what is learned at runtime, from errors about unsupported parameters.
+    """
+
+    # The request parameters that are subject to sanitization. Others (e.g., api_base or timeout) are left untouched.
+    SANITIZABLE_PARAMS = {"temperature", "max_tokens", "top_p", "frequency_penalty", "presence_penalty", "stop", "n",
+                          "response_format", "echo", "seed", "logit_bias", "logprobs", "top_logprobs"}
+
+    # Known capabilities by model name prefix. More specific (longer) prefixes take precedence. Names are those of the
+    # models actually requested, i.e., after _resolve_model() (which, e.g., serves all Gemini models through vertex_ai).
+    known_capabilities = {
+        "groq/": {"unsupported_params": {"echo"}},
+        "vertex_ai/gemini": {"unsupported_params": {"presence_penalty"}},
+    }
+
+    _learned_unsupported_params = {} # model -> set of parameters
+    _capabilities_cache = {} # model -> capabilities
+    _lock = threading.Lock()
+
+    @staticmethod
+    def register(model_prefix:str, **capabilities):
+        """
+        Registers the capabilities of the models whose names start with the given prefix, overriding what is otherwise known.
+
+        Args:
+            model_prefix (str): The model name prefix (e.g., "groq/" or "vertex_ai/gemini-2.0-flash").
+            **capabilities: The capabilities, among: supported_params (set), unsupported_params (set), response_format (bool),
+              response_schema (bool), max_input_tokens (int) and max_output_tokens (int).
+        """
+        with ModelCapabilities._lock:
+            ModelCapabilities.known_capabilities[model_prefix] = capabilities
+            ModelCapabilities._capabilities_cache.clear()
+
+    @staticmethod
+    def of(model:str) -> dict:
+        """
+        Returns the capabilities of the specified model, as a dict with the keys: provider, supported_params (a set, or None
+        if unknown), unsupported_params (a set), response_format, response_schema, max_input_tokens and max_output_tokens
+        (None if unknown).
+        """
+        capabilities = ModelCapabilities._capabilities_cache.get(model)
+        if capabilities is None:
+            capabilities = ModelCapabilities._compute_capabilities(model)
+            with ModelCapabilities._lock:
+                ModelCapabilities._capabilities_cache[model] = capabilities
+
+        return capabilities
+
+    @staticmethod
+    def sanitize(model:str, params:dict) -> dict:
+        """
+        Returns a copy of the request parameters without those the model does not support, and with max_tokens 
+        limited to the model's maximum output.
+        """
+        capabilities = ModelCapabilities.of(model)
+        supported = capabilities["supported_params"]
+
+        sanitized = {}
+        for name, value in params.items():
+            if name in ModelCapabilities.SANITIZABLE_PARAMS:
+                if name in capabilities["unsupported_params"] or (supported is not None and name not in supported):
+                    logger.debug("Removing '%s' parameter, unsupported by model %s", name, model)
+                    continue
+                if name == "response_format" and not capabilities["response_format"]:
+                    logger.debug("Removing 'response_format' parameter, unsupported by model %s", model)
+                    continue
+                if name == "stop" and not value:
+                    # an empty list of stop sequences is the same as none, but not all providers accept it
+                    continue
+
+            sanitized[name] = value
+
+        max_output_tokens = capabilities["max_output_tokens"]
+        if max_output_tokens is not None and sanitized.get("max_tokens") is not None and sanitized["max_tokens"] > max_output_tokens:
+            logger.debug("Limiting max_tokens to %d, the maximum output of model %s", max_output_tokens, model)
+            sanitized["max_tokens"] = max_output_tokens
+
+        return sanitized
+
+    @staticmethod
+    def learn_from_error(model:str, error:Exception, params:dict) -> list:
+        """
+        Learns, from an error returned for a request, which of its parameters the model does not support, so that they
+        are not sent again.
+
+        Returns:
+            list: The parameters found to be unsupported, if any.
+        """
+        message = str(error).lower()
+        if not any(hint in message for hint in ["support", "unrecognized", "unknown", "not allowed", "not permitted", "extra inputs"]):
+            return []
+
+        # parameters are quoted in such errors (e.g., "Unsupported parameter: 'max_tokens' is not supported with this model.")
+        unsupported = [name for name in params 
+                       if name in ModelCapabilities.SANITIZABLE_PARAMS and re.search(rf"['\"`]{name}['\"`]", message)]
+        if len(unsupported) > 0:
+            logger.warning(f"Model {model} does not support the parameters {unsupported}. They will not be sent to it anymore.")
+            with ModelCapabilities._lock:
+                ModelCapabilities._learned_unsupported_params.setdefault(model, set()).update(unsupported)
+                ModelCapabilities._capabilities_cache.pop(model, None)
+
+        return unsupported
+
+    @staticmethod
+    def _compute_capabilities(model:str) -> dict:
+        capabilities = {"provider": None, "supported_params": None, "unsupported_params": set(),
+                        "response_format": True, "response_schema": False,
+                        "max_input_tokens": None, "max_output_tokens": None}
+
+        # what LiteLLM knows. Not all models are known, though.
+        try:
+            _, provider, _, _ = litellm.get_llm_provider(model)
+            capabilities["provider"] = provider
+            supported = litellm.get_supported_openai_params(model=model, custom_llm_provider=provider)
+            if supported:
+                capabilities["supported_params"] = set(supported)
+                capabilities["response_format"] = "response_format" in supported
+        except Exception:
+            pass
+
+        try:
+            capabilities["response_schema"] = bool(litellm.supports_response_schema(model=model))
+        except Exception:
+            pass
+
+        try:
+            model_info = litellm.get_model_info(model)
+            capabilities["max_input_tokens"] = model_info.get("max_input_tokens")
+            capabilities["max_output_tokens"] = model_info.get("max_output_tokens")
+        except Exception:
+            pass
+
+        # what is declared, from the least to the most specific prefix
+        for prefix in sorted(ModelCapabilities.known_capabilities, key=len):
+            if model.startswith(prefix):
+                for key, value in ModelCapabilities.known_capabilities[prefix].items():
+                    capabilities[key] = set(value) if key in ["supported_params", "unsupported_params"] else value
+
+        # what was learned
+        capabilities["unsupported_params"] = capabilities["unsupported_params"] | \
+                                             ModelCapabilities._learned_unsupported_params.get(model, set())
+
+        return capabilities
+
+_resolved_models = {}
+
+def _resolve_model(model):
+    """
+    Resolves the model name to the one actually requested from LiteLLM.
+    """
+    if model not in _resolved_models:
+        resolved = model
+        
+        # Gemini models are served through the vertex_ai provider
+        if "gemini" in model.lower() and not model.startswith("vertex_ai/"):
+            resolved = "vertex_ai/gemini-2.0-flash"
+            logger.warning(f"Converting model {model} to use vertex_ai provider: {resolved}")
+        
+        _resolved_models[model] = resolved
+    
+    return _resolved_models[model]
+
+###########################################################################
+# Model routing
+###########################################################################
+
+class ModelRouter:
+    """
+    Routes each request to the healthiest eligible model among the requested one and its fallbacks (FALLBACK_MODELS, if
+    ENABLE_FALLBACKS is set). For each model, the router keeps rolling latencies and error rates, as well as a circuit 
+    breaker: after repeated consecutive failures, the circuit opens and the model is not requested anymore, until a 
+    cooldown period has passed, after which the circuit is half-open and the model is tried again. A success then 
+    closes the circuit, while another failure opens it again.
+
+    Only server-side failures (5xx errors, timeouts, connection errors) count as failures, and on these the request
+    immediately fails over to the next candidate, rather than waiting and retrying against a degraded model.
+    """
+
+    # errors that say something about the health of the model, rather than about the request itself
+    FAILOVER_ERRORS = (litellm.InternalServerError, litellm.ServiceUnavailableError, litellm.BadGatewayError,
+                       litellm.Timeout, litellm.APIConnectionError)
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, fallback_models:list=None, failure_threshold:int=3, cooldown:float=30.0, window:int=50, 
+                 max_error_rate:float=0.5, min_samples:int=5):
+        """
+        Initializes the router.
+
+        Args:
+            fallback_models (list): The models to fail over to, in order of preference.
+            failure_threshold (int): The number of consecutive failures after which the circuit of a model opens.
+            cooldown (float): The time, in seconds, after which an open circuit becomes half-open.
+            window (int): The number of most recent requests over which latencies and error rates are computed.
+            max_error_rate (float): The error rate above which a model is considered degraded, and thus only used
+              if no healthy model is available.
+            min_samples (int): The minimum number of requests before the error rate of a model is taken into account.
+        """
+        self.fallback_models = list(fallback_models) if fallback_models is not None else []
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+
+        self._health = {} # model -> health statistics
+        self._lock = threading.Lock()
+
+    def candidates(self, model:str) -> list:
+        """
+        Returns the models to try for a request to the specified model, from the first to the last to be tried.
+        """
+        targets = [model] + [_resolve_model(fallback) for fallback in self.fallback_models if _resolve_model(fallback) != model]
+
+        with self._lock:
+            eligible = [target for target in targets if self._circuit_allows(target)]
+            if len(eligible) == 0:
+                # nothing else to do but to try anyway
+                return targets
+
+            healthy = [target for target in eligible if not self._is_degraded(target)]
+            degraded = sorted([target for target in eligible if self._is_degraded(target)],
+                              key=lambda target: (self._error_rate(target), self._latency_percentile(target, 95) or 0.0))
+
+        return healthy + degraded
+
+    def record_success(self, model:str, latency:float):
+        """
+        Records a successful request to the specified model, which took the given latency (in seconds).
+        """
+        with self._lock:
+            health = self._health_of(model)
+            health["calls"] += 1
+            health["latencies"].append(latency)
+            health["outcomes"].append(True)
+            health["consecutive_failures"] = 0
+
+            if health["state"] != ModelRouter.CLOSED:
+                logger.info(f"Model {model} is healthy again, closing its circuit.")
+                health["state"] = ModelRouter.CLOSED
+                health["outcomes"].clear() # a fresh start, or else the past errors would keep it degraded
+
+    def record_failure(self, model:str):
+        """
+        Records a failed request to the specified model.
+        """
+        with self._lock:
+            health = self._health_of(model)
+            health["calls"] += 1
+            health["failures"] += 1
+            health["outcomes"].append(False)
+            health["consecutive_failures"] += 1
+
+            if health["state"] == ModelRouter.HALF_OPEN or \
+               (health["state"] == ModelRouter.CLOSED and health["consecutive_failures"] >= self.failure_threshold):
+                logger.warning(f"Model {model} failed {health['consecutive_failures']} consecutive times, opening its circuit.")
+                health["state"] = ModelRouter.OPEN
+                health["opened_at"] = time.monotonic()
+
+    def latency_percentile(self, model:str, percentile:float) -> float:
+        """
+        Returns the given percentile (0-100) of the recent latencies of the specified model, in seconds, or None if 
+        there are no latencies yet.
+        """
+        with self._lock:
+            return self._latency_percentile(model, percentile)
+
+    def latency_samples(self, model:str) -> int:
+        """
+        Returns the number of recent latencies of the specified model, over which its latency percentiles are computed.
+        """
+        with self._lock:
+            return len(self._health[model]["latencies"]) if model in self._health else 0
+
+    def get_health_report(self) -> dict:
+        """
+        Returns, for each model requested so far, the number of calls and failures, the recent error rate, the median
+        and 95th percentile latencies, and the state of its circuit.
+        """
+        with self._lock:
+            return {model: {"calls": health["calls"],
+                            "failures": health["failures"],
+                            "error_rate": self._error_rate(model),
+                            "latency_p50": self._latency_percentile(model, 50),
+                            "latency_p95": self._latency_percentile(model, 95),
+                            "circuit": health["state"]}
+                    for model, health in self._health.items()}
+
+    def _health_of(self, model:str) -> dict:
+        if model not in self._health:
+            self._health[model] = {"calls": 0, "failures": 0, 
+                                   "latencies": collections.deque(maxlen=self.window),
+                                   "outcomes": collections.deque(maxlen=self.window),
+                                   "consecutive_failures": 0, "state": ModelRouter.CLOSED, "opened_at": None}
+        return self._health[model]
+
+    def _circuit_allows(self, model:str) -> bool:
+        health = self._health_of(model)
+        if health["state"] == ModelRouter.OPEN and time.monotonic() - health["opened_at"] >= self.cooldown:
+            health["state"] = ModelRouter.HALF_OPEN
+
+        return health["state"] != ModelRouter.OPEN
+
+    def _error_rate(self, model:str) -> float:
+        outcomes = self._health_of(model)["outcomes"]
+        return outcomes.count(False) / len(outcomes) if len(outcomes) > 0 else 0.0
+
+    def _is_degraded(self, model:str) -> bool:
+        return len(self._health_of(model)["outcomes"]) >= self.min_samples and self._error_rate(model) > self.max_error_rate
+
+    def _latency_percentile(self, model:str, percentile:float) -> float:
+        latencies = sorted(self._health_of(model)["latencies"])
+        if len(latencies) == 0:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+class HedgingPolicy:
+    """
+    When to hedge a request, that is, to send a duplicate of it if it takes longer than usual, so that a single slow 
+    response does not hold up everything else (e.g., a whole simulation step).
+    """
+
+    def __init__(self, percentile:float=95, max_extra_load:float=0.1, min_samples:int=20, use_fallbacks:bool=True):
+        """
+        Initializes the hedging policy.
+
+        Args:
+            percentile (float): The percentile of the recent latencies of a model after which a request to it is hedged.
+            max_extra_load (float): The maximum fraction of requests that can be duplicated.
+            min_samples (int): The minimum number of requests to a model before its requests are hedged.
+            use_fallbacks (bool): Whether to send the duplicate to the next candidate model (i.e., a fallback), if any,
+              rather than to the same model.
+        """
+        self.percentile = percentile
+        self.max_extra_load = max_extra_load
+        self.min_samples = min_samples
+        self.use_fallbacks = use_fallbacks
+
+class OutputLengthStats:
+    """
+    The distribution of output lengths (in tokens) of each call site, from which max_tokens can be set to just above 
+    what each call site actually needs, rather than to a large default. Since providers often schedule and rate-limit 
+    requests by their max_tokens, oversized values waste throughput. The statistics can be persisted to a JSON file, 
+    so that they are not learnt again on every run.
+    """
+
+    def __init__(self, percentile:float=99, margin:float=1.25, min_samples:int=20, window:int=200, 
+                 min_max_tokens:int=64, file_name:str=None, save_every:int=20):
+        """
+        Initializes the output length statistics, loading them from the file, if it exists.
+
+        Args:
+            percentile (float): The percentile of the recent output lengths of a call site to base max_tokens on.
+            margin (float): The factor by which that percentile is multiplied to get max_tokens.
+            min_samples (int): The minimum number of outputs of a call site before its max_tokens is adapted.
+            window (int): The number of most recent outputs of each call site that are considered.
+            min_max_tokens (int): The smallest max_tokens that is ever set.
+            file_name (str): The JSON file where the statistics are persisted. If None, they are kept in memory only.
+            save_every (int): The number of new outputs after which the statistics are saved to the file. Whatever 
+              is left unsaved is saved on exit, or by save_unsaved().
+        """
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.window = window
+        self.min_max_tokens = min_max_tokens
+        self.file_name = file_name
+        self.save_every = save_every
+
+        self._lengths = {} # call site -> deque of output lengths
+        self._truncations = {} # call site -> number of truncated outputs
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+        self.load()
+
+        if self.file_name is not None:
+            atexit.register(self.save_unsaved)
+
+    def record(self, call_site:str, output_tokens:int, truncated:bool=False):
+        """
+        Records the length of an output of the specified call site, and whether it was truncated by max_tokens.
+        """
+        with self._lock:
+            self._lengths_of(call_site).append(output_tokens)
+            if truncated:
+                self._truncations[call_site] = self._truncations.get(call_site, 0) + 1
+
+            self._unsaved += 1
+            save = self.file_name is not None and self._unsaved >= self.save_every
+
+        if save:
+            self.save()
+
+    def max_tokens_for(self, call_site:str, max_tokens:int) -> int:
+        """
+        Returns the max_tokens to request for the specified call site, which is never more than the given (configured) 
+        max_tokens. Without enough statistics yet, that is the given max_tokens itself.
+        """
+        with self._lock:
+            lengths = sorted(self._lengths.get(call_site, []))
+
+        if len(lengths) < self.min_samples:
+            return max_tokens
+
+        length = lengths[min(len(lengths) - 1, int(len(lengths) * self.percentile / 100))]
+        return min(max_tokens, max(self.min_max_tokens, int(length * self.margin)))
+
+    def get_report(self) -> dict:
+        """
+        Returns, for each call site, the number of outputs considered, their median and high percentile lengths, and
+        how many outputs were truncated.
+        """
+        with self._lock:
+            report = {}
+            for call_site, lengths in self._lengths.items():
+                lengths = sorted(lengths)
+                report[call_site] = {"samples": len(lengths),
+                                     "length_p50": lengths[len(lengths) // 2] if len(lengths) > 0 else None,
+                                     f"length_p{self.percentile:g}": lengths[min(len(lengths) - 1, int(len(lengths) * self.percentile / 100))] if len(lengths) > 0 else None,
+                                     "truncations": self._truncations.get(call_site, 0)}
+            return report
+
+    def save(self):
+        """
+        Saves the statistics to the file, if any.
+        """
+        if self.file_name is None:
+            return
+
+        with self._lock:
+            data = {call_site: list(lengths) for call_site, lengths in self._lengths.items()}
+            self._unsaved = 0
+
+        try:
+            with open(self.file_name, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+        except OSError as e:
+            logger.error(f"Error saving output length statistics: {e}")
+
+    def save_unsaved(self):
+        """
+        Saves the statistics to the file, if any, only if there are new outputs since they were last saved.
+        """
+        with self._lock:
+            unsaved = self._unsaved > 0
+
+        if unsaved:
+            self.save()
+
+    def load(self):
+        """
+        Loads the statistics from the file, if it exists.
+        """
+        if self.file_name is None or not os.path.exists(self.file_name):
+            return
+
+        try:
+            with open(self.file_name, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Error loading output length statistics: {e}")
+            return
+
+        with self._lock:
+            for call_site, lengths in data.items():
+                self._lengths_of(call_site).extend(lengths)
+
+    def _lengths_of(self, call_site:str) -> collections.deque:
+        if call_site not in self._lengths:
+            self._lengths[call_site] = collections.deque(maxlen=self.window)
+        return self._lengths[call_site]
+
 ###########################################################################
 # LiteLLM Client
 ###########################################################################
@@ -347,6 +941,18 @@ class LiteLLMClient:
         self.cache_file_name = cache_file_name
         self.api_cache = self._load_cache() if cache_api_calls else {}
         self.usage_tracker = {}
+        self.call_site_usage_tracker = {}
+        self.prefix_stability_tracker = {}
+        self.structured_output_tracker = {}
+        self._last_prompts = {} # prefix key -> last serialized prompt
+        self.router = ModelRouter(fallback_models=default["fallback_models"] if default["enable_fallbacks"] else [])
+        self.hedging_policy = HedgingPolicy(percentile=default["hedge_percentile"], max_extra_load=default["hedge_max_extra_load"]) \
+                              if default["hedge_requests"] else None
+        self.hedging_tracker = {"requests": 0, "hedged": 0, "hedge_wins": 0}
+        self.output_length_stats = OutputLengthStats(file_name=default["output_lengths_file_name"]) \
+                                   if default["adaptive_max_tokens"] else None
+        self._tracking_lock = threading.RLock()
+        self._executor = None
         
         # Setup LiteLLM configuration
         self._setup_from_config()
@@ -354,18 +960,22 @@ class LiteLLMClient:
         # Register the client
         register_client("litellm", self)
     
-    def set_api_cache(self, cache_api_calls, cache_file_name=default["cache_file_name"]):
+    def set_api_cache(self, cache_api_calls, cache_file_name=default["cache_file_name"], api_cache=None):
         """
         Set the API cache configuration.
         
         Args:
             cache_api_calls: Whether to cache API calls
-            cache_file_name: Name of the cache file
+            cache_file_name: Name of the cache file. If None, the cache is kept in memory only.
+            api_cache: An existing dict-like cache to use instead of loading one from the cache file 
+              (e.g., a cache shared among several processes).
         """
         self.cache_api_calls = cache_api_calls
         self.cache_file_name = cache_file_name
         
-        if cache_api_calls:
+        if api_cache is not None:
+            self.api_cache = api_cache
+        elif cache_api_calls:
             self.api_cache = self._load_cache()
         else:
             self.api_cache = {}
@@ -387,11 +997,12 @@ class LiteLLMClient:
         # Set default model
         litellm.set_verbose = False
     
+    @tracing.traced("LiteLLMClient.send_message")
     def send_message(self,
                     current_messages,
                     model=None,
-                    temperature=default["temperature"],
-                    max_tokens=default["max_tokens"],
+                    temperature=None,
+                    max_tokens=None,
                     top_p=default["top_p"],
                     frequency_penalty=default["frequency_penalty"],
                     presence_penalty=default["presence_penalty"],
@@ -402,15 +1013,21 @@ class LiteLLMClient:
                     exponential_backoff_factor=default["exponential_backoff_factor"],
                     n=1,
                     response_format=None,
+                    stable_prefix_length=None,
+                    prefix_key=None,
+                    stream=False,
+                    stream_callback=None,
+                    call_site=None,
                     **kwargs):
         """
         Send a message to the LLM model.
         
         Args:
             current_messages: List of message dictionaries
-            model: Model to use (if None, uses default)
-            temperature: Sampling temperature
-            max_tokens: Maximum tokens to generate
+            model: Model to use (if None, uses the one of the call site, or else the default)
+            temperature: Sampling temperature (if None, uses the one of the call site, or else the default)
+            max_tokens: Maximum tokens to generate (if None, uses the ones of the call site, or else the default, which
+              can be lowered to what the call site actually needs, if adaptive max_tokens are enabled)
             top_p: Top-p sampling parameter
             frequency_penalty: Frequency penalty
             presence_penalty: Presence penalty
@@ -421,41 +1038,72 @@ class LiteLLMClient:
             exponential_backoff_factor: Exponential backoff factor
             n: Number of completions
             response_format: Response format specification
+            stable_prefix_length: Number of leading messages that are not expected to change from one call to the next.
+              For providers that require explicit hints, these are marked to be cached.
+            prefix_key: Identifies the sequence of calls this one belongs to (e.g., an agent name), so that its prompt 
+              can be compared with the previous one in the sequence to measure how stable prompt prefixes are.
+            stream: Whether to stream the response, so that it can be consumed as it is generated.
+            stream_callback: A function called with each new piece of text of the response, as it arrives. If the 
+              response comes from the cache, it is called once, with the whole text.
+            call_site: The name of the use of the LLM this call is for (see call_sites), which determines the defaults of
+              the model, temperature and max_tokens, and under which usage is reported.
             **kwargs: Additional parameters
             
         Returns:
             Dictionary containing the model response
         """
+        settings = call_site_settings(call_site)
         if model is None:
-            model = default["model"]
+            model = settings["model"]
+        if temperature is None:
+            temperature = settings["temperature"]
         
-        # Re-enable caching based on config setting
-        self.cache_api_calls = default["cache_api_calls"]
+        # an explicit max_tokens is used as is, otherwise it can be adapted to the call site's output lengths. Streamed 
+        # outputs still count in these, but are not adapted: a truncated one could not be requested again once consumed.
+        track_output_length = max_tokens is None and call_site is not None and self.output_length_stats is not None
+        adaptive = track_output_length and not stream
+        if max_tokens is None:
+            max_tokens = settings["max_tokens"]
+        
+        tracing.current_span().set_attribute("model", model)
+        tracing.current_span().set_attribute("call_site", call_site)
+        
+        if prefix_key is not None:
+            self._track_prefix_stability(prefix_key, current_messages)
+        
+        cache_api_calls = self.cache_api_calls
         
         cache_key = None
         # Only try to use cache if caching is enabled
-        if self.cache_api_calls:
-            try:
-                # Create cache key
-                cache_key = self._create_cache_key(current_messages, model, temperature, max_tokens, 
-                                                top_p, frequency_penalty, presence_penalty, stop, 
-                                                response_format, **kwargs)
+        if cache_api_calls:
+            with tracing.span("llm.cache_lookup"):
+                try:
+                    # Create cache key
+                    cache_key = self._create_cache_key(current_messages, model, temperature, max_tokens, 
+                                                    top_p, frequency_penalty, presence_penalty, stop, 
+                                                    response_format, **kwargs)
                 
-                # Check cache first
-                if cache_key in self.api_cache:
-                    logger.debug(f"Cache hit for key: {cache_key[:50]}...")
-                    return self.api_cache[cache_key]
-            except Exception as e:
-                # If we can't create a cache key due to non-serializable objects, log and continue without caching
-                logger.warning(f"Could not use cache due to error: {e}")
-                self.cache_api_calls = False  # Temporarily disable caching for this request
-        
-        # Prepare parameters for LiteLLM
-        litellm_params = {
-            "model": model,
+                    # Check cache first
+                    if cache_key in self.api_cache:
+                        logger.debug("Cache hit for key: %s...", cache_key[:50])
+                        _llm_cache_hits.inc(model=model, call_site=call_site)
+                        cached = self.api_cache[cache_key]
+                        if stream_callback is not None and cached is not None and cached.get("content"):
+                            stream_callback(cached["content"])
+                        return cached
+                
+                    _llm_cache_misses.inc(model=model, call_site=call_site)
+                except Exception as e:
+                    # If we can't create a cache key due to non-serializable objects, log and continue without caching
+                    logger.warning(f"Could not use cache due to error: {e}")
+                    cache_api_calls = False  # Disable caching for this request only
+        
+        # Prepare parameters for LiteLLM. The actual model is chosen by the router, and the parameters are then
+        # adapted to it (see _routed_completion()).
+        request_params = {
             "messages": current_messages,
             "temperature": temperature,
-            "max_tokens": max_tokens,
+            "max_tokens": self.output_length_stats.max_tokens_for(call_site, max_tokens) if adaptive else max_tokens,
             "top_p": top_p,
             "frequency_penalty": frequency_penalty,
             "presence_penalty": presence_penalty,
@@ -464,47 +1112,44 @@ class LiteLLMClient:
             **kwargs
         }
         
-        # Remove model-specific unsupported parameters
-        if model.startswith("groq/") and "echo" in litellm_params:
-            logger.debug("Removing 'echo' parameter for Groq models")
-            litellm_params.pop("echo")
-            
-        # Handle Gemini models - ensure correct provider and remove unsupported parameters
-        if "gemini" in model.lower():
-            # Ensure correct provider for Gemini
-            if not model.startswith("vertex_ai/"):
-                new_model = f"vertex_ai/gemini-2.0-flash"
-                logger.warning(f"Converting model {model} to use vertex_ai provider: {new_model}")
-                litellm_params["model"] = new_model
-            
-            # Remove unsupported parameters
-            unsupported_params = ["presence_penalty"]
-            for param in unsupported_params:
-                if param in litellm_params:
-                    logger.debug(f"Removing '{param}' parameter for Gemini models")
-                    litellm_params.pop(param)
-        
         # Add response format if specified
         if response_format:
-            litellm_params["response_format"] = response_format
+            request_params["response_format"] = response_format
         
         # Remove None values
-        litellm_params = {k: v for k, v in litellm_params.items() if v is not None}
+        request_params = {k: v for k, v in request_params.items() if v is not None}
+        
+        # once part of a streamed response was consumed, the request cannot be transparently retried anymore
+        stream_started = [False]
         
         # Retry logic with exponential backoff
         def aux_exponential_backoff():
             for attempt in range(max_attempts + 1):
                 try:
-                    logger.debug(f"Attempting LLM call to {model} (attempt {attempt + 1}/{max_attempts + 1})")
+                    logger.debug("Attempting LLM call to %s (attempt %d/%d)", model, attempt + 1, max_attempts + 1)
+                    
+                    # Use LiteLLM completion, on the model chosen by the router
+                    with tracing.span("llm.request", attempt=attempt):
+                        response, routed_model = self._routed_completion(model, request_params, stable_prefix_length, 
+                                                                         stream, stream_callback, stream_started, call_site)
                     
-                    # Use LiteLLM completion
-                    response = litellm.completion(**litellm_params)
+                    # outputs truncated by an adapted max_tokens are requested again, with a larger one
+                    while adaptive and _finish_reason(response) == "length" and request_params["max_tokens"] < max_tokens:
+                        logger.debug("Output truncated at %d tokens, retrying with more", request_params["max_tokens"])
+                        self._track_usage(response, routed_model, call_site)
+                        self._track_output_length(response, call_site, truncated=True)
+                        request_params["max_tokens"] = min(max_tokens, request_params["max_tokens"] * 2)
+                        _llm_retries.inc(model=model, call_site=call_site)
+                        with tracing.span("llm.request", attempt=attempt, max_tokens=request_params["max_tokens"]):
+                            response, routed_model = self._routed_completion(model, request_params, stable_prefix_length, 
+                                                                             stream, stream_callback, stream_started, call_site)
                     
                     # Extract the response
-                    result = self._raw_model_response_extractor(response)
+                    with tracing.span("llm.parse"):
+                        result = self._raw_model_response_extractor(response)
                     
                     # Cache the result if caching is enabled and we have a valid cache key
-                    if self.cache_api_calls and cache_key:
+                    if cache_api_calls and cache_key:
                         try:
                             self.api_cache[cache_key] = result
                             self._save_cache()
@@ -512,74 +1157,392 @@ class LiteLLMClient:
                             logger.warning(f"Could not cache result: {e}")
                     
                     # Track usage
-                    self._track_usage(response, model)
+                    self._track_usage(response, routed_model, call_site)
+                    if track_output_length:
+                        self._track_output_length(response, call_site, truncated=_finish_reason(response) == "length")
+                    
+                    _llm_calls.inc(model=routed_model, call_site=call_site)
+                    _llm_call_duration.observe(time.monotonic() - start_time, model=routed_model, call_site=call_site)
                     
                     return result
                     
                 except litellm.RateLimitError as e:
                     logger.warning(f"Rate limit error (attempt {attempt + 1}): {e}")
+                    _llm_errors.inc(model=model, call_site=call_site, error=type(e).__name__)
                     if attempt < max_attempts:
                         wait_time = waiting_time * (exponential_backoff_factor ** attempt)
                         logger.info(f"Waiting {wait_time} seconds before retry...")
-                        time.sleep(wait_time)
+                        _llm_retries.inc(model=model, call_site=call_site)
+                        _llm_rate_limit_wait.inc(wait_time, model=model, call_site=call_site)
+                        _wait_before_retry(wait_time)
                     else:
                         raise
                         
                 except litellm.AuthenticationError as e:
                     logger.error(f"Authentication error: {e}")
+                    _llm_errors.inc(model=model, call_site=call_site, error=type(e).__name__)
                     raise
                     
                 except litellm.BadRequestError as e:
                     logger.error(f"Bad request error with model {model}: {e}")
-                    # Extract specific parameter errors from the exception
-                    error_msg = str(e)
-                    
-                    # Check for specific provider issues
-                    if "groq" in model.lower() and "echo" in error_msg.lower():
-                        logger.warning("Groq does not support the 'echo' parameter. Removing it and retrying...")
-                        if "echo" in litellm_params:
-                            litellm_params.pop("echo")
-                            return aux_exponential_backoff()  # Retry with fixed parameters
-                    
-                    # Check for unsupported parameters in Gemini
-                    if "gemini" in model.lower() and "UnsupportedParamsError" in error_msg:
-                        if "presence_penalty" in error_msg:
-                            logger.warning("Gemini does not support the 'presence_penalty' parameter. Removing it and retrying...")
-                            if "presence_penalty" in litellm_params:
-                                litellm_params.pop("presence_penalty")
-                                return aux_exponential_backoff()  # Retry with fixed parameters
-                    
+                    _llm_errors.inc(model=model, call_site=call_site, error=type(e).__name__)
                     raise
                 
                 except litellm.NotFoundError as e:
                     logger.error(f"Not Found error with model {model}: {e}")
-                    error_msg = str(e)
-                    
-                    # Check for Vertex AI provider issues
-                    if "gemini" in model.lower() and "VertexAIException" in error_msg:
-                        if not model.startswith("vertex_ai/"):
-                            new_model = f"vertex_ai/gemini-2.0-flash"
-                            logger.warning(f"Possible provider mismatch. Converting model {model} to {new_model}")
-                            litellm_params["model"] = new_model
-                            return aux_exponential_backoff()  # Retry with fixed model name
-                    
+                    _llm_errors.inc(model=model, call_site=call_site, error=type(e).__name__)
                     if attempt < max_attempts:
                         wait_time = waiting_time * (exponential_backoff_factor ** attempt)
                         logger.info(f"Waiting {wait_time} seconds before retry...")
-                        time.sleep(wait_time)
+                        _llm_retries.inc(model=model, call_site=call_site)
+                        _wait_before_retry(wait_time)
                     else:
                         raise
                     
                 except Exception as e:
                     logger.error(f"Unexpected error (attempt {attempt + 1}) with model {model}: {e}")
-                    if attempt < max_attempts:
+                    _llm_errors.inc(model=model, call_site=call_site, error=type(e).__name__)
+                    if attempt < max_attempts and not stream_started[0]:
                         wait_time = waiting_time * (exponential_backoff_factor ** attempt)
                         logger.info(f"Waiting {wait_time} seconds before retry...")
-                        time.sleep(wait_time)
+                        _llm_retries.inc(model=model, call_site=call_site)
+                        _wait_before_retry(wait_time)
                     else:
                         raise
         
-        return aux_exponential_backoff()
+        start_time = time.monotonic()
+        with _llm_in_flight.track(model=model, call_site=call_site):
+            return aux_exponential_backoff()
+    
+    def _routed_completion(self, model, request_params, stable_prefix_length, stream, stream_callback, stream_started, call_site=None):
+        """
+        Requests a completion from the candidate models given by the router, in order, failing over to the next one
+        immediately on server-side failures.
+        
+        Args:
+            model: The requested model
+            request_params: Parameters for LiteLLM, except for the model
+            stable_prefix_length: Number of leading messages that form the stable prefix, if known
+            stream: Whether to stream the response
+            stream_callback: A function called with each new piece of text, if streaming
+            stream_started: A one-element list, whose element is set to True once some streamed text was consumed
+            call_site: The call site of the request, if any
+            
+        Returns:
+            Tuple with the LiteLLM response object and the model that produced it
+        """
+        candidates = self.router.candidates(_resolve_model(model))
+        
+        last_error = None
+        for i, candidate in enumerate(candidates):
+            try:
+                # streamed responses are consumed as they arrive, so they cannot be hedged
+                if self.hedging_policy is not None and not stream:
+                    hedge_candidate = candidates[i + 1] if self.hedging_policy.use_fallbacks and i + 1 < len(candidates) else candidate
+                    return self._hedged_completion(candidate, hedge_candidate, request_params, stable_prefix_length, call_site)
+                
+                response = self._timed_completion(candidate, request_params, stable_prefix_length, stream, stream_callback, stream_started)
+                return response, candidate
+            
+            except ModelRouter.FAILOVER_ERRORS as e:
+                if stream_started[0]:
+                    raise
+                
+                logger.warning(f"Model {candidate} failed ({type(e).__name__}), failing over to the next candidate, if any: {e}")
+                last_error = e
+        
+        raise last_error
+    
+    def _timed_completion(self, model, request_params, stable_prefix_length, stream=False, stream_callback=None, stream_started=None):
+        """
+        Requests a completion from the specified model (see _completion()), recording its latency or failure in the router.
+        
+        Returns:
+            LiteLLM response object
+        """
+        start_time = time.monotonic()
+        try:
+            response = self._completion(model, request_params, stable_prefix_length, stream, stream_callback, 
+                                        stream_started if stream_started is not None else [False])
+        except ModelRouter.FAILOVER_ERRORS:
+            self.router.record_failure(model)
+            raise
+        
+        self.router.record_success(model, time.monotonic() - start_time)
+        return response
+    
+    def _hedged_completion(self, model, hedge_model, request_params, stable_prefix_length, call_site=None):
+        """
+        Requests a completion from the specified model and, if it does not respond within the hedging policy's percentile
+        of its recent latencies, sends a duplicate request to the hedge model (which can be the same model). The first 
+        response wins, and the other request is cancelled if it has not started yet, or else abandoned: its response is 
+        not used, but it still counts in the usage and latency statistics.
+        
+        Args:
+            model: The model to request the completion from
+            hedge_model: The model to send the duplicate request to
+            request_params: Parameters for LiteLLM, except for the model
+            stable_prefix_length: Number of leading messages that form the stable prefix, if known
+            call_site: The call site of the request, if any, under which the abandoned request's usage is tracked
+            
+        Returns:
+            Tuple with the LiteLLM response object and the model that produced it
+        """
+        policy = self.hedging_policy
+        
+        delay = None
+        if self.router.latency_samples(model) >= policy.min_samples:
+            delay = self.router.latency_percentile(model, policy.percentile)
+        if delay is None:
+            # not enough latency statistics to decide when to hedge
+            return self._timed_completion(model, request_params, stable_prefix_length), model
+        
+        # the requests run within the caller's context, so that their usage, metrics labels and trace spans are attributed to it
+        futures = {self._hedging_executor().submit(contextvars.copy_context().run, self._timed_completion, 
+                                                   model, request_params, stable_prefix_length): model}
+        done, _ = concurrent.futures.wait(futures, timeout=delay)
+        
+        with self._tracking_lock:
+            self.hedging_tracker["requests"] += 1
+            hedge = len(done) == 0 and self.hedging_tracker["hedged"] < policy.max_extra_load * self.hedging_tracker["requests"]
+            if hedge:
+                self.hedging_tracker["hedged"] += 1
+                self._usage_of(hedge_model)["hedged_calls"] += 1
+        
+        if hedge:
+            logger.debug("No response from %s after %.2f seconds, hedging with %s", model, delay, hedge_model)
+            futures[self._hedging_executor().submit(contextvars.copy_context().run, self._timed_completion, 
+                                                    hedge_model, request_params, stable_prefix_length)] = hedge_model
+        
+        pending = set(futures.keys())
+        last_error = None
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except ModelRouter.FAILOVER_ERRORS as e:
+                    last_error = e
+                    continue
+                
+                for loser in pending:
+                    if not loser.cancel():
+                        track_abandoned = in_current_context(self._track_abandoned)
+                        loser.add_done_callback(lambda loser, loser_model=futures[loser]: track_abandoned(loser, loser_model, call_site))
+                
+                winner_model = futures[future]
+                if len(futures) > 1 and future is not list(futures.keys())[0]:
+                    with self._tracking_lock:
+                        self.hedging_tracker["hedge_wins"] += 1
+                        self._usage_of(winner_model)["hedge_wins"] += 1
+                
+                return response, winner_model
+        
+        raise last_error
+    
+    def _track_abandoned(self, future, model, call_site=None):
+        """
+        Track the usage of a request whose response was abandoned in favor of another one.
+        """
+        if not future.cancelled() and future.exception() is None:
+            self._track_usage(future.result(), model, call_site)
+    
+    def _hedging_executor(self):
+        if self._executor is None:
+            with self._tracking_lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="tinytroupe-hedging")
+        return self._executor
+    
+    def close(self):
+        """
+        Shut down the threads used for hedged requests, and save the output length statistics that are not saved yet.
+        Requests still running (e.g., abandoned ones) are waited for. The client can still be used afterwards, in which 
+        case new threads are started as needed.
+        """
+        with self._tracking_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        
+        if self.output_length_stats is not None:
+            self.output_length_stats.save_unsaved()
+    
+    def set_hedging_policy(self, hedging_policy):
+        """
+        Set the hedging policy, or disable hedging if None.
+        
+        Args:
+            hedging_policy: A HedgingPolicy, or None
+        """
+        self.hedging_policy = hedging_policy
+    
+    def get_hedging_report(self):
+        """
+        Get hedging statistics.
+        
+        Returns:
+            Dictionary containing the number of requests that could be hedged, how many were, how many of these were won
+            by the hedge, and the extra load (i.e., the fraction of requests that were duplicated)
+        """
+        with self._tracking_lock:
+            return {**self.hedging_tracker, "extra_load": self.hedging_tracker["hedged"] / max(self.hedging_tracker["requests"], 1)}
+    
+    def _completion(self, model, request_params, stable_prefix_length, stream, stream_callback, stream_started):
+        """
+        Requests a completion from the specified model, with the parameters adapted to what it supports.
+        
+        Returns:
+            LiteLLM response object
+        """
+        def aux_litellm_params():
+            litellm_params = ModelCapabilities.sanitize(model, {"model": model, **request_params})
+            
+            # Mark the stable prefix for providers that only cache prompts explicitly
+            if stable_prefix_length:
+                litellm_params["messages"] = self._add_cache_control_hints(litellm_params["messages"], model, stable_prefix_length)
+            
+            return litellm_params
+        
+        def aux_completion(litellm_params):
+            if stream:
+                return self._streaming_completion(litellm_params, stream_callback, stream_started)
+            return litellm.completion(**litellm_params)
+        
+        litellm_params = aux_litellm_params()
+        try:
+            return aux_completion(litellm_params)
+        
+        except litellm.BadRequestError as e:
+            # Learn which parameters the model does not support, so that they are not sent anymore, and retry without them
+            if not ModelCapabilities.learn_from_error(model, e, litellm_params):
+                raise
+            return aux_completion(aux_litellm_params())
+    
+    def _streaming_completion(self, litellm_params, stream_callback, stream_started):
+        """
+        Requests a streamed completion, passing each new piece of text to the callback as it arrives, and then 
+        rebuilds the complete response from the chunks.
+        
+        Args:
+            litellm_params: Parameters for LiteLLM
+            stream_callback: A function called with each new piece of text, or None
+            stream_started: A one-element list, whose element is set to True once some text was passed to the callback
+            
+        Returns:
+            LiteLLM response object, as if the response had not been streamed
+        """
+        chunks = []
+        for chunk in litellm.completion(**litellm_params, stream=True):
+            chunks.append(chunk)
+            
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text and stream_callback is not None:
+                stream_started[0] = True
+                stream_callback(text)
+        
+        return litellm.stream_chunk_builder(chunks, messages=litellm_params["messages"])
+    
+    def send_structured_message(self, current_messages, output_model, model=None, max_repair_attempts=2, **kwargs):
+        """
+        Send a message to the LLM model, requesting an output that conforms to the given pydantic model. If the model 
+        supports structured outputs, the schema is enforced by the provider. In any case, the output is validated, and
+        if invalid, a short repair request is sent with just the invalid output and the schema, instead of sending the 
+        whole conversation again.
+        
+        Args:
+            current_messages: List of message dictionaries
+            output_model: The pydantic model class the output must conform to
+            model: Model to use (if None, uses default)
+            max_repair_attempts: Maximum number of repair requests before giving up
+            **kwargs: Additional parameters, passed on to send_message()
+            
+        Returns:
+            Tuple with the role of the response and the validated output (a dict)
+            
+        Raises:
+            ValueError: If the output is still invalid after all repair attempts
+        """
+        if model is None:
+            model = call_site_settings(kwargs.get("call_site"))["model"]
+        
+        response_format = output_model if ModelCapabilities.of(_resolve_model(model))["response_schema"] else None
+        next_message = self.send_message(current_messages, model=model, response_format=response_format, **kwargs)
+        if next_message is None:
+            raise ValueError(f"No response from model {model}.")
+        
+        output = next_message["content"] or ""
+        wasted_tokens = 0
+        for attempt in range(max_repair_attempts + 1):
+            content, error = _validate_structured_output(output, output_model)
+            if error is None:
+                self._track_structured_output(model, repair_attempts=attempt, failed=False, wasted_tokens=wasted_tokens)
+                return next_message["role"], content
+            
+            if attempt == max_repair_attempts:
+                break
+            
+            logger.debug("Invalid structured output from %s (repair attempt %d/%d): %s", model, attempt + 1, max_repair_attempts, error)
+            repair_messages = _structured_output_repair_messages(output, output_model, error)
+            repaired = self.send_message(repair_messages, model=model, temperature=0.0, response_format=response_format,
+                                         call_site=kwargs.get("call_site"))
+            
+            # the repair request is only overhead with respect to a valid first output
+            wasted_tokens += sum(utils.count_tokens(message["content"]) for message in repair_messages) 
+            output = (repaired or {}).get("content") or ""
+            wasted_tokens += utils.count_tokens(output)
+        
+        # everything was wasted, including the original request, which will presumably be sent again
+        wasted_tokens += sum(utils.count_tokens(str(message["content"])) for message in current_messages) + \
+                         utils.count_tokens(next_message["content"] or "")
+        self._track_structured_output(model, repair_attempts=max_repair_attempts, failed=True, wasted_tokens=wasted_tokens)
+        
+        raise ValueError(f"Output of model {model} does not conform to {output_model.__name__} even after {max_repair_attempts} repair attempts: {error}")
+    
+    def _track_structured_output(self, model, repair_attempts, failed, wasted_tokens):
+        """
+        Track structured output statistics.
+        
+        Args:
+            model: Model name
+            repair_attempts: Number of repair requests sent
+            failed: Whether the output remained invalid after all repair attempts
+            wasted_tokens: Tokens (estimated) spent on requests whose outputs were not used
+        """
+        with self._tracking_lock:
+            if model not in self.structured_output_tracker:
+                self.structured_output_tracker[model] = {
+                    "calls": 0,
+                    "valid_at_first": 0,
+                    "repaired": 0,
+                    "failed": 0,
+                    "repair_requests": 0,
+                    "wasted_tokens": 0
+                }
+        
+            stats = self.structured_output_tracker[model]
+            stats["calls"] += 1
+            stats["repair_requests"] += repair_attempts
+            stats["wasted_tokens"] += wasted_tokens
+            if failed:
+                stats["failed"] += 1
+            elif repair_attempts > 0:
+                stats["repaired"] += 1
+            else:
+                stats["valid_at_first"] += 1
+    
+    def get_structured_output_report(self):
+        """
+        Get structured output statistics.
+        
+        Returns:
+            Dictionary containing, for each model, the number of calls, how many were valid at first, repaired or failed,
+            the number of repair requests and the tokens wasted, as well as the retry rate (i.e., the fraction of calls
+            that were not valid at first).
+        """
+        with self._tracking_lock:
+            return {model: {**stats, "retry_rate": (stats["calls"] - stats["valid_at_first"]) / max(stats["calls"], 1)}
+                    for model, stats in self.structured_output_tracker.items()}
     
     def _raw_model_response_extractor(self, response):
         """
@@ -651,27 +1614,151 @@ class LiteLLMClient:
             request_str = json.dumps(fallback_data, sort_keys=True)
             return hashlib.md5(f"fallback:{request_str}".encode()).hexdigest()
     
-    def _track_usage(self, response, model):
+    def _track_usage(self, response, model, call_site=None):
         """
-        Track usage statistics.
+        Track usage statistics, both by model and by call site.
         
         Args:
             response: LiteLLM response object
             model: Model name
+            call_site: Call site name, if any
         """
         if hasattr(response, 'usage') and response.usage:
-            if model not in self.usage_tracker:
-                self.usage_tracker[model] = {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0,
-                    "calls": 0
+            # prompt tokens read from the provider's prompt cache, if reported
+            cached_tokens = getattr(response.usage, "cache_read_input_tokens", None)
+            if not cached_tokens:
+                prompt_tokens_details = getattr(response.usage, "prompt_tokens_details", None)
+                cached_tokens = getattr(prompt_tokens_details, "cached_tokens", None)
+            
+            _llm_tokens.inc(response.usage.prompt_tokens or 0, model=model, call_site=call_site, kind="prompt")
+            _llm_tokens.inc(response.usage.completion_tokens or 0, model=model, call_site=call_site, kind="completion")
+            _llm_tokens.inc(cached_tokens or 0, model=model, call_site=call_site, kind="cached_prompt")
+            
+            with self._tracking_lock:
+                for usage in [self._usage_of(model), self._usage_of(call_site or "other", self.call_site_usage_tracker)]:
+                    usage["prompt_tokens"] += response.usage.prompt_tokens or 0
+                    usage["completion_tokens"] += response.usage.completion_tokens or 0
+                    usage["total_tokens"] += response.usage.total_tokens or 0
+                    usage["calls"] += 1
+                    usage["cached_prompt_tokens"] += cached_tokens or 0
+    
+    def _track_output_length(self, response, call_site, truncated):
+        """
+        Track the output length of a response of the specified call site, to adapt its max_tokens.
+        """
+        if hasattr(response, 'usage') and response.usage and response.usage.completion_tokens:
+            self.output_length_stats.record(call_site, response.usage.completion_tokens, truncated=truncated)
+    
+    def _usage_of(self, model, tracker=None):
+        if tracker is None:
+            tracker = self.usage_tracker
+        
+        if model not in tracker:
+            tracker[model] = {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0,
+                "calls": 0,
+                "cached_prompt_tokens": 0,
+                "hedged_calls": 0,
+                "hedge_wins": 0
+            }
+        return tracker[model]
+    
+    def _track_prefix_stability(self, prefix_key, messages):
+        """
+        Track how many bytes of the prompt are the same as in the previous prompt with the same prefix key. Since providers
+        cache prompts by prefix, this tells how much of each prompt could be served from the provider's cache.
+        
+        Args:
+            prefix_key: Identifies the sequence of calls (e.g., an agent name)
+            messages: List of message dictionaries about to be sent
+        """
+        prompt = json.dumps(messages, default=_json_default_serializer).encode("utf-8")
+        with self._tracking_lock:
+            last_prompt = self._last_prompts.get(prefix_key, b"")
+            self._last_prompts[prefix_key] = prompt
+        stable_bytes = _common_prefix_length(last_prompt, prompt)
+        
+        with self._tracking_lock:
+            if prefix_key not in self.prefix_stability_tracker:
+                self.prefix_stability_tracker[prefix_key] = {
+                    "calls": 0,
+                    "stable_prefix_bytes": 0,
+                    "total_bytes": 0,
+                    "last_stable_prefix_bytes": 0
                 }
             
-            self.usage_tracker[model]["prompt_tokens"] += response.usage.prompt_tokens or 0
-            self.usage_tracker[model]["completion_tokens"] += response.usage.completion_tokens or 0
-            self.usage_tracker[model]["total_tokens"] += response.usage.total_tokens or 0
-            self.usage_tracker[model]["calls"] += 1
+            stats = self.prefix_stability_tracker[prefix_key]
+            stats["calls"] += 1
+            stats["stable_prefix_bytes"] += stable_bytes
+            stats["total_bytes"] += len(prompt)
+            stats["last_stable_prefix_bytes"] = stable_bytes
+        
+        logger.debug("[%s] Stable prompt prefix: %d of %d bytes", prefix_key, stable_bytes, len(prompt))
+    
+    def get_prefix_stability_report(self):
+        """
+        Get prompt prefix stability statistics, per prefix key and overall.
+        
+        Returns:
+            Dictionary containing, for each prefix key and for "overall", the number of calls, the stable prefix bytes,
+            the total bytes and the ratio between them.
+        """
+        with self._tracking_lock:
+            trackers = {prefix_key: dict(stats) for prefix_key, stats in self.prefix_stability_tracker.items()}
+        
+        report = {}
+        for prefix_key, stats in trackers.items():
+            report[prefix_key] = {**stats, "stable_ratio": stats["stable_prefix_bytes"] / max(stats["total_bytes"], 1)}
+        
+        overall = {
+            "calls": sum(stats["calls"] for stats in trackers.values()),
+            "stable_prefix_bytes": sum(stats["stable_prefix_bytes"] for stats in trackers.values()),
+            "total_bytes": sum(stats["total_bytes"] for stats in trackers.values())
+        }
+        overall["stable_ratio"] = overall["stable_prefix_bytes"] / max(overall["total_bytes"], 1)
+        report["overall"] = overall
+        
+        return report
+    
+    @staticmethod
+    def _add_cache_control_hints(messages, model, stable_prefix_length):
+        """
+        Mark the end of the system message and of the stable prefix as cache breakpoints, for providers that only cache 
+        prompts when explicitly told to (Anthropic models, whether served directly, through Bedrock or through Vertex AI). 
+        Other providers (e.g., OpenAI, Azure OpenAI, Gemini) cache stable prefixes automatically, so no hints are needed.
+        
+        Args:
+            messages: List of message dictionaries
+            model: Model name
+            stable_prefix_length: Number of leading messages that form the stable prefix
+            
+        Returns:
+            The messages, with cache hints if applicable
+        """
+        if "claude" not in model.lower() and not model.lower().startswith("anthropic/"):
+            return messages
+        
+        breakpoints = {0, min(stable_prefix_length, len(messages)) - 1}
+        
+        hinted_messages = []
+        for i, message in enumerate(messages):
+            if i in breakpoints and isinstance(message.get("content"), str):
+                message = {**message, "content": [{"type": "text", "text": message["content"], 
+                                                   "cache_control": {"type": "ephemeral"}}]}
+            hinted_messages.append(message)
+        
+        return hinted_messages
+    
+    def get_routing_report(self):
+        """
+        Get the health of each model requested so far, as seen by the router.
+        
+        Returns:
+            Dictionary containing routing statistics for each model
+        """
+        return self.router.get_health_report()
     
     def get_usage_report(self):
         """
@@ -682,8 +1769,39 @@ class LiteLLMClient:
         """
         return self.usage_tracker
     
+    def set_output_length_stats(self, output_length_stats):
+        """
+        Set the output length statistics from which max_tokens is adapted, or disable adaptive max_tokens if None.
+        
+        Args:
+            output_length_stats: An OutputLengthStats, or None
+        """
+        self.output_length_stats = output_length_stats
+    
+    def get_output_length_report(self):
+        """
+        Get output length statistics by call site, if adaptive max_tokens are enabled.
+        
+        Returns:
+            Dictionary containing output length statistics for each call site (see OutputLengthStats.get_report())
+        """
+        return self.output_length_stats.get_report() if self.output_length_stats is not None else {}
+    
+    def get_call_site_usage_report(self):
+        """
+        Get usage statistics by call site (see call_sites). Calls made without a call site are reported under "other".
+        
+        Returns:
+            Dictionary containing usage statistics for each call site
+        """
+        return self.call_site_usage_tracker
+    
     def _save_cache(self):
         """Save the API cache to disk."""
+        if self.cache_file_name is None:
+            # in-memory (or externally managed) cache only
+            return
+        
         try:
             with open(self.cache_file_name, 'wb') as f:
                 pickle.dump(self.api_cache, f)
@@ -693,7 +1811,7 @@ class LiteLLMClient:
     def _load_cache(self):
         """Load the API cache from disk."""
         try:
-            if os.path.exists(self.cache_file_name):
+            if self.cache_file_name is not None and os.path.exists(self.cache_file_name):
                 with open(self.cache_file_name, 'rb') as f:
                     return pickle.load(f)
         except Exception as e:
@@ -734,6 +1852,60 @@ class LiteLLMClient:
             logger.error(f"Error extracting embedding: {e}")
             return None
 
+def _common_prefix_length(a, b):
+    """
+    Returns the length of the common prefix of two byte strings. Uses a binary search over slice comparisons, 
+    which are done natively, instead of comparing byte by byte.
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def _wait_before_retry(wait_time):
+    with tracing.span("llm.backoff", wait_time=wait_time):
+        time.sleep(wait_time)
+
+def _finish_reason(response):
+    """
+    Returns why the model stopped generating the (first choice of the) response, e.g., "stop" or "length".
+    """
+    try:
+        return response.choices[0].finish_reason
+    except (AttributeError, IndexError):
+        return None
+
+def _validate_structured_output(output, output_model):
+    """
+    Parses and validates the output against the pydantic model.
+    
+    Returns:
+        Tuple with the parsed output (a dict) and the validation error, if any (None otherwise)
+    """
+    content = utils.extract_json(output)
+    try:
+        output_model.model_validate(content)
+        return content, None
+    except ValueError as e: # pydantic's ValidationError is a ValueError
+        return content, e
+
+def _structured_output_repair_messages(output, output_model, error):
+    """
+    Builds a short request to repair an invalid output, with just the output itself, the error and the schema.
+    """
+    schema = json.dumps(output_model.model_json_schema())
+    return [
+        {"role": "system", 
+         "content": "You fix JSON outputs that do not conform to a JSON schema. Keep the original values whenever possible, " +\
+                    "and fill in missing required values sensibly. Reply with the corrected JSON object only."},
+        {"role": "user", 
+         "content": f"JSON schema:\n{schema}\n\nInvalid output:\n{output}\n\nValidation errors:\n{error}"}
+    ]
+
 ###########################################################################
 # Client Registry and Management
 ###########################################################################
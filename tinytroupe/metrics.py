@@ -0,0 +1,327 @@
+"""
+Metrics about the operation of TinyTroupe, such as the latencies, tokens, retries and cache hits of LLM calls. Metrics
+are counters, gauges and histograms kept in a thread-safe registry, and can be exported either in the Prometheus text
+exposition format or as a JSON snapshot, e.g., to feed the dashboards of long-running simulation farms.
+
+Besides the labels given when a metric is updated, the labels in the current context are applied (see labels()),
+as well as the id of the simulation running in the current context, if any. This way, for instance, an LLM call is
+attributed to the agent and simulation it is made for, without passing these along to the client.
+"""
+import contextlib
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger("tinytroupe")
+
+
+# The labels in the current context, which are applied to all metrics updated within it.
+_context_labels = contextvars.ContextVar("tinytroupe_metrics_labels", default={})
+
+@contextlib.contextmanager
+def labels(**context_labels):
+    """
+    Applies the given labels (e.g., agent="Oscar") to all metrics updated within the context.
+    """
+    token = _context_labels.set({**_context_labels.get(), **context_labels})
+    try:
+        yield
+    finally:
+        _context_labels.reset(token)
+
+def current_labels() -> dict:
+    """
+    Returns the labels of the current context, including the id of the simulation running in it, if any.
+    """
+    # local import to avoid circular dependencies
+    from tinytroupe import control
+
+    simulation = control.current_simulation()
+    if simulation is None:
+        return _context_labels.get()
+
+    return {"simulation_id": simulation.id, **_context_labels.get()}
+
+
+class Metric:
+    """
+    A named metric with a fixed set of label names, whose values are kept separately for each combination of label values.
+    """
+
+    TYPE = None
+
+    def __init__(self, name:str, description:str, label_names:list):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+
+        self._values = {} # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels:dict) -> tuple:
+        context = current_labels()
+        return tuple(str(labels.get(name, context.get(name, "")) or "") for name in self.label_names)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self) -> list:
+        """
+        Returns the current values, as a list of (labels, value) pairs.
+        """
+        with self._lock:
+            return [(dict(zip(self.label_names, key)), self._copy(value)) for key, value in self._values.items()]
+
+    def _copy(self, value):
+        return value
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g., the number of calls or of tokens.
+    """
+
+    TYPE = "counter"
+
+    def inc(self, amount:float=1, **labels):
+        if amount < 0:
+            raise ValueError(f"Counter {self.name} can only be increased, not by {amount}.")
+
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """
+        Returns the sum of the values whose labels match the given ones.
+        """
+        return sum(value for sample_labels, value in self.samples() if _matches(sample_labels, labels))
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, e.g., the number of calls in flight.
+    """
+
+    TYPE = "gauge"
+
+    def inc(self, amount:float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount:float=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextlib.contextmanager
+    def track(self, **labels):
+        """
+        Increases the gauge while within the context.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._values[key] -= 1
+
+    def value(self, **labels) -> float:
+        """
+        Returns the sum of the values whose labels match the given ones.
+        """
+        return sum(value for sample_labels, value in self.samples() if _matches(sample_labels, labels))
+
+class Histogram(Metric):
+    """
+    The distribution of a value, e.g., the latency of calls, as counts of observations per bucket, plus their sum.
+    """
+
+    TYPE = "histogram"
+
+    DEFAULT_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0]
+
+    def __init__(self, name:str, description:str, label_names:list, buckets:list=None):
+        super().__init__(name, description, label_names)
+        self.buckets = sorted(buckets if buckets is not None else Histogram.DEFAULT_BUCKETS) + [math.inf]
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+
+            histogram = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observes the time spent within the context, in seconds.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels) -> int:
+        """
+        Returns the number of observations whose labels match the given ones.
+        """
+        return sum(value["count"] for sample_labels, value in self.samples() if _matches(sample_labels, labels))
+
+    def _copy(self, value):
+        # the buckets are made cumulative, as in Prometheus
+        cumulative = []
+        total = 0
+        for count in value["counts"]:
+            total += count
+            cumulative.append(total)
+        return {"buckets": dict(zip(self.buckets, cumulative)), "sum": value["sum"], "count": value["count"]}
+
+
+class MetricsRegistry:
+    """
+    A registry of metrics, which can be exported as a whole. Metrics are created when first requested, and the same
+    metric is returned afterwards.
+    """
+
+    def __init__(self):
+        self._metrics = {} # name -> metric
+        self._lock = threading.Lock()
+
+    def counter(self, name:str, description:str="", label_names:list=()) -> Counter:
+        return self._get_or_create(Counter, name, description, label_names)
+
+    def gauge(self, name:str, description:str="", label_names:list=()) -> Gauge:
+        return self._get_or_create(Gauge, name, description, label_names)
+
+    def histogram(self, name:str, description:str="", label_names:list=(), buckets:list=None) -> Histogram:
+        return self._get_or_create(Histogram, name, description, label_names, buckets=buckets)
+
+    def get(self, name:str) -> Metric:
+        """
+        Returns the metric with the given name, or None if there is none.
+        """
+        return self._metrics.get(name)
+
+    def reset(self):
+        """
+        Resets the values of all metrics, keeping the metrics themselves.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def _get_or_create(self, metric_class, name, description, label_names, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, description, label_names, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class) or metric.label_names != tuple(label_names):
+                raise ValueError(f"Metric {name} is already registered as a {metric.TYPE} with labels {metric.label_names}.")
+            return metric
+
+    ############################################################################
+    # Export
+    ############################################################################
+
+    def to_prometheus(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.description)}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for sample_labels, value in metric.samples():
+                if metric.TYPE == "histogram":
+                    for bound, count in value["buckets"].items():
+                        bucket_labels = {**sample_labels, "le": "+Inf" if bound == math.inf else _format_value(bound)}
+                        lines.append(f"{metric.name}_bucket{_format_labels(bucket_labels)} {count}")
+                    lines.append(f"{metric.name}_sum{_format_labels(sample_labels)} {_format_value(value['sum'])}")
+                    lines.append(f"{metric.name}_count{_format_labels(sample_labels)} {value['count']}")
+                else:
+                    lines.append(f"{metric.name}{_format_labels(sample_labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        """
+        Returns a snapshot of all metrics, as a JSON-serializable dict.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        snapshot = {"timestamp": time.time(), "metrics": {}}
+        for metric in metrics:
+            samples = []
+            for sample_labels, value in metric.samples():
+                if metric.TYPE == "histogram":
+                    value = {**value, "buckets": {("+Inf" if bound == math.inf else _format_value(bound)): count
+                                                  for bound, count in value["buckets"].items()}}
+                samples.append({"labels": sample_labels, "value": value})
+
+            snapshot["metrics"][metric.name] = {"type": metric.TYPE, "description": metric.description, "samples": samples}
+
+        return snapshot
+
+    def export(self, file_name:str):
+        """
+        Writes all metrics to the given file, as a JSON snapshot if its extension is .json, or else in the Prometheus
+        text exposition format (e.g., for the textfile collector of the Prometheus node exporter).
+        """
+        if file_name.endswith(".json"):
+            content = json.dumps(self.to_json(), indent=2)
+        else:
+            content = self.to_prometheus()
+
+        # written to a temporary file first, so that collectors never read a partially written file
+        temp_file_name = f"{file_name}.tmp"
+        with open(temp_file_name, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_file_name, file_name)
+
+
+def _matches(sample_labels:dict, labels:dict) -> bool:
+    return all(sample_labels.get(name) == str(value) for name, value in labels.items())
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(labels:dict) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _escape_help(text:str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+# The registry of TinyTroupe's own metrics.
+registry = MetricsRegistry()
@@ -62,7 +62,7 @@ class TinyStory:
         messages = utils.compose_initial_LLM_messages_with_templates("story.start.system.mustache", "story.start.user.mustache", 
                                                                      base_module_folder="steering",
                                                                      rendering_configs=rendering_configs)
-        next_message = litellm_utils.client().send_message(messages, temperature=1.5)
+        next_message = litellm_utils.client().send_message(messages, call_site="story")
 
         start = next_message["content"]
 
@@ -94,7 +94,7 @@ class TinyStory:
         messages = utils.compose_initial_LLM_messages_with_templates("story.continuation.system.mustache", "story.continuation.user.mustache", 
                                                                      base_module_folder="steering",
                                                                      rendering_configs=rendering_configs)
-        next_message = litellm_utils.client().send_message(messages, temperature=1.5)
+        next_message = litellm_utils.client().send_message(messages, call_site="story")
 
         continuation = next_message["content"]
 
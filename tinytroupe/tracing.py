@@ -0,0 +1,302 @@
+"""
+Tracing of where the wall-clock time of a simulation goes. The main operations (e.g., world steps, agent actions, LLM
+calls, memory retrievals, transaction encoding and checkpoints) are wrapped in spans, which are nested according to
+the calls that happen within them, and exported to a file, to be inspected as a flame chart.
+
+Spans are exported either as JSON lines, using the field names of OpenTelemetry's JSON encoding (traceId, spanId,
+parentSpanId, startTimeUnixNano, etc.), or as Chrome trace events, which can be opened in chrome://tracing or Perfetto.
+Tracing is disabled by default, in which case spans cost next to nothing. It is enabled either with enable() or by
+setting TRACE_FILE_NAME in the [Tracing] section of the config file.
+"""
+import atexit
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+from tinytroupe import utils
+
+import logging
+logger = logging.getLogger("tinytroupe")
+
+
+class Span:
+    """
+    A timed operation, with attributes that describe it (e.g., the agent acting).
+    """
+
+    __slots__ = ["name", "trace_id", "span_id", "parent_span_id", "start_time_ns", "end_time_ns", "attributes",
+                 "error", "thread_id"]
+
+    def __init__(self, name:str, trace_id:str, span_id:str, parent_span_id:str, attributes:dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_span_id = parent_span_id
+        self.attributes = attributes
+        self.start_time_ns = None
+        self.end_time_ns = None
+        self.error = None
+        self.thread_id = threading.get_ident()
+
+    def set_attribute(self, key:str, value):
+        self.attributes[key] = value
+
+    @property
+    def duration_ns(self) -> int:
+        return self.end_time_ns - self.start_time_ns if self.end_time_ns is not None else None
+
+    def to_json(self) -> dict:
+        """
+        Returns the span in OpenTelemetry's JSON encoding.
+        """
+        return {"traceId": self.trace_id,
+                "spanId": self.span_id,
+                "parentSpanId": self.parent_span_id or "",
+                "name": self.name,
+                "startTimeUnixNano": self.start_time_ns,
+                "endTimeUnixNano": self.end_time_ns,
+                "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in self.attributes.items()],
+                "status": {"code": "STATUS_CODE_ERROR", "message": self.error} if self.error is not None else {"code": "STATUS_CODE_OK"}}
+
+class _ActiveSpan:
+    """
+    The context manager of a span, which makes it the parent of the spans started within it.
+    """
+
+    __slots__ = ["span", "tracer", "_token"]
+
+    def __init__(self, tracer, span:Span):
+        self.tracer = tracer
+        self.span = span
+        self._token = None
+
+    def __enter__(self) -> Span:
+        self._token = _current_span.set(self.span)
+        self.span.start_time_ns = time.time_ns()
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.end_time_ns = time.time_ns()
+        if exc_type is not None:
+            self.span.error = f"{exc_type.__name__}: {exc_value}"
+
+        _current_span.reset(self._token)
+        self.tracer.exporter.export(self.span)
+        return False
+
+class _NoOpSpan:
+    """
+    What span() returns when tracing is disabled, which does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key:str, value):
+        pass
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+class Tracer:
+    """
+    Creates spans and passes them on to an exporter once they end.
+    """
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    def span(self, name:str, attributes:dict) -> _ActiveSpan:
+        parent = _current_span.get()
+        if parent is None:
+            trace_id = f"{random.getrandbits(128):032x}"
+            parent_span_id = None
+        else:
+            trace_id = parent.trace_id
+            parent_span_id = parent.span_id
+
+        return _ActiveSpan(self, Span(name, trace_id, f"{random.getrandbits(64):016x}", parent_span_id, attributes))
+
+
+###########################################################################
+# Exporters
+###########################################################################
+
+class InMemoryExporter:
+    """
+    Keeps the spans in memory (e.g., for tests or for analysis within the same process).
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span:Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def close(self):
+        pass
+
+class JSONLinesExporter:
+    """
+    Appends each span to a file, as a line of JSON in OpenTelemetry's JSON encoding.
+    """
+
+    def __init__(self, file_name:str):
+        self.file_name = file_name
+        self._file = open(file_name, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, span:Span):
+        line = json.dumps(span.to_json(), default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class ChromeTraceExporter:
+    """
+    Writes the spans to a file as Chrome trace events, which can be opened in chrome://tracing or Perfetto. The file
+    is written when the exporter is closed (which happens when tracing is disabled, or at exit).
+    """
+
+    def __init__(self, file_name:str):
+        self.file_name = file_name
+        self._events = []
+        self._lock = threading.Lock()
+
+    def export(self, span:Span):
+        event = {"name": span.name,
+                 "ph": "X",
+                 "ts": span.start_time_ns / 1000,
+                 "dur": span.duration_ns / 1000,
+                 "pid": os.getpid(),
+                 "tid": span.thread_id,
+                 "args": {key: _attribute_value(value, typed=False) for key, value in span.attributes.items()}}
+        if span.error is not None:
+            event["args"]["error"] = span.error
+
+        with self._lock:
+            self._events.append(event)
+
+    def close(self):
+        with self._lock:
+            events = self._events
+            self._events = []
+
+        with open(self.file_name, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def exporter_for(file_name:str):
+    """
+    Returns the exporter for the specified file: Chrome trace events if its extension is .json, or else JSON lines.
+    """
+    return ChromeTraceExporter(file_name) if file_name.endswith(".json") else JSONLinesExporter(file_name)
+
+
+###########################################################################
+# Tracing API
+###########################################################################
+
+_tracer = None
+_current_span = contextvars.ContextVar("tinytroupe_current_span", default=None)
+
+def enable(exporter):
+    """
+    Enables tracing, exporting spans with the given exporter (see exporter_for()). If tracing was already enabled,
+    the previous exporter is closed.
+    """
+    global _tracer
+    previous = _tracer
+    _tracer = Tracer(exporter)
+
+    if previous is not None:
+        previous.exporter.close()
+
+def disable():
+    """
+    Disables tracing, closing the exporter.
+    """
+    global _tracer
+    previous = _tracer
+    _tracer = None
+
+    if previous is not None:
+        previous.exporter.close()
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+def span(name:str, **attributes):
+    """
+    Returns a context manager that times the operation within it as a span with the given name and attributes.
+    """
+    if _tracer is None:
+        return _NO_OP_SPAN
+    return _tracer.span(name, attributes)
+
+def current_span():
+    """
+    Returns the span of the current context, to which attributes can be added (e.g., once known). If tracing is disabled,
+    or there is no span, the returned span does nothing.
+    """
+    current = _current_span.get() if _tracer is not None else None
+    return current if current is not None else _NO_OP_SPAN
+
+def traced(name:str=None, attributes=None):
+    """
+    Decorator that times each call of the decorated function as a span.
+
+    Args:
+        name (str): The name of the span. Defaults to the qualified name of the function.
+        attributes (callable): A function that receives the same arguments as the decorated function and returns
+          the attributes of the span (e.g., the name of the agent acting). It is only called if tracing is enabled.
+    """
+    def decorator(func):
+        span_name = name if name is not None else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+
+            with _tracer.span(span_name, attributes(*args, **kwargs) if attributes is not None else {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+def _attribute_value(value, typed:bool=True):
+    if not isinstance(value, (str, bool, int, float)):
+        value = str(value)
+
+    if not typed:
+        return value
+    elif isinstance(value, bool):
+        return {"boolValue": value}
+    elif isinstance(value, int):
+        return {"intValue": str(value)}
+    elif isinstance(value, float):
+        return {"doubleValue": value}
+    else:
+        return {"stringValue": value}
+
+
+# tracing can be enabled in the config file, too
+_config = utils.read_config_file()
+if _config.has_section("Tracing") and _config["Tracing"].get("TRACE_FILE_NAME"):
+    enable(exporter_for(_config["Tracing"]["TRACE_FILE_NAME"]))
+    atexit.register(disable)
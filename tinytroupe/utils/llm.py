@@ -10,6 +10,7 @@ from tinytroupe.litellm_utils import LLMRequest
 
 from tinytroupe.utils import logger
 from tinytroupe.utils.rendering import break_text_at_length
+from tinytroupe.utils.misc import thaw
 
 ################################################################################
 # Model input utilities
@@ -88,29 +89,192 @@ def llm(**model_overrides):
 ################################################################################	
 # Model output utilities
 ################################################################################
-def extract_json(text: str) -> dict:
+class JSONExtractionError(ValueError):
+    """
+    Raised when no valid JSON object or array can be extracted from a text.
+    """
+    pass
+
+class JSONExtractor:
+    """
+    Extracts the first JSON object or array from a text, ignoring any text before or after it (e.g., explanations or
+    Markdown code fences). The text can be given all at once or incrementally, in chunks (e.g., as a streamed LLM 
+    response arrives). Either way, each character is scanned only once, keeping track of strings and escapes, so that
+    the matching closing brace is found in linear time, regardless of what the text contains.
+
+    For JSON objects, top-level fields are also parsed as soon as their values are complete, and made available 
+    in `completed_fields`, so that parts of a streamed response can be used before the rest arrives.
+
+    Usage example:
+        extractor = JSONExtractor()
+        for chunk in chunks:
+            extractor.feed(chunk)
+            if "action" in extractor.completed_fields:
+                ...
+        result = extractor.result()
+    """
+
+    # the only characters that matter for finding the boundaries of the JSON value and of its top-level fields
+    _STRUCTURAL_CHARACTERS = re.compile(r'[{}\[\]",:\\]')
+
+    def __init__(self):
+        self._chunks = []
+        self._length = 0
+
+        self.start = None # index of the first opening brace
+        self.end = None # index right after the matching closing brace
+        self._depth = 0
+        self._in_string = False
+        self._skip_until = 0 # escaped characters are skipped
+
+        # top-level fields, for JSON objects
+        self.completed_fields = {}
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+
+    def feed(self, chunk:str):
+        """
+        Scans one more chunk of text. Once the JSON value is complete, further chunks are ignored.
+
+        Returns:
+            JSONExtractor: self, for chaining.
+        """
+        offset = self._length
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+
+        if self.end is not None:
+            return self
+
+        for match in JSONExtractor._STRUCTURAL_CHARACTERS.finditer(chunk):
+            i = offset + match.start()
+            if i < self._skip_until:
+                continue
+
+            char = match.group()
+            if self.start is None:
+                if char in "{[":
+                    self.start = i
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if char == "\\":
+                    self._skip_until = i + 2
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._key_start is not None:
+                        self._key = self._parse_slice(self._key_start, i + 1)
+                        self._key_start = None
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._value_start is None:
+                    self._key_start = i
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._complete_field(i)
+                    self.end = i + 1
+                    break
+            elif self._depth == 1:
+                if char == ":" and self._key is not None:
+                    self._value_start = i + 1
+                elif char == ",":
+                    self._complete_field(i)
+
+        return self
+
+    def is_complete(self) -> bool:
+        """
+        Whether the JSON value has been completely received.
+        """
+        return self.end is not None
+
+    def result(self):
+        """
+        Parses the JSON value found in the text.
+
+        Returns:
+            The parsed JSON value (a dict or a list).
+
+        Raises:
+            JSONExtractionError: If no JSON value was found, if it is incomplete, or if it is invalid.
+        """
+        if self.start is None:
+            raise JSONExtractionError("No JSON object or array found in the text.")
+        if self.end is None:
+            raise JSONExtractionError(f"Incomplete JSON: the value starting at position {self.start} is never closed.")
+
+        return _decode_json_at(self._text(), self.start)
+
+    def _text(self) -> str:
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def _parse_slice(self, start:int, end:int):
+        try:
+            return json.loads(self._text()[start:end], strict=False)
+        except json.JSONDecodeError:
+            return None
+
+    def _complete_field(self, end:int):
+        if self._key is not None and self._value_start is not None:
+            value = self._parse_slice(self._value_start, end)
+            if value is not None or self._text()[self._value_start:end].strip() == "null":
+                self.completed_fields[self._key] = value
+
+        self._key = None
+        self._value_start = None
+
+_JSON_START = re.compile(r'[{\[]')
+_json_decoder = json.JSONDecoder(strict=False) # strict=False to correctly parse new lines, tabs, etc.
+
+def _decode_json_at(text:str, start:int):
+    """
+    Decodes the JSON value starting at the given position, ignoring whatever comes after it. 
+    """
+    try:
+        return _json_decoder.raw_decode(text, start)[0]
+    except json.JSONDecodeError as e:
+        # models sometimes escape single quotes, which is invalid in JSON
+        if "\\'" in text:
+            try:
+                return _json_decoder.raw_decode(text[start:].replace("\\'", "'"))[0]
+            except json.JSONDecodeError:
+                pass
+        raise JSONExtractionError(f"Invalid JSON at position {e.pos}: {e.msg}.") from e
+
+def extract_json(text: str, strict:bool=False) -> dict:
     """
     Extracts a JSON object from a string, ignoring: any text before the first 
     opening curly brace; and any Markdown opening (```json) or closing(```) tags.
+
+    Args:
+        text (str): The text containing the JSON object (or array).
+        strict (bool): Whether to raise a JSONExtractionError if no valid JSON can be extracted. 
+          Otherwise, the error is logged and an empty dict is returned.
     """
     try:
-        # remove any text before the first opening curly or square braces, using regex. Leave the braces.
-        text = re.sub(r'^.*?({|\[)', r'\1', text, flags=re.DOTALL)
+        if not isinstance(text, str):
+            raise JSONExtractionError(f"Expected a string, got {type(text).__name__}.")
 
-        # remove any trailing text after the LAST closing curly or square braces, using regex. Leave the braces.
-        text  =  re.sub(r'(}|\])(?!.*(\]|\})).*$', r'\1', text, flags=re.DOTALL)
-        
-        # remove invalid escape sequences, which show up sometimes
-        text = re.sub("\\'", "'", text) # replace \' with just '
-        text = re.sub("\\,", ",", text)
+        # For a complete text, there is no need to scan it beforehand: the decoder itself stops at the end of the 
+        # JSON value, in a single pass.
+        match = _JSON_START.search(text)
+        if match is None:
+            raise JSONExtractionError("No JSON object or array found in the text.")
 
-        # use strict=False to correctly parse new lines, tabs, etc.
-        parsed = json.loads(text, strict=False)
-        
-        # return the parsed JSON object
-        return parsed
+        return _decode_json_at(text, match.start())
     
-    except Exception as e:
+    except JSONExtractionError as e:
+        if strict:
+            raise
         logger.error(f"Error occurred while extracting JSON: {e}")
         return {}
 
@@ -215,11 +379,12 @@ def truncate_actions_or_stimuli(list_of_actions_or_stimuli: Collection[dict], ma
         Collection[str]: The truncated list of actions or stimuli. It is a new list, not a reference to the original list, 
         to avoid unexpected side effects.
     """
-    cloned_list = copy.deepcopy(list_of_actions_or_stimuli)
+    # thawing also copies, and works for immutable (e.g., shared) episodes as well
+    cloned_list = thaw(list_of_actions_or_stimuli)
     
     for element in cloned_list:
-        # the external wrapper of the LLM message: {'role': ..., 'content': ...}
-        if "content" in element:
+        # the external wrapper of the LLM message: {'role': ..., 'content': ...}. Some messages (e.g., summaries) just have text content.
+        if "content" in element and isinstance(element["content"], dict):
             msg_content = element["content"] 
 
             # now the actual action or stimulus content
@@ -240,4 +405,37 @@ def truncate_actions_or_stimuli(list_of_actions_or_stimuli: Collection[dict], ma
                     if "content" in stimulus:
                         stimulus["content"] = break_text_at_length(stimulus["content"], max_content_length)
     
-    return cloned_list
\ No newline at end of file
+    return cloned_list
+
+################################################################################
+# Token counting
+################################################################################
+
+@functools.lru_cache(maxsize=1)
+def _tokenizer():
+    try:
+        # local import, since only token counting needs it
+        import litellm
+        return litellm.encoding
+    except Exception as e:
+        logger.warning(f"No tokenizer available, token counts will be estimated from text length: {e}")
+        return None
+
+@functools.lru_cache(maxsize=100_000)
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of the specified text. The tokenizer is loaded only once, and counts are cached, since
+    the same pieces of text (e.g., episodes) are counted over and over when composing prompts. The count is
+    exact for OpenAI models, and a good approximation for others.
+
+    Args:
+        text (str): The text whose tokens are to be counted.
+
+    Returns:
+        int: The number of tokens.
+    """
+    tokenizer = _tokenizer()
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    
+    return len(tokenizer.encode(text, disallowed_special=()))
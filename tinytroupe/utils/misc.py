@@ -1,4 +1,6 @@
 import hashlib
+import threading
+import contextvars
 from typing import Union
 AgentOrWorld = Union["TinyPerson", "TinyWorld"]
 
@@ -23,18 +25,88 @@ def custom_hash(obj):
 
     return hashlib.sha256(str(obj).encode()).hexdigest()
 
-_fresh_id_counter = 0
+# The fresh id counter is context-local, so that concurrent simulations (e.g., in different threads) each
+# get their own, deterministic, sequence of ids. Contexts that never reset the counter share the global one.
+_fresh_id_counter = [0]
+_fresh_id_counter_lock = threading.Lock()
+_context_fresh_id_counter = contextvars.ContextVar("tinytroupe_fresh_id_counter", default=None)
+
 def fresh_id():
     """
     Returns a fresh ID for a new object. This is useful for generating unique IDs for objects.
     """
-    global _fresh_id_counter
-    _fresh_id_counter += 1
-    return _fresh_id_counter
+    counter = _context_fresh_id_counter.get()
+    if counter is None:
+        counter = _fresh_id_counter
+
+    with _fresh_id_counter_lock:
+        counter[0] += 1
+        return counter[0]
 
 def reset_fresh_id():
     """
-    Resets the fresh ID counter. This is useful for testing purposes.
+    Resets the fresh ID counter of the current context. This is useful for testing purposes, as well as 
+    to make ids deterministic within each simulation.
+    """
+    _context_fresh_id_counter.set([0])
+
+################################################################################
+# Immutable data
+################################################################################
+class FrozenDict(dict):
+    """
+    A read-only dict. Since it cannot change, it can be shared freely (e.g., among the memories of many agents),
+    and copying it, shallowly or deeply, just returns the same object. Being a dict, it can still be used wherever
+    plain dicts are expected, such as LLM messages or JSON serialization. Use thaw() to get a mutable copy.
     """
-    global _fresh_id_counter
-    _fresh_id_counter = 0
+
+    __slots__ = ("_hash", "__weakref__")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hash = None
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} is immutable, use thaw() to get a mutable copy.")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.items()))
+        return self._hash
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+def freeze(obj):
+    """
+    Returns an immutable version of the specified object, recursively converting dicts to FrozenDicts 
+    and lists to tuples. Objects that are already frozen are returned as they are, without copying.
+    """
+    if isinstance(obj, FrozenDict):
+        return obj
+    elif isinstance(obj, dict):
+        return FrozenDict({key: freeze(value) for key, value in obj.items()})
+    elif isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    else:
+        return obj
+
+def thaw(obj):
+    """
+    Returns a mutable copy of the specified object, recursively converting dicts (frozen or not) to dicts 
+    and tuples to lists. This is the inverse of freeze().
+    """
+    if isinstance(obj, dict):
+        return {key: thaw(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [thaw(value) for value in obj]
+    else:
+        return obj
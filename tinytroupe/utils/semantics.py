@@ -3,7 +3,7 @@ Semantic-related mechanisms.
 """
 from tinytroupe.utils import llm
 
-@llm()
+@llm(call_site="semantics")
 def rephrase(observation, rule) -> str:
     """
     Given an observation and a rule, this function rephrases or completely changes the observation in accordance with what the rule
@@ -25,7 +25,7 @@ def rephrase(observation, rule) -> str:
     """
     # llm decorator will handle the body of this function
 
-@llm()
+@llm(call_site="semantics")
 def restructure_as_observed_vs_expected(description) -> str:
     """
     Given the description of something (either a real event or abstract concept), but that violates an expectation, this function 
@@ -66,7 +66,7 @@ class TinyPersonValidator:
         current_messages.append({"role": "system", "content": system_prompt})
         current_messages.append({"role": "user", "content": user_prompt})
 
-        message = litellm_utils.client().send_message(current_messages)
+        message = litellm_utils.client().send_message(current_messages, call_site="validation")
 
         # What string to look for to terminate the conversation
         termination_mark = "```json"
@@ -84,7 +84,7 @@ class TinyPersonValidator:
 
             # Appending the responses to the current conversation and checking the next message
             current_messages.append({"role": "user", "content": responses})
-            message = litellm_utils.client().send_message(current_messages)
+            message = litellm_utils.client().send_message(current_messages, call_site="validation")
 
         if message is not None:
             json_content = utils.extract_json(message['content'])